@@ -4,15 +4,20 @@
     "name": "Pasarela de pago Redsys",
     "category": "Payment Acquirer",
     "summary": "Payment Acquirer: Redsys Implementation",
-    "version": "15.0.1.0.4",
+    "version": "15.0.1.1.0",
     "author": "Tecnativa," "Odoo Community Association (OCA)",
     "depends": ["payment", "website_sale"],
-    "external_dependencies": {"python": ["pycrypto"]},
+    "external_dependencies": {"python": ["pycryptodome"]},
     "data": [
+        "security/ir.model.access.csv",
         "views/redsys.xml",
         "views/payment_acquirer.xml",
         "views/payment_redsys_templates.xml",
+        "views/redsys_notification.xml",
+        "views/redsys_retry.xml",
+        "views/redsys_order_job.xml",
         "data/payment_redsys.xml",
+        "data/ir_cron.xml",
     ],
     "license": "AGPL-3",
     "installable": True,
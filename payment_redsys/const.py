@@ -0,0 +1,184 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+# Ranges of Ds_Response codes as (first, last, state, retryable, reason). The
+# states follow the historical classification of the module: authorised up to
+# 100, pending up to 203, canceled from 912 to 9912 and error otherwise.
+RESPONSE_RANGES = [
+    (0, 100, "done", False, "Authorised transaction"),
+    (101, 203, "pending", False, "Transaction denied"),
+    (204, 911, "error", False, "Transaction denied"),
+    (912, 9912, "cancel", False, "Transaction denied"),
+    (9913, 9999, "error", False, "Transaction denied"),
+]
+
+# Known Ds_Response codes, overriding the ranges above. Retryable codes are
+# the ones that may succeed if the same charge is attempted later.
+RESPONSE_CODES = {
+    101: ("pending", False, "Expired card"),
+    102: ("pending", False, "Card temporarily blocked or under suspicion of fraud"),
+    104: ("pending", False, "Operation not allowed for this card or terminal"),
+    106: ("pending", False, "PIN attempts exceeded"),
+    116: ("pending", True, "Insufficient funds"),
+    118: ("pending", False, "Card not registered"),
+    125: ("pending", False, "Card not effective"),
+    129: ("pending", False, "Wrong security code (CVV2/CVC2)"),
+    167: ("pending", False, "Contact the card issuer: suspicion of fraud"),
+    180: ("pending", False, "Card not supported by the service"),
+    184: ("pending", False, "Cardholder authentication error"),
+    190: ("pending", True, "Denied without specific reason"),
+    191: ("pending", False, "Wrong expiration date"),
+    195: ("pending", True, "Strong customer authentication required"),
+    202: ("pending", False, "Card blocked under suspicion of fraud"),
+    # Successful answers of cancellations, which release the authorised amount,
+    # and of refunds and confirmations. Refunds only complete the refund
+    # transaction, see payment.transaction._redsys_get_feedback_state
+    400: ("cancel", False, "Cancellation accepted"),
+    900: ("done", False, "Refund or confirmation accepted"),
+    904: ("error", False, "Merchant not registered in FUC"),
+    909: ("error", True, "System error"),
+    912: ("cancel", True, "Card issuer not available"),
+    913: ("cancel", False, "Duplicated order"),
+    944: ("cancel", False, "Wrong session"),
+    950: ("cancel", False, "Refund not allowed"),
+    9064: ("cancel", False, "Wrong number of card digits"),
+    9078: ("cancel", False, "Operation type not allowed for this card"),
+    9093: ("cancel", False, "Card does not exist"),
+    9094: ("cancel", True, "Rejected by the international servers"),
+    9104: ("cancel", False, "Secure purchase key required by the merchant"),
+    9218: ("cancel", False, "Merchant does not allow secure operations by entrada"),
+    9253: ("cancel", False, "Card does not pass the check-digit"),
+    9256: ("cancel", False, "Merchant cannot perform pre-authorisations"),
+    9257: ("cancel", False, "Card does not allow pre-authorisations"),
+    9261: ("cancel", True, "Operation stopped by the restriction controls"),
+    9912: ("cancel", True, "Card issuer not available"),
+    9915: ("error", False, "Payment canceled by the user"),
+    9928: ("error", False, "Deferred pre-authorisation canceled by SIS"),
+    9929: ("error", False, "Deferred pre-authorisation canceled by the merchant"),
+    9997: ("error", True, "Another transaction is being processed with this card"),
+    9998: ("error", True, "Operation waiting for card data"),
+    9999: ("error", True, "Operation redirected to the issuer for authentication"),
+}
+
+# Ds_ErrorCode / errorCode values returned by the SIS, as (retryable, reason)
+SIS_ERROR_CODES = {
+    "SIS0007": (False, "Error disassembling the input XML"),
+    "SIS0008": (False, "Missing Ds_Merchant_MerchantCode"),
+    "SIS0009": (False, "Wrong format of Ds_Merchant_MerchantCode"),
+    "SIS0010": (False, "Missing Ds_Merchant_Terminal"),
+    "SIS0011": (False, "Wrong format of Ds_Merchant_Terminal"),
+    "SIS0014": (False, "Wrong format of Ds_Merchant_Order"),
+    "SIS0015": (False, "Missing Ds_Merchant_Currency"),
+    "SIS0016": (False, "Wrong format of Ds_Merchant_Currency"),
+    "SIS0018": (False, "Missing Ds_Merchant_Amount"),
+    "SIS0019": (False, "Wrong format of Ds_Merchant_Amount"),
+    "SIS0020": (False, "Missing Ds_Merchant_MerchantSignature"),
+    "SIS0021": (False, "Empty Ds_Merchant_MerchantSignature"),
+    "SIS0022": (False, "Wrong format of Ds_Merchant_TransactionType"),
+    "SIS0023": (False, "Unknown Ds_Merchant_TransactionType"),
+    "SIS0026": (False, "Merchant or terminal does not exist"),
+    "SIS0027": (False, "Currency does not match the terminal"),
+    "SIS0028": (False, "Merchant or terminal deregistered"),
+    "SIS0030": (False, "Card payment not allowed for this operation type"),
+    "SIS0031": (False, "Operation type not allowed"),
+    "SIS0034": (True, "Database access error"),
+    "SIS0038": (True, "Java internal error"),
+    "SIS0040": (False, "Merchant or terminal without payment method"),
+    "SIS0041": (False, "Error calculating the signature"),
+    "SIS0042": (False, "Wrong signature"),
+    "SIS0046": (False, "Card BIN not registered"),
+    "SIS0051": (False, "Duplicated order number"),
+    "SIS0054": (False, "No operation to refund"),
+    "SIS0055": (False, "Several payments match the refund"),
+    "SIS0056": (False, "Operation to refund not authorised"),
+    "SIS0057": (False, "Amount to refund exceeds the operation amount"),
+    "SIS0058": (False, "Inconsistent data for the confirmation"),
+    "SIS0059": (False, "Operation to confirm does not exist"),
+    "SIS0060": (False, "Confirmation already done"),
+    "SIS0061": (False, "Operation to confirm not authorised"),
+    "SIS0062": (False, "Amount to confirm exceeds the authorised amount"),
+    "SIS0063": (False, "Card number not available"),
+    "SIS0064": (False, "Wrong number of card digits"),
+    "SIS0065": (False, "Card number is not numeric"),
+    "SIS0066": (False, "Missing card expiration month"),
+    "SIS0067": (False, "Card expiration month is not numeric"),
+    "SIS0068": (False, "Wrong card expiration month"),
+    "SIS0069": (False, "Missing card expiration year"),
+    "SIS0070": (False, "Card expiration year is not numeric"),
+    "SIS0071": (False, "Expired card"),
+    "SIS0072": (False, "Operation cannot be canceled"),
+    "SIS0074": (False, "Missing Ds_Merchant_Order"),
+    "SIS0075": (False, "Ds_Merchant_Order too short or too long"),
+    "SIS0076": (False, "Ds_Merchant_Order does not start with four digits"),
+    "SIS0078": (False, "Payment method not available"),
+    "SIS0093": (False, "Card not found in the ranges table"),
+    "SIS0094": (False, "Card not authenticated as 3D Secure"),
+    "SIS0112": (False, "Transaction type not allowed"),
+    "SIS0114": (False, "Call done with GET instead of POST"),
+    "SIS0142": (True, "Time limit for the payment exceeded"),
+    "SIS0216": (False, "Missing Ds_Merchant_Identifier reference"),
+    "SIS0218": (False, "Secure operations not allowed through this entry"),
+    "SIS0221": (False, "Security code (CVV2) required"),
+    "SIS0252": (False, "Merchant does not allow sending the card"),
+    "SIS0253": (False, "Card does not pass the check-digit"),
+    "SIS0256": (False, "Merchant cannot perform pre-authorisations"),
+    "SIS0257": (False, "Card does not allow pre-authorisations"),
+    "SIS0261": (True, "Operation stopped by the restriction controls"),
+    "SIS0270": (False, "Merchant cannot perform deferred authorisations"),
+    "SIS0274": (False, "Unknown or not accepted operation type"),
+    "SIS0298": (False, "Merchant does not allow card-on-file operations"),
+    "SIS0319": (False, "Merchant does not belong to the payment group"),
+    "SIS0429": (False, "Wrong Ds_SignatureVersion"),
+    "SIS0432": (False, "Wrong merchant FUC code"),
+    "SIS0433": (False, "Wrong merchant terminal"),
+    "SIS0434": (False, "Wrong order number"),
+    "SIS0435": (False, "Wrong signature"),
+    "SIS0448": (False, "DINERS operation not allowed for this merchant"),
+    "SIS0462": (False, "Operation not allowed, it requires a secure channel"),
+    "SIS0463": (False, "Operation method not allowed for this merchant"),
+    # Answer of the consultation web service when there is no operation for the
+    # order: a charge whose answer was lost never reached Redsys, it can be sent again
+    "XML0024": (True, "No operation found for the order"),
+}
+
+# ISO 4217 numeric codes (Ds_Merchant_Currency) of the currencies accepted by
+# the SIS, used to route a payment to the terminal of its currency
+CURRENCY_CODES = {
+    "EUR": "978",
+    "USD": "840",
+    "GBP": "826",
+    "JPY": "392",
+    "CHF": "756",
+    "CAD": "124",
+    "AUD": "036",
+    "SEK": "752",
+    "NOK": "578",
+    "DKK": "208",
+    "PLN": "985",
+    "CZK": "203",
+    "HUF": "348",
+    "RON": "946",
+    "MXN": "484",
+    "BRL": "986",
+    "ARS": "032",
+    "CLP": "152",
+    "COP": "170",
+    "CNY": "156",
+    "RUB": "643",
+}
+
+# Column names of the operations and settlement exports of the Redsys
+# administration module, normalized to lowercase ASCII letters. The first
+# exact match is used, then the first column containing one of them.
+EXPORT_COLUMNS = {
+    "order": ("dsorder", "numerodepedido", "pedido", "order"),
+    "amount": ("dsamount", "importe", "amount"),
+    "date": ("fechadeliquidacion", "fecha", "date"),
+    "type": ("tipodeoperacion", "tipooperacion", "transactiontype", "tipo"),
+}
+# Words of the operation type of the rows which are not a charge
+EXPORT_SKIPPED_TYPES = ("devolucion", "refund", "anulacion", "cancel")
+
+# Ds_Merchant_TransactionType of the operations other than the acquirer's own
+TRANSACTION_PREAUTHORISATION = "1"
+TRANSACTION_CAPTURE = "2"
+TRANSACTION_REFUND = "3"
@@ -2,14 +2,18 @@
 # Copyright 2019 Ignacio Ibeas <ignacio@acysos.com>
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import hmac
 import logging
-import pprint
 
 import werkzeug
 
 from odoo import http
+from odoo.exceptions import ValidationError
 from odoo.http import request
 
+from odoo.addons.payment_redsys import profiler as redsys_profiler
+from odoo.addons.payment_redsys import utils as redsys_utils
+
 _logger = logging.getLogger(__name__)
 
 
@@ -33,11 +37,15 @@ class RedsysController(http.Controller):
     )
     def redsys_return(self, **post):
         """Redsys."""
-        _logger.info(
-            "Redsys: entering form_feedback with post data %s", pprint.pformat(post)
-        )
-        if post:
-            request.env["payment.transaction"].sudo()._handle_feedback_data("redsys", post)
+        acquirer = request.env["payment.acquirer"].sudo()
+        with acquirer._redsys_profiled("/payment/redsys/return"):
+            acquirer._redsys_trace("notification", post)
+            if post:
+                # Decoded once here, then shared by the whole feedback pipeline
+                with redsys_profiler.span("parse"):
+                    redsys_utils.parse_notification(post)
+                with redsys_profiler.span("receive"):
+                    request.env["payment.redsys.notification"].sudo()._receive(post)
         return_url = post.pop("return_url", "")
         if not return_url:
             return_url = "/shop"
@@ -51,6 +59,50 @@ class RedsysController(http.Controller):
         website=True,
     )
     def redsys_result(self, page, **vals):
-        if vals:
-            request.env["payment.transaction"].sudo()._get_tx_from_feedback_data("redsys", vals)
+        acquirer = request.env["payment.acquirer"].sudo()
+        with acquirer._redsys_profiled("/payment/redsys/result"):
+            if vals:
+                with redsys_profiler.span("parse"):
+                    redsys_utils.parse_notification(vals)
+                with redsys_profiler.span("duplicate_check"):
+                    notifications = request.env["payment.redsys.notification"].sudo()
+                    duplicate = notifications._is_duplicate(vals)
+                if not duplicate:
+                    # The result page carries the same signed answer as the
+                    # notification, so it is applied the same way when it wins
+                    # the race, and the customer is redirected anyway
+                    with redsys_profiler.span("receive"):
+                        try:
+                            notifications._receive(vals)
+                        except ValidationError:
+                            _logger.exception("<redsys> Unable to apply the result page")
         return werkzeug.utils.redirect("/payment/status")
+
+    @http.route(
+        ["/payment/redsys/metrics"],
+        type="http",
+        auth="public",
+        methods=["GET"],
+        csrf=False,
+    )
+    def redsys_metrics(self, **kwargs):
+        """Scrape endpoint of the Redsys metrics, enabled by setting a token in
+        the ``payment_redsys.metrics_token`` system parameter, to be sent as a
+        bearer token.
+        """
+        token = (
+            request.env["ir.config_parameter"]
+            .sudo()
+            .get_param("payment_redsys.metrics_token")
+        )
+        if not token:
+            return request.not_found()
+        authorization = request.httprequest.headers.get("Authorization", "")
+        if not hmac.compare_digest(authorization, "Bearer %s" % token):
+            return request.make_response(
+                "Unauthorized", [("WWW-Authenticate", "Bearer")], status=401
+            )
+        return request.make_response(
+            request.env["payment.acquirer"].sudo()._get_redsys_metrics(),
+            [("Content-Type", "text/plain; version=0.0.4; charset=utf-8")],
+        )
@@ -0,0 +1,192 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""In-process counters and latency histograms of the Redsys acquirer,
+rendered in the Prometheus text exposition format.
+
+Updating a metric costs a lock and a dict lookup, so they stay enabled at
+all times. Every worker process keeps its own values, exported with a
+``pid`` label.
+"""
+
+import bisect
+import os
+import threading
+import time
+
+# Upper bounds in seconds; the last bucket (+Inf) is implicit
+FAST_BUCKETS = (0.00001, 0.00005, 0.0001, 0.0005, 0.001, 0.005, 0.01, 0.05)
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30)
+
+_registry = []
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{%s}" % ",".join(
+        '%s="%s"' % (name, str(value).replace("\\", "\\\\").replace('"', '\\"'))
+        for name, value in pairs
+    )
+
+
+class Counter(object):
+    """Monotonic counter, one value per combination of ``labelnames``."""
+
+    kind = "counter"
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+        _registry.append(self)
+
+    def inc(self, amount=1, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        return self._values.get(key, 0)
+
+    def samples(self):
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name + "_total", key, (), value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+
+class Histogram(Counter):
+    """Distribution of durations, in cumulative ``buckets`` (seconds)."""
+
+    kind = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, seconds, **labels):
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            state[0][index] += 1
+            state[1] += seconds
+            state[2] += 1
+
+    def value(self, **labels):
+        """Return the number of observations."""
+        key = tuple(str(labels.get(name, "")) for name in self.labelnames)
+        state = self._values.get(key)
+        return state[2] if state else 0
+
+    def time(self, **labels):
+        return _Timer(self, labels)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(s[0]), s[1], s[2])) for key, s in self._values.items()]
+        bounds = [repr(float(bound)) for bound in self.buckets] + ["+Inf"]
+        for key, (counts, total, count) in values:
+            cumulative = 0
+            for bound, bucket_count in zip(bounds, counts):
+                cumulative += bucket_count
+                yield self.name + "_bucket", key, (("le", bound),), cumulative
+            yield self.name + "_sum", key, (), total
+            yield self.name + "_count", key, (), count
+
+
+class _Timer(object):
+    __slots__ = ("histogram", "labels", "start")
+
+    def __init__(self, histogram, labels):
+        self.histogram = histogram
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start, **self.labels)
+
+
+def render(gauges=()):
+    """Return every metric, followed by the ``gauges``, in the Prometheus text
+    format. ``gauges`` are ``(name, documentation, [(labels, value)])``
+    triplets computed at scrape time.
+    """
+    pid = (("pid", os.getpid()),)
+    lines = []
+    for metric in list(_registry):
+        lines.append("# HELP %s %s" % (metric.name, metric.documentation))
+        lines.append("# TYPE %s %s" % (metric.name, metric.kind))
+        for name, key, extra, value in metric.samples():
+            labels = _format_labels(metric.labelnames, key, pid + extra)
+            lines.append("%s%s %s" % (name, labels, value))
+    for name, documentation, values in gauges:
+        lines.append("# HELP %s %s" % (name, documentation))
+        lines.append("# TYPE %s gauge" % name)
+        for labels, value in values:
+            labels = dict(labels, pid=os.getpid())
+            lines.append(
+                "%s%s %s" % (name, _format_labels(list(labels), labels.values()), value)
+            )
+    return "\n".join(lines) + "\n"
+
+
+def clear():
+    for metric in _registry:
+        metric.clear()
+
+
+forms_rendered = Histogram(
+    "redsys_form_render_seconds", "Time generating the redirect form values"
+)
+form_payloads = Histogram(
+    "redsys_form_payload_seconds",
+    "Time building the merchant parameters of the redirect form, signature excluded",
+    buckets=FAST_BUCKETS,
+)
+form_html = Histogram(
+    "redsys_form_html_seconds", "Time rendering the QWeb redirect form"
+)
+signatures = Histogram(
+    "redsys_sign_seconds", "Time computing HMAC_SHA256_V1 signatures", buckets=FAST_BUCKETS
+)
+tx_lookups = Histogram(
+    "redsys_tx_lookup_seconds",
+    "Time resolving and verifying the transaction of a notification",
+    ["result"],
+)
+notifications = Counter(
+    "redsys_notifications", "Notifications received, by outcome", ["result"]
+)
+feedbacks = Histogram(
+    "redsys_feedback_seconds", "Time applying Redsys answers, by resulting state", ["state"]
+)
+rest_requests = Histogram(
+    "redsys_rest_request_seconds", "Duration of the REST calls, by outcome", ["outcome"]
+)
+rest_errors = Counter(
+    "redsys_rest_errors", "SIS error codes answered to REST calls", ["code"]
+)
+
+
+def observe_rest(seconds, response, error):
+    """Record a REST call that got ``response`` or failed with ``error``."""
+    if error is not None:
+        rest_requests.observe(seconds, outcome="transport_error")
+    elif response.get("errorCode"):
+        rest_requests.observe(seconds, outcome="sis_error")
+        rest_errors.inc(code=response["errorCode"])
+    else:
+        rest_requests.observe(seconds, outcome="ok")
@@ -0,0 +1,52 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+
+_logger = logging.getLogger(__name__)
+
+
+def migrate(cr, version):
+    """Keep the Redsys order numbers of the existing transactions.
+
+    Up to 15.0.1.0.x the order number was not stored: it was the last 12
+    characters of the reference, so it is filled in from it before the
+    column becomes a plain field. Long references could share one, so only
+    the transaction a notification would have been applied to keeps it, to
+    make room for the unique constraint: the done one, else the latest.
+    """
+    if not version:
+        return
+    cr.execute(
+        "ALTER TABLE payment_transaction ADD COLUMN IF NOT EXISTS redsys_order varchar"
+    )
+    cr.execute(
+        """
+        UPDATE payment_transaction
+           SET redsys_order = RIGHT(reference, 12)
+         WHERE redsys_order IS NULL
+           AND acquirer_id IN (
+               SELECT id FROM payment_acquirer WHERE provider = 'redsys'
+           )
+        """
+    )
+    _logger.info("Redsys: stored the order number of %s transactions", cr.rowcount)
+    cr.execute(
+        """
+        UPDATE payment_transaction tx
+           SET redsys_order = NULL
+          FROM (
+              SELECT id,
+                     ROW_NUMBER() OVER (
+                         PARTITION BY redsys_order
+                         ORDER BY state = 'done' DESC, id DESC
+                     ) AS position
+                FROM payment_transaction
+               WHERE redsys_order IS NOT NULL
+          ) duplicate
+         WHERE duplicate.id = tx.id AND duplicate.position > 1
+        """
+    )
+    if cr.rowcount:
+        _logger.warning(
+            "Redsys: cleared the order number of %s transactions sharing it", cr.rowcount
+        )
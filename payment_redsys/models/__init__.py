@@ -1,3 +1,7 @@
 from . import redsys
 from . import payment_transaction
 from . import account_payment_method
+from . import redsys_notification
+from . import redsys_retry
+from . import redsys_order_job
+from . import ir_ui_view
@@ -0,0 +1,19 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+from odoo import models
+
+from odoo.addons.payment_redsys import metrics as redsys_metrics
+
+
+class IrUiView(models.Model):
+    _inherit = "ir.ui.view"
+
+    def _render(self, values=None, engine="ir.qweb", minimal_qcontext=False):
+        if not self.env.context.get("redsys_form_render"):
+            return super()._render(
+                values=values, engine=engine, minimal_qcontext=minimal_qcontext
+            )
+        with redsys_metrics.form_html.time():
+            return super()._render(
+                values=values, engine=engine, minimal_qcontext=minimal_qcontext
+            )
@@ -1,21 +1,197 @@
 import base64
 import json
-import urllib
-import requests
 import logging
-from odoo.tools import config
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import timedelta
+
+from psycopg2.extras import execute_values
+
+from odoo.tools import config, create_index, split_every
 from odoo.exceptions import UserError
 from odoo import _, api, fields, http, models
 from odoo.tools.float_utils import float_compare
 from odoo.addons.payment.models.payment_acquirer import ValidationError
+from odoo.addons.payment_redsys import const
+from odoo.addons.payment_redsys import metrics as redsys_metrics
+from odoo.addons.payment_redsys import profiler as redsys_profiler
+from odoo.addons.payment_redsys import sis as redsys_sis
+from odoo.addons.payment_redsys import utils as redsys_utils
 
 _logger = logging.getLogger(__name__)
 
+_ORDER_SEQUENCE = "payment_redsys_order_seq"
+# Order numbers reserved at once by a worker
+_ORDER_BLOCK_SIZE = 100
+
 
 class TxRedsys(models.Model):
     _inherit = "payment.transaction"
 
     redsys_txnid = fields.Char("Transaction ID")
+    redsys_order = fields.Char(
+        "Redsys Order",
+        readonly=True,
+        copy=False,
+        help="The order number (Ds_Order) sent to Redsys for this transaction",
+    )
+
+    redsys_response_code = fields.Integer(
+        "Redsys Response", readonly=True, index=True, help="The last Ds_Response received"
+    )
+    redsys_error_code = fields.Char(
+        "Redsys Error Code", readonly=True, index=True, help="The last SIS error code received"
+    )
+    redsys_retryable = fields.Boolean(
+        "Redsys Retryable",
+        readonly=True,
+        index=True,
+        help="Whether the last answer of Redsys may succeed if the charge is attempted again",
+    )
+    redsys_reason = fields.Char("Redsys Reason", readonly=True)
+    redsys_merchant_parameters = fields.Text(
+        "Redsys Merchant Parameters",
+        readonly=True,
+        copy=False,
+        help="The Ds_MerchantParameters of the redirect form, signed in advance",
+    )
+    redsys_signature = fields.Char("Redsys Signature", readonly=True, copy=False)
+    redsys_reconciliation_state = fields.Selection(
+        [("matched", "Matched"), ("amount_mismatch", "Amount Mismatch")],
+        "Redsys Reconciliation",
+        readonly=True,
+        copy=False,
+        index=True,
+        help="The result of the last import of a Redsys operations or settlement file",
+    )
+    redsys_settled_amount = fields.Float(
+        "Redsys Settled Amount", readonly=True, copy=False
+    )
+    redsys_settlement_date = fields.Date("Redsys Settlement Date", readonly=True, copy=False)
+    redsys_last_query = fields.Datetime(
+        "Redsys Last Status Query",
+        readonly=True,
+        copy=False,
+        help="When Redsys was last asked for the status of this transaction",
+    )
+    redsys_sent_date = fields.Datetime(
+        "Redsys Sent Date",
+        readonly=True,
+        copy=False,
+        help="When the customer was last sent to the payment form of Redsys",
+    )
+
+    # Fields the signed redirect form depends on
+    _redsys_form_fields = {"reference", "amount", "currency_id", "partner_id", "acquirer_id"}
+
+    # Also the index of the lookups of the notifications by order number
+    _sql_constraints = [
+        (
+            "redsys_order_unique",
+            "UNIQUE(redsys_order)",
+            "The Redsys order number must be unique!",
+        ),
+    ]
+
+    def init(self):
+        super().init()
+        self._redsys_create_order_sequence()
+        # The status query cron scans the open transactions by creation date
+        create_index(
+            self._cr,
+            "payment_transaction_redsys_state_create_date_index",
+            self._table,
+            ["state", "create_date"],
+        )
+
+    @api.model
+    def _redsys_create_order_sequence(self):
+        """ Create the sequence of the Redsys order numbers, starting after the numeric order
+        numbers already sent. Each value reserves a block of `increment` numbers.
+        """
+        self.env.cr.execute("SELECT 1 FROM pg_class WHERE relname = %s", [_ORDER_SEQUENCE])
+        if self.env.cr.fetchone():
+            return
+        self.env.cr.execute("""
+            SELECT MAX(redsys_order::bigint)
+              FROM payment_transaction
+             WHERE redsys_order ~ '^[0-9]{12}$'
+        """)
+        start = (self.env.cr.fetchone()[0] or 0) + 1
+        self.env.cr.execute(
+            "CREATE SEQUENCE %s INCREMENT BY %%s START WITH %%s" % _ORDER_SEQUENCE,
+            [_ORDER_BLOCK_SIZE, start],
+        )
+
+    @api.model
+    def _redsys_reserve_order_block(self):
+        self.env.cr.execute("""
+            SELECT nextval(%s), seqincrement
+              FROM pg_sequence
+             WHERE seqrelid = %s::regclass
+        """, [_ORDER_SEQUENCE, _ORDER_SEQUENCE])
+        return self.env.cr.fetchone()
+
+    @api.model
+    def _redsys_next_order(self):
+        """ Return a new Redsys order number, from the block of numbers of this worker. """
+        return redsys_utils.format_order(
+            redsys_utils.order_numbers.next(
+                self.env.cr.dbname, self._redsys_reserve_order_block
+            )
+        )
+
+    @api.model_create_multi
+    def create(self, vals_list):
+        redsys_acquirers = set(
+            self.env["payment.acquirer"].sudo().browse(
+                {vals["acquirer_id"] for vals in vals_list if vals.get("acquirer_id")}
+            ).filtered(lambda a: a.provider == 'redsys').ids
+        )
+        # Refunds are sent with the order number of the refunded transaction
+        vals_list = [
+            dict(vals, redsys_order=self._redsys_next_order())
+            if vals.get("acquirer_id") in redsys_acquirers and not vals.get("redsys_order")
+            and vals.get("operation") != "refund"
+            else vals
+            for vals in vals_list
+        ]
+        txs = super().create(vals_list)
+        txs._redsys_presign()
+        return txs
+
+    def write(self, vals):
+        if self._redsys_form_fields.intersection(vals) and "redsys_signature" not in vals:
+            vals = dict(vals, redsys_merchant_parameters=False, redsys_signature=False)
+        return super().write(vals)
+
+    def _redsys_presign(self):
+        """ Build and sign in advance the redirect forms of the transactions in `self`.
+
+        The product descriptions of the transactions of an acquirer are all fetched at once,
+        and rendering the form then only reads the stored values.
+        """
+        txs = self.filtered(
+            lambda t: t.provider == 'redsys' and t.operation == 'online_redirect'
+            and t.state == 'draft'
+        )
+        for acquirer in txs.acquirer_id:
+            acquirer_txs = txs.filtered(lambda t: t.acquirer_id == acquirer)
+            descriptions = acquirer._get_redsys_product_descriptions(
+                acquirer_txs.mapped('reference')
+            )
+            for tx in acquirer_txs:
+                values = acquirer.redsys_form_generate_values({
+                    'reference': tx.reference,
+                    'redsys_order': tx.redsys_order,
+                    'amount': tx.amount,
+                    'billing_partner': tx.partner_id,
+                    'redsys_product_description': descriptions.get(tx.reference),
+                })
+                tx.write({
+                    'redsys_merchant_parameters': values['Ds_MerchantParameters'],
+                    'redsys_signature': values['Ds_Signature'],
+                })
 
     def _get_specific_processing_values(self, processing_values):
         """ Return a dict of acquirer-specific values used to process the transaction.
@@ -50,7 +226,23 @@ class TxRedsys(models.Model):
         if self.provider != 'redsys':
             return res
 
-        return self.acquirer_id.redsys_form_generate_values(processing_values)
+        # Only the transactions sent to Redsys are worth asking it about
+        self.redsys_sent_date = fields.Datetime.now()
+        if not self.redsys_signature:
+            self._redsys_presign()
+        if not self.redsys_signature:
+            # Not a redirect payment, e.g. a validation
+            return self.acquirer_id.redsys_form_generate_values(
+                dict(processing_values, redsys_order=self.redsys_order)
+            )
+        config = self.acquirer_id._get_redsys_config()
+        return {
+            'api_url': config.form_url,
+            'return_url': processing_values.get('return_url'),
+            'Ds_SignatureVersion': config.signature_version,
+            'Ds_MerchantParameters': self.redsys_merchant_parameters,
+            'Ds_Signature': self.redsys_signature,
+        }
 
     def _send_payment_request(self):
         """ Override of payment to send a payment request to Redsys.
@@ -67,30 +259,694 @@ class TxRedsys(models.Model):
         if not self.token_id:
             raise UserError(_("Redsys: " + _("The transaction is not linked to a token.")))
 
+        response = self.acquirer_id._redsys_make_request(self._redsys_prepare_s2s_values())
+        if response.get('errorCode', False):
+            self._redsys_handle_charge_failure(response['errorCode'])
+            return
+
+        self._handle_feedback_data('redsys', response)
+
+    def _redsys_prepare_s2s_values(self):
+        """ Return the signed values of a token (MIT) charge for the REST endpoint. """
+        self.ensure_one()
+        order = self.redsys_order or self.acquirer_id._get_redsys_order(self.reference)
         tx_values = {
             'token_ref': self.token_id.acquirer_ref,
             'txnid': self.token_id.txnid,
             'reference': self.reference,
+            'redsys_order': order,
             'amount': self.amount
         }
-
         merchant_parameters = self.acquirer_id._prepare_merchant_parameters_recurring(tx_values)
-        redsys_values = {
-            "Ds_SignatureVersion": str(self.acquirer_id.redsys_signature_version),
+        config = self.acquirer_id._get_redsys_config()
+        return {
+            "Ds_SignatureVersion": config.signature_version,
             "Ds_MerchantParameters": merchant_parameters,
             "Ds_Signature": self.acquirer_id.sign_parameters(
-                self.acquirer_id.redsys_secret_key, merchant_parameters
+                config.secret_key,
+                merchant_parameters,
+                order=order,
             ),
         }
 
-        url = self.acquirer_id._get_redsys_url_s2s()
-        response = requests.post(url=url, data=redsys_values)
-        response = json.loads(response.content.decode('utf8'))
-        if response.get('errorCode', False):
-            _logger.debug("======= ERROR FROM REDSYS: =====%r", response.get('errorCode', False))
+    def _redsys_send_payment_requests_batch(self, concurrency=None, chunk_size=None,
+                                            auto_commit=False):
+        """ Charge the token transactions in `self` concurrently.
+
+        The transactions are charged one chunk at a time: the payloads and signatures of the
+        chunk are built, only the HTTP calls are dispatched over a bounded thread pool, as the
+        ORM cannot be used from other threads, then the answers are applied, committing if
+        `auto_commit` is set. A worker killed midway thus only loses the answers of the chunk
+        in flight, never those of charges already made.
+
+        :param int concurrency: The maximum number of simultaneous calls to Redsys
+        :param int chunk_size: The number of charges sent and applied together
+        :param bool auto_commit: Whether to commit after each chunk
+        :return: The statistics of the run, see `utils.summarize_run`
+        :rtype: dict
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        concurrency = concurrency or int(get_param("payment_redsys.batch_concurrency", 8))
+        chunk_size = chunk_size or int(get_param("payment_redsys.batch_chunk_size", 100))
+        start = time.perf_counter()
+        failures = []
+        txs = self.filtered(lambda t: t.provider == 'redsys' and t.token_id)
+        for tx in self - txs:
+            failures.append((tx.reference, "not a Redsys token transaction"))
+
+        endpoints = {}
+        latencies = []
+        done = 0
+        with ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+            for chunk in split_every(chunk_size, txs):
+                # Committed drafts may be charged by another worker meanwhile
+                chunk = self.browse([tx.id for tx in chunk])
+                locked = chunk._redsys_lock_drafts()
+                for tx in chunk - locked:
+                    failures.append((tx.reference, "not a draft or being charged elsewhere"))
+                calls = []
+                for tx in locked:
+                    acquirer = tx.acquirer_id
+                    if acquirer not in endpoints:
+                        endpoints[acquirer] = (
+                            acquirer._get_redsys_session(),
+                            acquirer._get_redsys_url_s2s(),
+                            acquirer._get_redsys_request_timeout(),
+                        )
+                    calls.append(endpoints[acquirer] + (tx._redsys_prepare_s2s_values(),))
+                results = executor.map(lambda call: redsys_utils.timed_post(*call), calls)
+                items = []
+                for tx, (response, error, elapsed) in zip(locked, results):
+                    latencies.append(elapsed)
+                    if error is not None:
+                        failures.append((tx.reference, str(error)))
+                        tx._redsys_handle_charge_failure(error=error)
+                    elif response.get('errorCode'):
+                        failures.append((tx.reference, response['errorCode']))
+                        tx._redsys_handle_charge_failure(response['errorCode'])
+                    else:
+                        items.append((tx, response))
+                chunk_failures = self._redsys_process_feedback_batch(
+                    items, execute_callback=True, auto_commit=auto_commit
+                )
+                failures.extend((tx.reference, message) for tx, message in chunk_failures)
+                done += len(items) - len(chunk_failures)
+
+        stats = redsys_utils.summarize_run(
+            latencies, time.perf_counter() - start, done, failures
+        )
+        _logger.info(
+            "Redsys: batch charge of %s transactions: %s done, %s failed in %.2fs "
+            "(%.1f tx/s, p50 %.3fs, p95 %.3fs, p99 %.3fs)",
+            stats["count"], stats["done"], stats["failed"], stats["elapsed"],
+            stats["throughput"], stats["latency"]["p50"], stats["latency"]["p95"],
+            stats["latency"]["p99"],
+        )
+        return stats
+
+    def _redsys_lock_drafts(self):
+        """ Lock the draft transactions in `self` until the next commit and return them.
+
+        Those locked by another worker are skipped, as are those no longer in draft, so that
+        a charge in flight or already answered is never sent a second time.
+        """
+        if not self:
+            return self
+        self.flush(['state'])
+        self.env.cr.execute("""
+            SELECT id FROM payment_transaction
+             WHERE id IN %s AND state = 'draft'
+               FOR UPDATE SKIP LOCKED
+        """, [tuple(self.ids)])
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _redsys_handle_charge_failure(self, error_code=False, reason=None, error=None):
+        """ Record why the token charges in `self` got no answer and retry the transient ones.
+
+        A charge refused by the SIS, or that could not even reach it, leaves the draft state
+        in error, so that `_cron_redsys_charge_tokens` does not send it again next to its
+        retry. One that may have reached Redsys, e.g. a read timeout, cannot be replayed
+        without risking a double charge: it is left pending for `_cron_redsys_query_status`
+        to look up its order before anything else is done.
+
+        :param str error_code: The errorCode answered by the SIS, if any
+        :param str reason: Why the charge failed, when there is no error code
+        :param Exception error: The transport error, when the SIS could not be reached
+        :return: None
+        """
+        lost = False
+        if error_code:
+            result = redsys_utils.classify_response(29999, error_code)
+            retryable, reason = result.retryable, result.reason
+        elif error is not None and not redsys_utils.is_connect_error(error):
+            retryable, lost = False, True
+            reason = _("No answer from Redsys, the charge may have been made: %s") % error
+        else:
+            retryable, reason = True, reason or error or _("Redsys could not be reached")
+        _logger.warning(
+            "Redsys: charge of %s failed (%s, %s): %s",
+            ", ".join(self.mapped('reference')), error_code or "transport",
+            "unknown outcome" if lost else "transient" if retryable else "permanent",
+            reason,
+        )
+        self.write({
+            'redsys_error_code': error_code,
+            'redsys_retryable': retryable,
+            'redsys_reason': str(reason),
+        })
+        if lost:
+            self._set_pending(state_message=str(reason))
             return
+        self._set_error(str(reason))
+        self._redsys_schedule_retries()
 
-        self._handle_feedback_data('redsys', response)
+    def _redsys_schedule_retries(self):
+        """ Queue a new attempt of the failed token (MIT) charges in `self` that may succeed
+        later. Charges made with the customer present are never retried.
+        """
+        Retry = self.env["payment.redsys.retry"].sudo()
+        for tx in self.filtered(lambda t: (
+            t.provider == 'redsys' and t.operation == 'offline' and t.token_id
+            and t.redsys_retryable
+        )):
+            Retry._schedule(tx, tx.redsys_reason)
+
+    def _redsys_create_retry_transaction(self):
+        """ Return a copy of the failed charge in `self` to be sent again, with a reference
+        (hence an order number) of its own as Redsys refuses repeated order numbers.
+        """
+        self.ensure_one()
+        return self.create({
+            'acquirer_id': self.acquirer_id.id,
+            'reference': self._compute_reference(self.provider, prefix=self.reference),
+            'amount': self.amount,
+            'currency_id': self.currency_id.id,
+            'partner_id': self.partner_id.id,
+            'token_id': self.token_id.id,
+            'operation': 'offline',
+            'sale_order_ids': [(6, 0, self.sale_order_ids.ids)],
+            'invoice_ids': [(6, 0, self.invoice_ids.ids)],
+            'callback_model_id': self.callback_model_id.id,
+            'callback_res_id': self.callback_res_id,
+            'callback_method': self.callback_method,
+            'callback_hash': self.callback_hash,
+        })
+
+    @api.model
+    def _cron_redsys_charge_tokens(self, limit=None):
+        """ Charge the pending token (MIT) transactions created by recurring flows. """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        txs = self.search([
+            ('provider', '=', 'redsys'),
+            ('operation', '=', 'offline'),
+            ('state', '=', 'draft'),
+            ('token_id', '!=', False),
+        ], limit=limit or int(get_param("payment_redsys.batch_limit", 500)))
+        return txs._redsys_send_payment_requests_batch(auto_commit=True)
+
+    @api.model
+    def _redsys_get_stale_domain(self):
+        """ Return the domain of the open Redsys transactions whose answer may have been lost:
+        pending, or sent to the payment form, for a while and not queried recently. The drafts
+        whose customer never reached the payment form, token charges not sent yet included,
+        are left out, Redsys knows nothing about them.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        now = fields.Datetime.now()
+        delay = int(get_param("payment_redsys.status_query_delay", 30))
+        interval = int(get_param("payment_redsys.status_query_interval", 60))
+        max_age = int(get_param("payment_redsys.status_query_max_age", 7))
+        acquirers = self.env["payment.acquirer"].sudo().search([("provider", "=", "redsys")])
+        return [
+            ("state", "in", ("draft", "pending")),
+            ("create_date", ">=", now - timedelta(days=max_age)),
+            ("create_date", "<=", now - timedelta(minutes=delay)),
+            ("acquirer_id", "in", acquirers.ids),
+            ("redsys_order", "!=", False),
+            "|", ("state", "=", "pending"), ("redsys_sent_date", "!=", False),
+            "|", ("redsys_last_query", "=", False),
+            ("redsys_last_query", "<=", now - timedelta(minutes=interval)),
+        ]
+
+    def _redsys_prepare_query_values(self):
+        """ Return the signed request to the consultation web service of Redsys for the
+        status of the transaction.
+        """
+        self.ensure_one()
+        return self.acquirer_id._prepare_redsys_consultation(self.redsys_order)
+
+    def _redsys_query_status_batch(self, concurrency=None, rate=None, chunk_size=None,
+                                   auto_commit=False):
+        """ Ask Redsys for the status of the transactions in `self` and apply the answers.
+
+        The queries to the consultation web service are signed up front and sent over a
+        bounded thread pool, at most `rate` per second, then the answers that change the
+        state of their transaction are applied in chunks as in
+        `_redsys_send_payment_requests_batch`.
+
+        :param int concurrency: The maximum number of simultaneous queries
+        :param float rate: The maximum number of queries started per second, 0 for unlimited
+        :param int chunk_size: The number of answers applied in one batch of writes
+        :param bool auto_commit: Whether to commit after each chunk
+        :return: The statistics of the run, see `utils.summarize_run`
+        :rtype: dict
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        concurrency = concurrency or int(get_param("payment_redsys.status_query_concurrency", 8))
+        if rate is None:
+            rate = float(get_param("payment_redsys.status_query_rate", 20))
+        chunk_size = chunk_size or int(get_param("payment_redsys.batch_chunk_size", 100))
+        start = time.perf_counter()
+        failures = []
+        txs = self.filtered(lambda t: t.provider == 'redsys' and t.redsys_order)
+
+        endpoints = {}
+        calls = []
+        for tx in txs:
+            acquirer = tx.acquirer_id
+            if acquirer not in endpoints:
+                endpoints[acquirer] = (
+                    acquirer._get_redsys_session(),
+                    acquirer._get_redsys_url_query(),
+                    acquirer._get_redsys_request_timeout(),
+                )
+            session, url, timeout = endpoints[acquirer]
+            calls.append((
+                session, url, tx._redsys_prepare_query_values(), timeout,
+                redsys_sis.CONSULTATION_HEADERS, redsys_sis.parse_consultation_response,
+            ))
+
+        results = redsys_utils.post_many(calls, concurrency=concurrency, rate=rate)
+
+        latencies = []
+        done = unchanged = 0
+        for chunk in split_every(chunk_size, list(zip(txs, results))):
+            self.browse([tx.id for tx, _result in chunk]).write({
+                'redsys_last_query': fields.Datetime.now(),
+            })
+            items = []
+            for tx, (response, error, elapsed) in chunk:
+                latencies.append(elapsed)
+                if error is not None:
+                    failures.append((tx.reference, str(error)))
+                    continue
+                if response.get('errorCode'):
+                    failures.append((tx.reference, response['errorCode']))
+                    if (response['errorCode'] == "XML0024" and tx.operation == 'offline'
+                            and tx.token_id and tx.state == 'pending'):
+                        # The charge whose answer was lost never reached Redsys
+                        tx._redsys_handle_charge_failure(response['errorCode'])
+                    continue
+                if not response.get("Ds_Response"):
+                    # Still in progress, e.g. the customer is on the payment page
+                    unchanged += 1
+                    continue
+                try:
+                    state = tx._redsys_get_feedback_state(response)[0]
+                except Exception as error:
+                    failures.append((tx.reference, str(error)))
+                    continue
+                if response.get("Ds_Order") != tx.redsys_order:
+                    failures.append(
+                        (tx.reference, "answer for order %s" % response.get("Ds_Order"))
+                    )
+                elif state is None or state == tx.state:
+                    unchanged += 1
+                else:
+                    items.append((tx, redsys_utils.consultation_feedback(response)))
+            chunk_failures = self._redsys_process_feedback_batch(
+                items, execute_callback=True, auto_commit=auto_commit
+            )
+            failures.extend((tx.reference, message) for tx, message in chunk_failures)
+            done += len(items) - len(chunk_failures)
+
+        stats = redsys_utils.summarize_run(
+            latencies, time.perf_counter() - start, done, failures
+        )
+        stats["unchanged"] = unchanged
+        _logger.info(
+            "Redsys: status query of %s transactions: %s updated, %s unchanged, %s failed "
+            "in %.2fs (%.1f tx/s, p50 %.3fs, p95 %.3fs)",
+            len(txs), stats["done"], unchanged, stats["failed"], stats["elapsed"],
+            stats["throughput"], stats["latency"]["p50"], stats["latency"]["p95"],
+        )
+        return stats
+
+    @api.model
+    def _cron_redsys_query_status(self, limit=None):
+        """ Recover the open transactions whose answer from Redsys never arrived. """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        txs = self.search(
+            self._redsys_get_stale_domain(),
+            limit=limit or int(get_param("payment_redsys.status_query_limit", 5000)),
+            order="create_date",
+        )
+        return txs._redsys_query_status_batch(auto_commit=True)
+
+    @api.model
+    def _redsys_get_tx_by_order(self, redsys_order):
+        """ Resolve the transactions, acquirers and sale orders of a Redsys order number.
+
+        Everything is fetched in a single query on the indexed `redsys_order` column, so the
+        cost of a notification does not grow with the size of the transaction table.
+
+        :param str redsys_order: The Ds_Order received from Redsys
+        :return: The transactions, their acquirers and their linked sale orders
+        :rtype: tuple
+        """
+        self.env["payment.transaction"].flush(["redsys_order", "acquirer_id", "sale_order_ids"])
+        self.env.cr.execute("""
+            SELECT tx.id, tx.acquirer_id, rel.sale_order_id
+              FROM payment_transaction tx
+         LEFT JOIN sale_order_transaction_rel rel ON rel.transaction_id = tx.id
+             WHERE tx.redsys_order = %s
+        """, [redsys_order])
+        tx_ids, acquirer_ids, sale_order_ids = set(), set(), set()
+        for tx_id, acquirer_id, sale_order_id in self.env.cr.fetchall():
+            tx_ids.add(tx_id)
+            acquirer_ids.add(acquirer_id)
+            if sale_order_id:
+                sale_order_ids.add(sale_order_id)
+        return (
+            self.browse(sorted(tx_ids)),
+            self.env["payment.acquirer"].browse(sorted(acquirer_ids)),
+            self.env["sale.order"].browse(sorted(sale_order_ids)),
+        )
+
+    # --------------------------------------------------
+    # REFUNDS AND CAPTURES
+    # --------------------------------------------------
+
+    def _redsys_prepare_operation_values(self):
+        """ Return the signed values of the refund transaction, or of the capture of the
+        authorised transaction, in `self` for the REST endpoint.
+        """
+        self.ensure_one()
+        if self.operation == 'refund':
+            source = self.source_transaction_id
+            transaction_type = const.TRANSACTION_REFUND
+            # What was charged, at most, the partial payment percentage being deducted
+            amount = min(abs(self.amount), redsys_utils.expected_amount(
+                source.amount, self.acquirer_id.redsys_percent_partial
+            ))
+        else:
+            source = self
+            transaction_type = const.TRANSACTION_CAPTURE
+            amount = redsys_utils.expected_amount(
+                self.amount, self.acquirer_id.redsys_percent_partial
+            )
+        if not source.redsys_order:
+            # Its order number was shared with another transaction before 15.0.1.1.0
+            raise UserError(_(
+                "Redsys: transaction %s has no order number, it must be handled from the "
+                "Redsys administration module.", source.reference
+            ))
+        merchant_parameters = self.acquirer_id._prepare_merchant_parameters_operation(
+            source.redsys_order, amount, transaction_type
+        )
+        config = self.acquirer_id._get_redsys_config()
+        return {
+            "Ds_SignatureVersion": config.signature_version,
+            "Ds_MerchantParameters": merchant_parameters,
+            "Ds_Signature": self.acquirer_id.sign_parameters(
+                config.secret_key, merchant_parameters, order=source.redsys_order
+            ),
+        }
+
+    def _redsys_handle_operation_failure(self, error_code=False, reason=None):
+        """ Record why the refunds or captures in `self` were not done. The refunds are put
+        in error, the captured transactions stay authorised.
+        """
+        if error_code:
+            reason = redsys_utils.classify_response(29999, error_code).reason
+        reason = reason or _("Redsys could not be reached")
+        _logger.warning(
+            "Redsys: %s failed (%s): %s",
+            ", ".join(self.mapped('reference')), error_code or "transport", reason,
+        )
+        self.write({
+            'redsys_error_code': error_code,
+            'redsys_retryable': False,
+            'redsys_reason': reason,
+        })
+        self.filtered(lambda t: t.operation == 'refund')._set_error(
+            "Redsys: %s (%s)" % (reason, error_code or "transport")
+        )
+
+    def _send_refund_request(self, amount_to_refund=None, create_refund_transaction=True):
+        """ Override of payment to send a refund request to Redsys.
+
+        Note: self.ensure_one()
+
+        :param float amount_to_refund: The amount to refund
+        :param bool create_refund_transaction: Whether a refund transaction should be created
+        :return: The refund transaction
+        :rtype: recordset of `payment.transaction`
+        """
+        refund_tx = super()._send_refund_request(
+            amount_to_refund=amount_to_refund,
+            create_refund_transaction=create_refund_transaction,
+        )
+        if self.provider != 'redsys' or not refund_tx:
+            return refund_tx
+        refund_tx._redsys_send_operation_request()
+        return refund_tx
+
+    def _send_capture_request(self):
+        """ Override of payment to capture an authorised (pre-authorised) Redsys payment.
+
+        Note: self.ensure_one()
+
+        :return: None
+        """
+        super()._send_capture_request()
+        if self.provider != 'redsys':
+            return
+        self._redsys_send_operation_request()
+
+    def _redsys_send_operation_request(self):
+        try:
+            response = self.acquirer_id._redsys_make_request(
+                self._redsys_prepare_operation_values()
+            )
+        except ValidationError as error:
+            self._redsys_handle_operation_failure(reason=str(error))
+            return
+        if response.get('errorCode'):
+            self._redsys_handle_operation_failure(response['errorCode'])
+            return
+        self._process_feedback_data(response)
+
+    def _redsys_send_operation_requests_batch(self, concurrency=None, rate=None,
+                                              chunk_size=None, auto_commit=False):
+        """ Send the refund transactions, or the captures of the authorised transactions, in
+        `self` concurrently.
+
+        As in `_redsys_send_payment_requests_batch`, the requests are signed up front and
+        sent over a bounded thread pool through the pooled sessions, at most `rate` per
+        second, and the answers are applied in chunks.
+
+        :param int concurrency: The maximum number of simultaneous calls to Redsys
+        :param float rate: The maximum number of calls started per second, 0 for unlimited
+        :param int chunk_size: The number of answers applied in one batch of writes
+        :param bool auto_commit: Whether to commit after each chunk
+        :return: The statistics of the run, see `utils.summarize_run`, with the resulting
+                 state of each transaction by reference in `results`
+        :rtype: dict
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        concurrency = concurrency or int(get_param("payment_redsys.batch_concurrency", 8))
+        if rate is None:
+            rate = float(get_param("payment_redsys.batch_rate", 0))
+        chunk_size = chunk_size or int(get_param("payment_redsys.batch_chunk_size", 100))
+        start = time.perf_counter()
+        failures = []
+        txs = self.filtered(lambda t: t.provider == 'redsys' and (
+            t.operation == 'refund' and t.state == 'draft' or t.state == 'authorized'
+        ))
+        for tx in self - txs:
+            failures.append((tx.reference, "not a Redsys refund or authorised transaction"))
+
+        endpoints = {}
+        calls = []
+        for tx in txs:
+            acquirer = tx.acquirer_id
+            if acquirer not in endpoints:
+                endpoints[acquirer] = (
+                    acquirer._get_redsys_session(),
+                    acquirer._get_redsys_url_s2s(),
+                    acquirer._get_redsys_request_timeout(),
+                )
+            session, url, timeout = endpoints[acquirer]
+            calls.append((session, url, tx._redsys_prepare_operation_values(), timeout))
+
+        results = redsys_utils.post_many(calls, concurrency=concurrency, rate=rate)
+
+        latencies = []
+        done = 0
+        for chunk in split_every(chunk_size, list(zip(txs, results))):
+            items = []
+            for tx, (response, error, elapsed) in chunk:
+                latencies.append(elapsed)
+                if error is not None:
+                    failures.append((tx.reference, str(error)))
+                    tx._redsys_handle_operation_failure(reason=str(error))
+                elif response.get('errorCode'):
+                    failures.append((tx.reference, response['errorCode']))
+                    tx._redsys_handle_operation_failure(response['errorCode'])
+                else:
+                    items.append((tx, response))
+            chunk_failures = self._redsys_process_feedback_batch(
+                items, auto_commit=auto_commit
+            )
+            failures.extend((tx.reference, message) for tx, message in chunk_failures)
+            done += len(items) - len(chunk_failures)
+
+        stats = redsys_utils.summarize_run(
+            latencies, time.perf_counter() - start, done, failures
+        )
+        stats["results"] = {tx.reference: tx.state for tx in txs}
+        _logger.info(
+            "Redsys: batch of %s refunds and captures: %s answered, %s failed in %.2fs "
+            "(%.1f tx/s, p50 %.3fs, p95 %.3fs, p99 %.3fs)",
+            stats["count"], stats["done"], stats["failed"], stats["elapsed"],
+            stats["throughput"], stats["latency"]["p50"], stats["latency"]["p95"],
+            stats["latency"]["p99"],
+        )
+        return stats
+
+    def _redsys_refund_batch(self, amounts=None, **kwargs):
+        """ Refund the done Redsys transactions in `self` concurrently, the others are left out.
+
+        :param dict amounts: The amount to refund by transaction id, the whole amount for the
+                             transactions not in it
+        :return: The statistics of `_redsys_send_operation_requests_batch`, the results
+                 being keyed by the references of the refund transactions
+        :rtype: dict
+        """
+        amounts = amounts or {}
+        refunds = self.browse()
+        for tx in self.filtered(lambda t: t.provider == 'redsys' and t.state == 'done'):
+            refund_tx = tx._create_refund_transaction(amount_to_refund=amounts.get(tx.id))
+            refund_tx._log_sent_message()
+            refunds |= refund_tx
+        return refunds._redsys_send_operation_requests_batch(**kwargs)
+
+    # --------------------------------------------------
+    # RECONCILIATION
+    # --------------------------------------------------
+
+    @api.model
+    def _redsys_get_reconciliation_index(self):
+        """ Map the Redsys order number of every Redsys transaction to its id and to the
+        amount Redsys should have charged, in a single query.
+
+        When several transactions share an order number, the done one, then the latest,
+        wins.
+        """
+        self.flush(["redsys_order", "amount", "state", "acquirer_id"])
+        self.env["payment.acquirer"].flush(["provider", "redsys_percent_partial"])
+        self.env.cr.execute("""
+            SELECT tx.redsys_order, tx.id, tx.amount, acq.redsys_percent_partial
+              FROM payment_transaction tx
+              JOIN payment_acquirer acq ON acq.id = tx.acquirer_id
+             WHERE acq.provider = 'redsys' AND tx.redsys_order IS NOT NULL
+          ORDER BY tx.state = 'done', tx.id
+        """)
+        index = {}
+        while True:
+            rows = self.env.cr.fetchmany(10000)
+            if not rows:
+                break
+            for redsys_order, tx_id, amount, percent_partial in rows:
+                index[redsys_order] = (
+                    tx_id, redsys_utils.expected_amount(amount, percent_partial or 0.0)
+                )
+        return index
+
+    @api.model
+    def _redsys_import_reconciliation(self, file, chunk_size=None, auto_commit=False):
+        """ Reconcile the Redsys transactions with an operations or settlement export of the
+        Redsys administration module.
+
+        The file is read line by line and its rows matched by order number against an index
+        of the transactions built beforehand, so memory does not grow with the size of the
+        file. The amounts are checked as in `_redsys_form_get_invalid_parameters`, and the
+        results written with one query per chunk of rows.
+
+        :param file: The path of the CSV file, or a binary file object
+        :param int chunk_size: The number of rows written at once
+        :param bool auto_commit: Whether to commit after each chunk
+        :return: The number of rows read, matched, with a different amount, unknown and
+                 unreadable
+        :rtype: dict
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        chunk_size = chunk_size or int(get_param("payment_redsys.reconciliation_chunk_size", 5000))
+        encoding = get_param("payment_redsys.reconciliation_encoding", "utf-8-sig")
+        start = time.perf_counter()
+        index = self._redsys_get_reconciliation_index()
+        stats = dict.fromkeys(["rows", "matched", "amount_mismatch", "unknown", "invalid"], 0)
+        fileobj = open(file, "rb") if isinstance(file, str) else file
+        try:
+            for chunk in redsys_utils.read_export(fileobj, chunk_size, encoding=encoding):
+                values = []
+                for line, redsys_order, amount, date in chunk:
+                    stats["rows"] += 1
+                    if amount is None:
+                        stats["invalid"] += 1
+                        _logger.warning("Redsys: unreadable amount on line %s", line)
+                        continue
+                    match = index.get(redsys_order)
+                    if match is None and redsys_order.isdigit():
+                        # Spreadsheets drop the leading zeros of the order numbers
+                        match = index.get(redsys_utils.format_order(int(redsys_order)))
+                    if match is None:
+                        stats["unknown"] += 1
+                        _logger.debug("Redsys: unknown order %s on line %s", redsys_order, line)
+                        continue
+                    tx_id, expected = match
+                    state = (
+                        "matched" if float_compare(amount, expected, 2) == 0
+                        else "amount_mismatch"
+                    )
+                    stats[state] += 1
+                    values.append((tx_id, state, amount, date))
+                self._redsys_write_reconciliation(values)
+                if auto_commit:
+                    self.env.cr.commit()
+        finally:
+            if fileobj is not file:
+                fileobj.close()
+        stats["elapsed"] = time.perf_counter() - start
+        _logger.info("Redsys: reconciliation import done, %s", stats)
+        return stats
+
+    @api.model
+    def _redsys_write_reconciliation(self, values):
+        """ Write the `(id, state, amount, date)` results of a chunk in one query. """
+        if not values:
+            return
+        execute_values(self.env.cr._obj, """
+            UPDATE payment_transaction tx
+               SET redsys_reconciliation_state = v.state,
+                   redsys_settled_amount = v.amount,
+                   redsys_settlement_date = v.date::date,
+                   write_uid = %s,
+                   write_date = (now() at time zone 'UTC')
+              FROM (VALUES %%s) AS v(id, state, amount, date)
+             WHERE tx.id = v.id
+        """ % self.env.uid, values)
+        self.invalidate_cache(
+            [
+                "redsys_reconciliation_state",
+                "redsys_settled_amount",
+                "redsys_settlement_date",
+                "write_uid",
+                "write_date",
+            ],
+            [value[0] for value in values],
+        )
 
     @staticmethod
     def merchant_params_json2dict(data):
@@ -105,11 +961,11 @@ class TxRedsys(models.Model):
     def _redsys_form_get_tx_from_data(self, data):
         """ Given a data dict coming from redsys, verify it and
         find the related transaction record. """
-        parameters = data.get("Ds_MerchantParameters", "")
-        parameters_dic = json.loads(base64.b64decode(parameters).decode())
-        reference = urllib.parse.unquote(parameters_dic.get("Ds_Order", ""))
-        pay_id = parameters_dic.get("Ds_AuthorisationCode")
-        shasign = data.get("Ds_Signature", "").replace("_", "/").replace("-", "+")
+        start = time.perf_counter()
+        notification = redsys_utils.parse_notification(data)
+        reference = notification.order
+        pay_id = notification.authorisation_code
+        shasign = notification.signature
         test_env = config["test_enable"]
         if not reference or not pay_id or not shasign:
             error_msg = (
@@ -118,10 +974,14 @@ class TxRedsys(models.Model):
             )
             if not test_env:
                 _logger.error(error_msg)
+                redsys_metrics.tx_lookups.observe(
+                    time.perf_counter() - start, result="missing_data"
+                )
                 raise ValidationError(error_msg)
             # For tests
             http.OpenERPSession.tx_error = True
-        tx = self.search([("reference", "=", reference)])
+        with redsys_profiler.span("lookup"):
+            tx, acquirer, _sale_orders = self._redsys_get_tx_by_order(reference)
         if not tx or len(tx) > 1:
             error_msg = "Redsys: received data for reference %s" % (reference)
             if not tx:
@@ -130,27 +990,38 @@ class TxRedsys(models.Model):
                 error_msg += "; multiple order found"
             if not test_env:
                 _logger.error(error_msg)
+                redsys_metrics.tx_lookups.observe(
+                    time.perf_counter() - start, result="not_found"
+                )
                 raise ValidationError(error_msg)
             # For tests
             http.OpenERPSession.tx_error = True
-        if tx and not test_env:
+        if tx and not test_env and not notification.verified:
             # verify shasign
-            shasign_check = tx.acquirer_id.sign_parameters(
-                tx.acquirer_id.redsys_secret_key, parameters
-            )
-            if shasign_check != shasign:
+            with redsys_profiler.span("signature"):
+                shasign_check = acquirer.sign_parameters(
+                    acquirer._get_redsys_config().secret_key,
+                    notification.raw,
+                    order=redsys_utils.get_order(notification.params),
+                )
+            if not redsys_utils.signatures_match(shasign_check, shasign):
                 error_msg = (
-                        "Redsys: invalid shasign, received %s, computed %s, "
-                        "for data %s" % (shasign, shasign_check, data)
+                        "Redsys: invalid shasign received for order %s, data %s"
+                        % (reference, redsys_utils.LazyRedacted(redsys_utils.raw_data(data)))
                 )
                 _logger.error(error_msg)
+                redsys_metrics.tx_lookups.observe(
+                    time.perf_counter() - start, result="invalid_signature"
+                )
                 raise ValidationError(error_msg)
+            notification.verified = True
+        redsys_metrics.tx_lookups.observe(time.perf_counter() - start, result="ok")
         return tx
 
     def _redsys_form_get_invalid_parameters(self, data):
         test_env = config["test_enable"]
         invalid_parameters = []
-        parameters_dic = self.merchant_params_json2dict(data)
+        parameters_dic = redsys_utils.parse_notification(data).params
         if (self.acquirer_reference and parameters_dic.get("Ds_Order")) != self.acquirer_reference:
             invalid_parameters.append(
                 (
@@ -162,8 +1033,9 @@ class TxRedsys(models.Model):
 
         # check what has been bought
         if self.acquirer_id.redsys_percent_partial > 0.0:
-            new_amount = self.amount - (self.amount * self.acquirer_id.redsys_percent_partial / 100)
-            self.amount = new_amount
+            self.amount = redsys_utils.expected_amount(
+                self.amount, self.acquirer_id.redsys_percent_partial
+            )
 
         if float_compare(float(parameters_dic.get("Ds_Amount", "0.0")) / 100, self.amount, 2) != 0:
             invalid_parameters.append(("Amount", parameters_dic.get("Ds_Amount"), "%.2f" % self.amount))
@@ -176,64 +1048,164 @@ class TxRedsys(models.Model):
 
     @api.model
     def _get_redsys_state(self, status_code):
-        if 0 <= status_code <= 100:
-            return "done"
-        elif status_code <= 203:
-            return "pending"
-        elif 912 <= status_code <= 9912:
-            return "cancel"
-        else:
-            return "error"
+        return redsys_utils.classify_response(status_code).state
 
-    def _process_feedback_data(self, data):
-        super()._process_feedback_data(data)
-        if self.provider != 'redsys':
-            return
-        params = self.merchant_params_json2dict(data)
+    def _redsys_get_feedback_state(self, params):
+        """ Return the state and the state message matching a Redsys answer.
+
+        :param dict params: The decoded Ds_MerchantParameters of the answer
+        :return: The target state, None to leave the transaction as it is, and its message
+        :rtype: tuple
+        """
         status_code = int(params.get("Ds_Response", "29999"))
         state = self._get_redsys_state(status_code)
-        vals = {
-            "state": state,
-            # "redsys_txnid": params.get("Ds_AuthorisationCode"),
-            # "date": fields.Datetime.now(),
-        }
-        state_message = ""
+        transaction_type = str(params.get("Ds_TransactionType", ""))
+        if transaction_type == const.TRANSACTION_REFUND and self.operation != 'refund':
+            # A refund notified on the order of the refunded payment, e.g. one made from the
+            # Redsys administration module, does not change the payment
+            return None, _("Refund notified: %s") % params.get("Ds_Response")
         if state == "done":
-            vals["state_message"] = _("Ok: %s") % params.get("Ds_Response")
-            order = self.env['sale.order'].search([('name', '=', params.get("Ds_Order").split('-')[0])])
-            # acquirer = self.env['payment.acquirer'].search([('provider', '=', 'redsys')])
-            # s2s_data = {
-            #     'token': params.get('Ds_Merchant_Identifier'),
-            #     'card': params.get('Ds_ExpiryDate'),
-            #     'acquirer_id': acquirer.id,
-            #     'partner_id': order.partner_id.id,
-            #     'txnid': params.get('Ds_Merchant_Cof_Txnid')
-            # }
-            # if not self.token_id:
-            #     token_id = self.acquirer_id.redsys_s2s_form_process(s2s_data)
-            #     if token_id:
-            #         self.token_id = token_id.id
-            self._set_done()
-            # self._finalize_post_processing()
-            # self._execute_callback()
-            self.env.cr.commit()
-        elif state == "pending":  # 'Payment error: code: %s.'
+            if transaction_type == const.TRANSACTION_PREAUTHORISATION:
+                return "authorized", _("Authorised: %s") % params.get("Ds_Response")
+            return state, _("Ok: %s") % params.get("Ds_Response")
+        if transaction_type == const.TRANSACTION_CAPTURE:
+            # A refused capture leaves the authorisation as it was
+            state = "authorized"
+        elif transaction_type == const.TRANSACTION_REFUND:
+            state = "error"
+        if state == "pending":  # 'Payment error: code: %s.'
             state_message = _("Error: %s (%s)")
-            self._set_pending()
         elif state == "cancel":  # 'Payment error: bank unavailable.'
             state_message = _("Bank Error: %s (%s)")
-            self._set_canceled()
         else:
             state_message = _("Redsys: feedback error %s (%s)")
-            self._set_error(state_message)
-        if state_message:
-            vals["state_message"] = state_message % (
-                params.get("Ds_Response"),
-                params.get("Ds_ErrorCode"),
-            )
+        return state, state_message % (params.get("Ds_Response"), params.get("Ds_ErrorCode"))
+
+    @api.model
+    def _redsys_get_feedback_values(self, params):
+        """ Return the classification of a Redsys answer to store on the transaction.
+
+        :param dict params: The decoded Ds_MerchantParameters of the answer
+        :return: The values of the `redsys_*` classification fields
+        :rtype: dict
+        """
+        status_code = int(params.get("Ds_Response", "29999"))
+        error_code = params.get("Ds_ErrorCode") or False
+        result = redsys_utils.classify_response(status_code, error_code)
+        return {
+            "redsys_response_code": status_code,
+            "redsys_error_code": error_code,
+            "redsys_retryable": result.retryable,
+            "redsys_reason": result.reason,
+        }
+
+    @api.model
+    def _redsys_set_states(self, transitions):
+        """ Apply many state transitions, with one write per group of identical values.
+
+        :param list transitions: (transaction, state, state message, values) quadruplets,
+                                 the values being the extra fields to write
+        :return: None
+        """
+        groups = {}
+        for tx, state, state_message, vals in transitions:
+            if state is None:
+                _logger.info("Redsys: %s left as it is: %s", tx.reference, state_message)
+                continue
+            key = (state, state_message, tuple(sorted(vals.items())))
+            groups[key] = groups.get(key, self.env["payment.transaction"]) | tx
+        for (state, state_message, vals), txs in groups.items():
+            if vals:
+                txs.write(dict(vals))
+            if state == "done":
+                txs._set_done(state_message=state_message)
+            elif state == "authorized":
+                txs._set_authorized(state_message=state_message)
+            elif state == "pending":
+                txs._set_pending(state_message=state_message)
+            elif state == "cancel":
+                txs._set_canceled(state_message=state_message)
+            else:
+                txs._set_error(state_message)
+            if state not in ("done", "authorized") and dict(vals).get("redsys_retryable"):
+                txs._redsys_schedule_retries()
+
+    @api.model
+    def _redsys_process_feedback_batch(self, items, execute_callback=False, auto_commit=False):
+        """ Apply many Redsys answers at once.
+
+        The state transitions are grouped in as few writes as possible. Should the grouped
+        writes fail, they are replayed one at a time, each in its own savepoint, so that a
+        faulty transaction does not roll back the others.
+
+        :param list items: (transaction, feedback data) pairs
+        :param bool execute_callback: Whether to execute the callbacks of the transactions
+        :param bool auto_commit: Whether to commit once the batch is applied
+        :return: The (transaction, error message) pairs that could not be applied
+        :rtype: list
+        """
+        start = time.perf_counter()
+        transitions, failures = [], []
+        for tx, data in items:
+            try:
+                params = redsys_utils.parse_notification(data).params
+                state, state_message = tx._redsys_get_feedback_state(params)
+                vals = tx._redsys_get_feedback_values(params)
+            except Exception as error:
+                failures.append((tx, str(error)))
+                continue
             if state == "error":
-                _logger.warning(vals["state_message"])
-        self.write(vals)
+                _logger.warning(state_message)
+            transitions.append((tx, state, state_message, vals))
+        try:
+            with self.env.cr.savepoint():
+                self._redsys_set_states(transitions)
+        except Exception:
+            _logger.exception("Redsys: grouped state update failed, applying one at a time")
+            applied = []
+            for transition in transitions:
+                try:
+                    with self.env.cr.savepoint():
+                        self._redsys_set_states([transition])
+                    applied.append(transition)
+                except Exception as error:
+                    failures.append((transition[0], str(error)))
+            transitions = applied
+        # The answers are applied together, each one is accounted its share
+        elapsed = (time.perf_counter() - start) / (len(transitions) or 1)
+        for tx, state, _state_message, _vals in transitions:
+            redsys_metrics.feedbacks.observe(elapsed, state=state or tx.state)
+        self.browse(
+            [tx.id for tx, state, _state_message, _vals in transitions if state is not None]
+        )._redsys_update_partial_orders()
+        if execute_callback:
+            for tx, _state, _state_message, _vals in transitions:
+                try:
+                    with self.env.cr.savepoint():
+                        tx._execute_callback()
+                except Exception as error:
+                    _logger.exception("Redsys: callback failed for %s", tx.reference)
+                    failures.append((tx, str(error)))
+        if auto_commit:
+            self.env.cr.commit()
+        return failures
+
+    def _process_feedback_data(self, data):
+        super()._process_feedback_data(data)
+        if self.provider != 'redsys':
+            return
+        start = time.perf_counter()
+        params = redsys_utils.parse_notification(data).params
+        state, state_message = self._redsys_get_feedback_state(params)
+        if state == "error":
+            _logger.warning(state_message)
+        with redsys_profiler.span("state"):
+            self._redsys_set_states(
+                [(self, state, state_message, self._redsys_get_feedback_values(params))]
+            )
+        if state is not None:
+            self._redsys_update_partial_orders()
+        redsys_metrics.feedbacks.observe(time.perf_counter() - start, state=state or self.state)
         return state != "error"
 
     @api.model
@@ -241,85 +1213,73 @@ class TxRedsys(models.Model):
         res = super()._get_tx_from_feedback_data(acquirer_name, data)
         if acquirer_name != "redsys":
             return res
-        try:
-            tx_find_method_name = "_%s_form_get_tx_from_data" % acquirer_name
-            if hasattr(self, tx_find_method_name):
-                tx = getattr(self, tx_find_method_name)(data)
-            _logger.info(
-                "<%s> transaction processed: tx ref:%s, tx amount: %s",
-                acquirer_name,
-                tx.reference if tx else "n/a",
-                tx.amount if tx else "n/a",
-            )
-            if tx.acquirer_id.redsys_percent_partial > 0:
-                if tx and tx.sale_order_ids and tx.sale_order_ids.ensure_one():
-                    percent_reduction = tx.acquirer_id.redsys_percent_partial
-                    new_so_amount = tx.sale_order_ids.amount_total - (
-                            tx.sale_order_ids.amount_total * percent_reduction / 100
-                    )
-                    amount_matches = (
-                            tx.sale_order_ids.state in ["draft", "sent"]
-                            and float_compare(tx.amount, new_so_amount, 2) == 0
-                    )
-                    if amount_matches:
-                        if tx.state == "done":
-                            _logger.info(
-                                "<%s> transaction completed, confirming order "
-                                "%s (ID %s)",
-                                acquirer_name,
-                                tx.sale_order_ids.name,
-                                tx.sale_order_ids.id,
-                            )
-                            if not self.env.context.get("bypass_test", False):
-                                tx.sale_order_ids.with_context(
-                                    send_email=True
-                                ).action_confirm()
-                        elif tx.state != "cancel" and tx.sale_order_ids.state == "draft":
-                            _logger.info(
-                                "<%s> transaction pending, sending "
-                                "quote email for order %s (ID %s)",
-                                acquirer_name,
+        tx = self._redsys_form_get_tx_from_data(data)
+        _logger.info(
+            "<%s> transaction processed: tx ref:%s, tx amount: %s",
+            acquirer_name,
+            tx.reference if tx else "n/a",
+            tx.amount if tx else "n/a",
+        )
+        return tx
+
+    def _redsys_update_partial_orders(self):
+        """ Confirm the sale orders paid in part through the transactions in `self`, or send
+        their quotation while the payment is pending.
+
+        Called once the answer of Redsys is applied, so that the decision is taken on the
+        resulting state of the transaction.
+        """
+        for tx in self:
+            try:
+                if tx.acquirer_id.redsys_percent_partial > 0:
+                    if tx.sale_order_ids and tx.sale_order_ids.ensure_one():
+                        percent_reduction = tx.acquirer_id.redsys_percent_partial
+                        new_so_amount = tx.sale_order_ids.amount_total - (
+                                tx.sale_order_ids.amount_total * percent_reduction / 100
+                        )
+                        amount_matches = (
+                                tx.sale_order_ids.state in ["draft", "sent"]
+                                and float_compare(tx.amount, new_so_amount, 2) == 0
+                        )
+                        if amount_matches:
+                            if tx.state == "done":
+                                _logger.info(
+                                    "<redsys> transaction completed, confirming order "
+                                    "%s (ID %s)",
+                                    tx.sale_order_ids.name,
+                                    tx.sale_order_ids.id,
+                                )
+                                if not self.env.context.get("bypass_test", False):
+                                    with redsys_profiler.span("confirm"):
+                                        self.env["payment.redsys.order.job"].sudo(
+                                        )._run_or_enqueue(tx, "confirm")
+                            elif tx.state != "cancel" and tx.sale_order_ids.state == "draft":
+                                _logger.info(
+                                    "<redsys> transaction pending, sending "
+                                    "quote email for order %s (ID %s)",
+                                    tx.sale_order_ids.name,
+                                    tx.sale_order_ids.id,
+                                )
+                                if not self.env.context.get("bypass_test", False):
+                                    with redsys_profiler.span("quotation_email"):
+                                        self.env["payment.redsys.order.job"].sudo(
+                                        )._run_or_enqueue(tx, "quotation")
+                        else:
+                            _logger.warning(
+                                "<redsys> transaction MISMATCH for order " "%s (ID %s)",
                                 tx.sale_order_ids.name,
                                 tx.sale_order_ids.id,
                             )
-                            if not self.env.context.get("bypass_test", False):
-                                tx.sale_order_ids.action_quotation_send()
-                    else:
-                        _logger.warning(
-                            "<%s> transaction MISMATCH for order " "%s (ID %s)",
-                            acquirer_name,
-                            tx.sale_order_ids.name,
-                            tx.sale_order_ids.id,
-                        )
-        except Exception:
-            _logger.exception(
-                "Fail to confirm the order or send the confirmation email%s",
-                tx and " for the transaction %s" % tx.reference or "",
-            )
-        return tx
+            except Exception:
+                _logger.exception(
+                    "Fail to confirm the order or send the confirmation email"
+                    " for the transaction %s", tx.reference,
+                )
 
     def redsys_s2s_do_transaction(self, **kwargs):
-        tx_values = {
-            'token_ref': self.token_id.acquirer_ref,
-            'txnid': self.token_id.txnid,
-            'reference': self.reference,
-            'amount': self.amount
-        }
-
-        merchant_parameters = self.acquirer_id._prepare_merchant_parameters_recurring(tx_values)
-        redsys_values = {
-            "Ds_SignatureVersion": str(self.acquirer_id.redsys_signature_version),
-            "Ds_MerchantParameters": merchant_parameters,
-            "Ds_Signature": self.acquirer_id.sign_parameters(
-                self.acquirer_id.redsys_secret_key, merchant_parameters
-            ),
-        }
-
-        url = self.acquirer_id._get_redsys_url_s2s()
-        response = requests.post(url=url, data=redsys_values)
-        response = json.loads(response.content.decode('utf8'))
+        response = self.acquirer_id._redsys_make_request(self._redsys_prepare_s2s_values())
         if response.get('errorCode', False):
-            _logger.debug("=======ERROR OF REDSYS=====%r", response.get('errorCode', False))
+            self._redsys_handle_charge_failure(response['errorCode'])
             return
         self._process_feedback_data(response)
         if self.state == 'done':
@@ -4,30 +4,47 @@
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
 import base64
-import hashlib
-import hmac
-
 import json
 import logging
-import urllib
+import os
+import time
+
+import requests
+
 from odoo.tools import config
-from odoo import _, api, exceptions, fields, http, models
+from odoo import _, api, exceptions, fields, http, models, tools
 
+from odoo.addons.payment_redsys import const
+from odoo.addons.payment_redsys import metrics as redsys_metrics
+from odoo.addons.payment_redsys import profiler as redsys_profiler
+from odoo.addons.payment_redsys import simulator as redsys_simulator
+from odoo.addons.payment_redsys import sis as redsys_sis
+from odoo.addons.payment_redsys import utils as redsys_utils
 
-_logger = logging.getLogger(__name__)
 
-try:
-    from Crypto.Cipher import DES3
-except ImportError:
-    _logger.info("Missing dependency (pycryptodome). See README.")
+_logger = logging.getLogger(__name__)
 
 
 class AcquirerRedsys(models.Model):
     _inherit = "payment.acquirer"
 
+    def _get_redsys_simulator_url(self):
+        """Return the URL of the Redsys simulator that stands in for the test
+        environment, if any. Acquirers in production never use it.
+        """
+        url = self.env["ir.config_parameter"].sudo().get_param(
+            "payment_redsys.simulator_url"
+        )
+        return url and url.rstrip("/") or False
+
     def _get_redsys_urls(self, environment):
         """ Redsys URLs
         """
+        simulator_url = environment != "prod" and self._get_redsys_simulator_url()
+        if simulator_url:
+            return {
+                "redsys_form_url": simulator_url + redsys_simulator.FORM_PATH,
+            }
         if environment == "prod":
             return {
                 "redsys_form_url": "https://sis.redsys.es/sis/realizarPago/",
@@ -38,11 +55,77 @@ class AcquirerRedsys(models.Model):
             }
 
     def _get_redsys_url_s2s(self):
+        simulator_url = self.state != "enabled" and self._get_redsys_simulator_url()
+        if simulator_url:
+            return simulator_url + redsys_simulator.REST_PATH
         if self.state == "enabled":
             return 'https://sis.redsys.es/sis/rest/trataPeticionREST'
         else:
             return 'https://sis-t.redsys.es:25443/sis/rest/trataPeticionREST'
 
+    def _get_redsys_url_query(self):
+        """Return the endpoint of the status queries, the consultation web
+        service unless the ``payment_redsys.query_url`` system parameter is set.
+        """
+        url = self.env["ir.config_parameter"].sudo().get_param("payment_redsys.query_url")
+        if url:
+            return url
+        simulator_url = self.state != "enabled" and self._get_redsys_simulator_url()
+        if simulator_url:
+            return simulator_url + redsys_sis.CONSULTATION_PATH
+        if self.state == "enabled":
+            return "https://sis.redsys.es" + redsys_sis.CONSULTATION_PATH
+        else:
+            return "https://sis-t.redsys.es:25443" + redsys_sis.CONSULTATION_PATH
+
+    def _get_redsys_session(self):
+        """Return the pooled HTTP session used for the REST calls of this
+        acquirer. Pool size and retries are read from system parameters.
+        """
+        self.ensure_one()
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return redsys_utils.get_session(
+            (self.env.cr.dbname, self.id),
+            pool_size=int(get_param("payment_redsys.http_pool_size", 10)),
+            max_retries=int(get_param("payment_redsys.http_max_retries", 2)),
+            backoff_factor=float(get_param("payment_redsys.http_backoff_factor", 0.3)),
+        )
+
+    @api.model
+    def _get_redsys_request_timeout(self):
+        """Return the (connect, read) timeout of the REST calls, in seconds."""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return (
+            float(get_param("payment_redsys.http_connect_timeout", 5)),
+            float(get_param("payment_redsys.http_read_timeout", 30)),
+        )
+
+    def _redsys_make_request(self, data):
+        """Send ``data`` to the Redsys REST endpoint and return its decoded
+        JSON answer.
+
+        :param dict data: The signed Ds_* values to post
+        :return: The JSON-decoded response
+        :rtype: dict
+        :raise: ValidationError if Redsys cannot be reached
+        """
+        self.ensure_one()
+        url = self._get_redsys_url_s2s()
+        start = time.perf_counter()
+        try:
+            response = self._get_redsys_session().post(
+                url, data=data, timeout=self._get_redsys_request_timeout()
+            )
+        except requests.exceptions.RequestException as error:
+            redsys_metrics.observe_rest(time.perf_counter() - start, None, error)
+            _logger.exception("Redsys: unable to reach endpoint at %s", url)
+            raise exceptions.ValidationError(
+                "Redsys: " + _("Could not establish the connection to the API.")
+            )
+        result = json.loads(response.content.decode("utf8"))
+        redsys_metrics.observe_rest(time.perf_counter() - start, result, None)
+        return result
+
     provider = fields.Selection(selection_add=[("redsys", "Redsys")],
                                 ondelete={'redsys': 'set default', 'none': 'set default'})
     redsys_merchant_name = fields.Char("Merchant Name", required_if_provider="redsys")
@@ -102,6 +185,14 @@ class AcquirerRedsys(models.Model):
              "payment later.",
     )
 
+    @api.depends("provider")
+    def _compute_feature_support_fields(self):
+        """Redsys refunds, also partially, and captures through the REST API."""
+        super()._compute_feature_support_fields()
+        self.filtered(lambda a: a.provider == "redsys").update(
+            {"support_refund": "partial", "support_manual_capture": True}
+        )
+
     @api.constrains("redsys_percent_partial")
     def check_redsys_percent_partial(self):
         if self.redsys_percent_partial < 0 or self.redsys_percent_partial > 100:
@@ -128,8 +219,7 @@ class AcquirerRedsys(models.Model):
             return self.env["ir.config_parameter"].sudo().get_param("web.base.url")
 
         domain = False
-        # _logger.info("=========%r",[http.request])
-        if hasattr(http.request, 'website'):
+        if http.request and hasattr(http.request, 'website'):
             domain = http.request.website.domain
 
         if domain:
@@ -138,47 +228,215 @@ class AcquirerRedsys(models.Model):
             base_url = self.env["ir.config_parameter"].sudo().get_param("web.base.url")
         return base_url or ""
 
+    def _get_redsys_endpoints(self):
+        """Return the URLs used by this acquirer on the current website: the
+        redirect form (``form_url``), the REST endpoint (``s2s_url``), the
+        notification URL (``merchant_url``) and the result pages (``url_ok``
+        and ``url_ko``). The returned dict is cached and must not be modified.
+        """
+        self.ensure_one()
+        domain = False
+        if not config["test_enable"] and http.request and hasattr(http.request, "website"):
+            domain = http.request.website.domain
+        return self._get_redsys_endpoints_cached(domain or False)
+
+    @tools.ormcache("self.id", "self.state", "domain")
+    def _get_redsys_endpoints_cached(self, domain):
+        # Keyed on the state, and writing system parameters clears the ormcache
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        base_url = (
+            self._get_website_callback_url() or domain or get_param("web.base.url") or ""
+        )
+        return {
+            "form_url": self.redsys_get_form_action_url(),
+            "s2s_url": self._get_redsys_url_s2s(),
+            "merchant_url": ("%s/payment/redsys/return" % base_url)[:250],
+            "url_ok": "%s/payment/redsys/result/redsys_result_ok" % base_url,
+            "url_ko": "%s/payment/redsys/result/redsys_result_ko" % base_url,
+        }
+
+    # Fields the configuration snapshot is built from
+    _redsys_config_fields = {
+        "state",
+        "website_id",
+        "redsys_merchant_code",
+        "redsys_merchant_name",
+        "redsys_merchant_description",
+        "redsys_merchant_data",
+        "redsys_terminal",
+        "redsys_currency",
+        "redsys_transaction_type",
+        "redsys_merchant_lang",
+        "redsys_pay_method",
+        "redsys_signature_version",
+        "redsys_secret_key",
+        "redsys_percent_partial",
+        "capture_manually",
+    }
+
+    def _get_redsys_config(self):
+        """Return the configuration snapshot of this acquirer, see
+        ``utils.RedsysConfig``. It is cached per worker and dropped whenever
+        the acquirer or a system parameter is written.
+        """
+        self.ensure_one()
+        return self._get_redsys_config_cached()
+
+    @tools.ormcache("self.id")
+    def _get_redsys_config_cached(self):
+        acquirer = self.sudo()
+        return redsys_utils.RedsysConfig(
+            acquirer_id=acquirer.id,
+            state=acquirer.state,
+            website_id=acquirer.website_id.id,
+            merchant_code=(acquirer.redsys_merchant_code or "")[:9],
+            merchant_name=(acquirer.redsys_merchant_name or "")[:25],
+            merchant_description=(acquirer.redsys_merchant_description or "")[:125],
+            merchant_data=acquirer.redsys_merchant_data or "",
+            terminal=acquirer.redsys_terminal or "1",
+            currency=acquirer.redsys_currency or "978",
+            transaction_type=(
+                const.TRANSACTION_PREAUTHORISATION if acquirer.capture_manually
+                else acquirer.redsys_transaction_type or "0"
+            ),
+            lang=acquirer.redsys_merchant_lang or "001",
+            pay_method=acquirer.redsys_pay_method or "T",
+            signature_version=str(acquirer.redsys_signature_version),
+            secret_key=acquirer.redsys_secret_key,
+            percent_partial=acquirer.redsys_percent_partial,
+            form_url=acquirer.redsys_get_form_action_url(),
+            s2s_url=acquirer._get_redsys_url_s2s(),
+        )
+
+    def _redsys_route(self, website_id=None, currency_id=None):
+        """Pick, among the Redsys acquirers in `self`, the ones that should take
+        a payment of ``website_id`` in ``currency_id``: the terminals of that
+        currency, preferring the ones dedicated to the website. Acquirers are
+        only discarded when another one can take the payment.
+
+        :param int website_id: The website of the payment, if any
+        :param int currency_id: The currency of the payment, if any
+        :return: The routed acquirers
+        :rtype: recordset of `payment.acquirer`
+        """
+        if len(self) < 2:
+            return self
+        configs = {acquirer: acquirer._get_redsys_config() for acquirer in self}
+        routed = self
+        currency = self.env["res.currency"].browse(currency_id)
+        code = currency_id and const.CURRENCY_CODES.get(currency.name)
+        if code:
+            routed = routed.filtered(lambda a: configs[a].currency == code) or routed
+        if website_id:
+            routed = (
+                routed.filtered(lambda a: configs[a].website_id == website_id) or routed
+            )
+        return routed
+
+    @api.model
+    def _get_compatible_acquirers(self, *args, currency_id=None, website_id=None, **kwargs):
+        """Route the payments among the compatible Redsys acquirers."""
+        acquirers = super()._get_compatible_acquirers(
+            *args, currency_id=currency_id, website_id=website_id, **kwargs
+        )
+        redsys = acquirers.filtered(lambda a: a.provider == "redsys")
+        routed = redsys._redsys_route(website_id=website_id, currency_id=currency_id)
+        return acquirers.filtered(lambda a: a.provider != "redsys" or a in routed)
+
+    @api.model
+    def _get_redsys_order(self, reference):
+        """Return the Ds_Merchant_Order of a transaction with no stored order
+        number, the end of its ``reference``.
+        """
+        return reference and reference[-12:] or False
+
+    def _redsys_with_order(self, tx_values):
+        """Return ``tx_values`` with the order number of their transaction,
+        looked up once when the caller did not give it.
+        """
+        if tx_values.get("redsys_order"):
+            return tx_values
+        tx = self.env["payment.transaction"].sudo().search(
+            [("reference", "=", tx_values["reference"])], limit=1
+        )
+        return dict(
+            tx_values,
+            redsys_order=tx.redsys_order or self._get_redsys_order(tx_values["reference"]),
+        )
+
+    def _get_redirect_form_view(self, is_validation=False):
+        """Flag the rendering of the Redsys form, to time it apart."""
+        view = super()._get_redirect_form_view(is_validation=is_validation)
+        if self.provider != "redsys" or not view:
+            return view
+        return view.with_context(redsys_form_render=True)
+
     def _prepare_merchant_parameters(self, tx_values, recurring=True):
-        # Check multi-website
-        base_url = self._get_website_url()
-        callback_url = self._get_website_callback_url()
-        if self.redsys_percent_partial > 0:
+        with redsys_metrics.form_payloads.time():
+            return self._prepare_merchant_parameters_values(self._redsys_with_order(tx_values))
+
+    def _prepare_merchant_parameters_values(self, tx_values):
+        endpoints = self._get_redsys_endpoints()
+        config = self._get_redsys_config()
+        if config.percent_partial > 0:
             amount = tx_values["amount"]
-            tx_values["amount"] = amount - (amount * self.redsys_percent_partial / 100)
+            tx_values["amount"] = amount - (amount * config.percent_partial / 100)
         values = {
-            "Ds_Sermepa_Url": self.redsys_get_form_action_url(),
+            "Ds_Sermepa_Url": endpoints["form_url"],
             "Ds_Merchant_Amount": str(int(round(tx_values["amount"] * 100))),
-            "Ds_Merchant_Currency": self.redsys_currency or "978",
-            "Ds_Merchant_Order": (
-                    tx_values["reference"] and tx_values["reference"][-12:] or False
-            ),
-            "Ds_Merchant_MerchantCode": (
-                    self.redsys_merchant_code and self.redsys_merchant_code[:9]
-            ),
-            "Ds_Merchant_Terminal": self.redsys_terminal or "1",
-            "Ds_Merchant_TransactionType": (self.redsys_transaction_type or "0"),
+            "Ds_Merchant_Currency": config.currency,
+            "Ds_Merchant_Order": (tx_values.get("redsys_order")
+                                  or self._get_redsys_order(tx_values["reference"])),
+            "Ds_Merchant_MerchantCode": config.merchant_code,
+            "Ds_Merchant_Terminal": config.terminal,
+            "Ds_Merchant_TransactionType": config.transaction_type,
             # "DS_MERCHANT_COF_INI": "S",
             # "DS_MERCHANT_COF_TYPE": "R",
             # "DS_MERCHANT_IDENTIFIER": "REQUIRED",
             "Ds_Merchant_Titular": tx_values.get(
                 "billing_partner", self.env.user.partner_id
             ).display_name[:60],
-            "Ds_Merchant_MerchantName": (
-                    self.redsys_merchant_name and self.redsys_merchant_name[:25]
-            ),
-            "Ds_Merchant_MerchantUrl": ("%s/payment/redsys/return" % (callback_url or base_url))[:250],
-            "Ds_Merchant_MerchantData": self.redsys_merchant_data or "",
-            "Ds_Merchant_ProductDescription": (self._product_description(tx_values["reference"])
-                                               or self.redsys_merchant_description
-                                               and self.redsys_merchant_description[:125]),
-            "Ds_Merchant_ConsumerLanguage": (self.redsys_merchant_lang or "001"),
-            "Ds_Merchant_UrlOk": "%s/payment/redsys/result/redsys_result_ok" % (callback_url or base_url),
-            "Ds_Merchant_UrlKo": "%s/payment/redsys/result/redsys_result_ko" % (callback_url or base_url),
-            "Ds_Merchant_Paymethods": self.redsys_pay_method or "T",
+            "Ds_Merchant_MerchantName": config.merchant_name,
+            "Ds_Merchant_MerchantUrl": endpoints["merchant_url"],
+            "Ds_Merchant_MerchantData": config.merchant_data,
+            "Ds_Merchant_ProductDescription": (tx_values.get("redsys_product_description")
+                                               or self._product_description(tx_values["reference"])
+                                               or config.merchant_description),
+            "Ds_Merchant_ConsumerLanguage": config.lang,
+            "Ds_Merchant_UrlOk": endpoints["url_ok"],
+            "Ds_Merchant_UrlKo": endpoints["url_ko"],
+            "Ds_Merchant_Paymethods": config.pay_method,
         }
-        _logger.info("=======%r", values)
+        self._redsys_trace("merchant parameters", values)
         return self._url_encode64(json.dumps(values))
 
+    @api.model
+    def _redsys_trace(self, event, values):
+        """Log ``values`` lazily and redacted, sampled at INFO following the
+        ``payment_redsys.debug_sample_rate`` system parameter (0 to 1).
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        redsys_utils.trace(
+            _logger, event, values, float(get_param("payment_redsys.debug_sample_rate", 0))
+        )
+
+    @api.model
+    def _redsys_profiled(self, name):
+        """Return the context manager profiling the request ``name``, sampled
+        following the ``payment_redsys.profile_sample_rate`` system parameter
+        (0 to 1). The slowest ``payment_redsys.profile_size`` requests of each
+        worker are written to ``payment_redsys.profile_file``.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return redsys_profiler.profiled(
+            name,
+            self.env.cr,
+            float(get_param("payment_redsys.profile_sample_rate", 0)),
+            size=int(get_param("payment_redsys.profile_size", 20)),
+            path=get_param("payment_redsys.profile_file")
+            or os.path.join(config["data_dir"], "redsys_profile.log"),
+        )
+
     def _url_encode64(self, data):
         data = base64.b64encode(data.encode())
         return data
@@ -186,33 +444,131 @@ class AcquirerRedsys(models.Model):
     def _url_decode64(self, data):
         return json.loads(base64.b64decode(data).decode())
 
-    def sign_parameters(self, secret_key, params64):
-        params_dic = self._url_decode64(params64)
-        if "Ds_Merchant_Order" in params_dic:
-            order = str(params_dic["Ds_Merchant_Order"])
-        else:
-            order = str(urllib.parse.unquote(params_dic.get("Ds_Order", "Not found")))
-        cipher = DES3.new(
-            key=base64.b64decode(secret_key), mode=DES3.MODE_CBC, IV=b"\0\0\0\0\0\0\0\0"
+    def sign_parameters(self, secret_key, params64, order=None):
+        """Sign ``params64`` with ``secret_key``. Callers that already know the
+        order number can pass it to skip decoding the parameters.
+        """
+        with redsys_metrics.signatures.time():
+            if order is None:
+                order = redsys_utils.get_order(self._url_decode64(params64))
+            return redsys_utils.sign_parameters(secret_key, params64, order)
+
+    def sign_many(self, items):
+        """Sign many ``(params64, order)`` pairs with the key of this acquirer,
+        ``order`` may be None to read it from the parameters.
+        """
+        self.ensure_one()
+        secret_key = self._get_redsys_config().secret_key
+        return [
+            self.sign_parameters(secret_key, params64, order)
+            for params64, order in items
+        ]
+
+    @api.model
+    def redsys_verify_signatures(self, pairs, processes=0, chunk_size=10000):
+        """Verify many signed Redsys payloads, e.g. a notification archive.
+
+        Each payload is checked with the secret key of the acquirer matching
+        its merchant code and terminal, among the acquirers in `self` (all the
+        Redsys acquirers if empty), comparing the signatures in constant time.
+
+        :param iterable pairs: (Ds_MerchantParameters, Ds_Signature) pairs,
+                               consumed lazily so it may be a stream
+        :param int processes: The size of the process pool to spread the work
+                              on, none if below 2
+        :param int chunk_size: The number of pairs sent at once to a process
+        :return: Whether each pair is correctly signed, in the order of `pairs`
+        :rtype: generator
+        """
+        acquirers = self or self.search([("provider", "=", "redsys")])
+        keys = {}
+        for acquirer in acquirers:
+            config = acquirer._get_redsys_config()
+            if config.secret_key:
+                keys[redsys_utils.merchant_key(
+                    {"Ds_MerchantCode": config.merchant_code, "Ds_Terminal": config.terminal}
+                )] = config.secret_key
+        return redsys_utils.verify_many(
+            keys, pairs, processes=processes, chunk_size=chunk_size
+        )
+
+    def write(self, vals):
+        if "redsys_secret_key" in vals:
+            redsys_utils.clear_signing_cache()
+        res = super().write(vals)
+        if self._redsys_config_fields.intersection(vals):
+            self.clear_caches()
+            # The presigned forms carry the former configuration, they are
+            # signed again when rendered
+            self.env["payment.transaction"].sudo().search(
+                [
+                    ("acquirer_id", "in", self.ids),
+                    ("state", "=", "draft"),
+                    ("redsys_signature", "!=", False),
+                ]
+            ).write({"redsys_merchant_parameters": False, "redsys_signature": False})
+        return res
+
+    @api.model
+    def _get_redsys_metrics(self):
+        """Return the metrics of this worker in the Prometheus text format,
+        along with the gauges of the HTTP pools and of the queues.
+        """
+        queue = self.env["payment.redsys.notification"]._get_queue_metrics()
+        self.env.cr.execute(
+            "SELECT COUNT(*) FROM payment_redsys_retry WHERE state = 'queued'"
+        )
+        retries = self.env.cr.fetchone()[0]
+        connections = []
+        for (dbname, acquirer_id), stats in redsys_utils.get_session_stats().items():
+            if dbname != self.env.cr.dbname:
+                continue
+            for kind in ("new", "reused"):
+                connections.append(
+                    ({"acquirer": acquirer_id, "kind": kind}, stats[kind])
+                )
+        return redsys_metrics.render(
+            [
+                (
+                    "redsys_http_connections",
+                    "Requests sent over new or reused pooled connections",
+                    connections,
+                ),
+                ("redsys_queue_depth", "Notifications waiting", [({}, queue["depth"])]),
+                (
+                    "redsys_queue_lag_seconds",
+                    "Age of the oldest notification waiting",
+                    [({}, queue["lag"])],
+                ),
+                ("redsys_queue_errors", "Notifications in error", [({}, queue["errors"])]),
+                (
+                    "redsys_duplicates_suppressed",
+                    "Duplicate notifications dropped by this worker",
+                    [({}, queue["duplicates"])],
+                ),
+                ("redsys_retries_queued", "Token charges waiting a retry", [({}, retries)]),
+            ]
         )
-        diff_block = len(order) % 8
-        zeros = diff_block and (b"\0" * (8 - diff_block)) or b""
-        key = cipher.encrypt(str.encode(order + zeros.decode()))
-        if isinstance(params64, str):
-            params64 = params64.encode()
-        dig = hmac.new(key=key, msg=params64, digestmod=hashlib.sha256).digest()
-        return base64.b64encode(dig).decode()
 
     def redsys_form_generate_values(self, values):
         self.ensure_one()
+        with redsys_metrics.forms_rendered.time():
+            return self._redsys_form_generate_values(self._redsys_with_order(values))
+
+    def _redsys_form_generate_values(self, values):
+        config = self._get_redsys_config()
         redsys_values = dict(values)
         merchant_parameters = self._prepare_merchant_parameters(values).decode('utf-8')
         redsys_values.update(
             {
-                'api_url': self.redsys_get_form_action_url(),
-                "Ds_SignatureVersion": str(self.redsys_signature_version),
+                'api_url': config.form_url,
+                "Ds_SignatureVersion": config.signature_version,
                 "Ds_MerchantParameters": merchant_parameters,
-                "Ds_Signature": (self.sign_parameters(self.redsys_secret_key, merchant_parameters)),
+                "Ds_Signature": self.sign_parameters(
+                    config.secret_key,
+                    merchant_parameters,
+                    order=values["redsys_order"],
+                ),
             }
         )
         return redsys_values
@@ -223,12 +579,69 @@ class AcquirerRedsys(models.Model):
         return self._get_redsys_urls(environment)["redsys_form_url"]
 
     def _product_description(self, order_ref):
-        sale_order = self.env["sale.order"].search([("name", "=", order_ref)])
-        res = ""
-        if sale_order:
-            description = "|".join(x.name for x in sale_order.order_line)
-            res = description[:125]
-        return res
+        return self._get_redsys_product_descriptions([order_ref]).get(order_ref, "")
+
+    @api.model
+    def _get_redsys_product_descriptions(self, references, size=125):
+        """Build the Ds_Merchant_ProductDescription of many transactions at once.
+
+        The lines of the sale orders linked to each transaction (or, failing
+        that, of the sale order named like the reference) are joined with "|".
+        A single query fetches them, truncated and limited to the lines that
+        can fit in ``size`` characters, so large carts are never fully loaded.
+
+        :param list references: The references of the transactions
+        :param int size: The maximum length of a description
+        :return: The descriptions indexed by reference, missing when empty
+        :rtype: dict
+        """
+        references = tuple(set(filter(None, references)))
+        if not references:
+            return {}
+        self.env["payment.transaction"].flush(["reference", "sale_order_ids"])
+        self.env["sale.order"].flush(["name"])
+        self.env["sale.order.line"].flush(["order_id", "sequence", "name"])
+        self.env.cr.execute(
+            """
+            WITH orders AS (
+                SELECT tx.reference, rel.sale_order_id AS order_id
+                  FROM payment_transaction tx
+                  JOIN sale_order_transaction_rel rel ON rel.transaction_id = tx.id
+                 WHERE tx.reference IN %(references)s
+                 UNION
+                SELECT so.name, so.id
+                  FROM sale_order so
+                 WHERE so.name IN %(references)s
+                   AND NOT EXISTS (
+                       SELECT 1
+                         FROM payment_transaction tx
+                         JOIN sale_order_transaction_rel rel
+                           ON rel.transaction_id = tx.id
+                        WHERE tx.reference = so.name
+                   )
+            ), lines AS (
+                SELECT orders.reference, LEFT(line.name, %(size)s) AS name,
+                       ROW_NUMBER() OVER (
+                           PARTITION BY orders.reference
+                           ORDER BY line.order_id, line.sequence, line.id
+                       ) AS rank
+                  FROM orders
+                  JOIN sale_order_line line ON line.order_id = orders.order_id
+            )
+            SELECT reference, name FROM lines
+             WHERE rank <= %(size)s + 1
+          ORDER BY reference, rank
+            """,
+            {"references": references, "size": size},
+        )
+        names = {}
+        for reference, name in self.env.cr.fetchall():
+            names.setdefault(reference, []).append(name or "")
+        # Every line but the first one takes at least its separator, so no
+        # more than `size` + 1 lines can show up in the description
+        return {
+            reference: "|".join(lines)[:size] for reference, lines in names.items()
+        }
 
     @api.model
     def redsys_s2s_form_process(self, data):
@@ -244,21 +657,51 @@ class AcquirerRedsys(models.Model):
         return self.env['payment.token'].sudo().create(vals)
 
     def _prepare_merchant_parameters_recurring(self, tx_values):
+        config = self._get_redsys_config()
         values = {
             "DS_MERCHANT_IDENTIFIER": tx_values.get('token_ref'),
             "DS_MERCHANT_COF_INI": "N",
             "DS_MERCHANT_COF_TXNID": tx_values.get('txnid'),
-            "DS_MERCHANT_MERCHANTCODE": self.redsys_merchant_code and self.redsys_merchant_code[:9],
-            "DS_MERCHANT_TRANSACTIONTYPE": (self.redsys_transaction_type or "0"),
+            "DS_MERCHANT_MERCHANTCODE": config.merchant_code,
+            "DS_MERCHANT_TRANSACTIONTYPE": config.transaction_type,
             "DS_MERCHANT_EXCEP_SCA" : "MIT",
             "DS_MERCHANT_DIRECTPAYMENT": "true",
-            "Ds_Merchant_Order": tx_values["reference"] and tx_values["reference"][-12:] or False,
-            "DS_MERCHANT_TERMINAL": self.redsys_terminal or "1",
-            "DS_MERCHANT_CURRENCY": self.redsys_currency or "978",
+            "Ds_Merchant_Order": (tx_values.get("redsys_order")
+                                  or self._get_redsys_order(tx_values["reference"])),
+            "DS_MERCHANT_TERMINAL": config.terminal,
+            "DS_MERCHANT_CURRENCY": config.currency,
             "DS_MERCHANT_AMOUNT": str(int(round(tx_values["amount"] * 100))),
         }
         return self._url_encode64(json.dumps(values))
 
+    def _prepare_merchant_parameters_operation(self, redsys_order, amount, transaction_type):
+        """Return the merchant parameters of a refund or a capture of
+        ``amount`` on the order ``redsys_order``, already authorised.
+        """
+        config = self._get_redsys_config()
+        values = {
+            "DS_MERCHANT_ORDER": redsys_order,
+            "DS_MERCHANT_MERCHANTCODE": config.merchant_code,
+            "DS_MERCHANT_TERMINAL": config.terminal,
+            "DS_MERCHANT_CURRENCY": config.currency,
+            "DS_MERCHANT_TRANSACTIONTYPE": transaction_type,
+            "DS_MERCHANT_AMOUNT": str(int(round(abs(amount) * 100))),
+        }
+        return self._url_encode64(json.dumps(values))
+
+    def _prepare_redsys_consultation(self, redsys_order):
+        """Return the signed request to the consultation web service for the
+        payment of the order ``redsys_order``.
+        """
+        config = self._get_redsys_config()
+        return redsys_sis.build_consultation(
+            config.secret_key,
+            redsys_order,
+            config.merchant_code,
+            config.terminal,
+            config.transaction_type,
+        )
+
 
 class PaymentToken(models.Model):
     _inherit = 'payment.token'
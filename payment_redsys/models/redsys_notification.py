@@ -0,0 +1,262 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import json
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+from odoo.addons.payment_redsys import metrics as redsys_metrics
+from odoo.addons.payment_redsys import profiler as redsys_profiler
+from odoo.addons.payment_redsys import utils as redsys_utils
+
+_logger = logging.getLogger(__name__)
+
+
+class RedsysNotification(models.Model):
+    _name = "payment.redsys.notification"
+    _description = "Redsys Notification Queue"
+    _order = "id"
+
+    redsys_order = fields.Char("Redsys Order", readonly=True, index=True)
+    data = fields.Text(
+        "Notification Data",
+        required=True,
+        readonly=True,
+        help="The raw values posted by Redsys, as JSON",
+    )
+    transaction_id = fields.Many2one(
+        "payment.transaction", readonly=True, index=True, ondelete="set null"
+    )
+    state = fields.Selection(
+        [("pending", "Pending"), ("done", "Done"), ("error", "Error")],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    fingerprint = fields.Char(readonly=True, copy=False)
+    attempts = fields.Integer(readonly=True)
+    error_message = fields.Text(readonly=True)
+    processed_date = fields.Datetime(readonly=True)
+
+    _sql_constraints = [
+        (
+            "fingerprint_uniq",
+            "unique(fingerprint)",
+            "This Redsys notification has already been received.",
+        ),
+    ]
+
+    @api.model
+    def _is_async_enabled(self):
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return bool(get_param("payment_redsys.async_notifications"))
+
+    @api.model
+    def _get_dedup_key(self, data):
+        fingerprint = redsys_utils.notification_fingerprint(data)
+        return fingerprint and (self.env.cr.dbname, fingerprint)
+
+    @api.model
+    def _is_duplicate(self, data):
+        """Return whether the notification ``data`` has already been received,
+        looking at the in-memory LRU first and at the database then.
+        """
+        key = self._get_dedup_key(data)
+        if not key:
+            return False
+        deduplicator = redsys_utils.notification_deduplicator
+        if deduplicator.is_duplicate(key):
+            return True
+        self.env.cr.execute(
+            "SELECT 1 FROM payment_redsys_notification WHERE fingerprint = %s",
+            [key[1]],
+        )
+        if self.env.cr.fetchone():
+            deduplicator.remember(key)
+            deduplicator.count_suppressed()
+            return True
+        return False
+
+    @api.model
+    def _receive(self, data):
+        """Entry point of the notifications posted by Redsys.
+
+        Duplicates are dropped, then the notification is either queued or
+        processed right away depending on the ``async_notifications`` setting.
+
+        :param dict data: The values posted by Redsys
+        :return: The recorded notification, empty for a duplicate
+        """
+        key = self._get_dedup_key(data)
+        deduplicator = redsys_utils.notification_deduplicator
+        if key and deduplicator.is_duplicate(key):
+            redsys_metrics.notifications.inc(result="duplicate")
+            return self
+        is_async = self._is_async_enabled()
+        with redsys_profiler.span("enqueue"):
+            notification = self._enqueue(data, state="pending" if is_async else "done")
+        if not notification:
+            deduplicator.count_suppressed()
+            redsys_metrics.notifications.inc(result="duplicate")
+        elif is_async:
+            redsys_metrics.notifications.inc(result="queued")
+        else:
+            redsys_metrics.notifications.inc(result="processed")
+            with redsys_profiler.span("feedback"):
+                self.env["payment.transaction"]._handle_feedback_data("redsys", data)
+            notification.processed_date = fields.Datetime.now()
+        if key:
+            # Only trust the LRU once the notification is durably recorded, so
+            # a rolled back (and retried) request is not taken as a duplicate
+            self.env.cr.postcommit.add(lambda: deduplicator.remember(key))
+        return notification
+
+    @api.model
+    def _enqueue(self, data, state="pending"):
+        """Verify the signature of a notification and record it.
+
+        The row is inserted with ON CONFLICT DO NOTHING on its fingerprint, so
+        a concurrent delivery of the same notification waits for this one and
+        is then dropped instead of being processed twice.
+
+        :param dict data: The values posted by Redsys
+        :param str state: The state of the recorded notification
+        :return: The recorded notification, empty if it was already known
+        :raise: ValidationError if the transaction is unknown or the signature is invalid
+        """
+        tx = self.env["payment.transaction"]._redsys_form_get_tx_from_data(data)
+        self.env.cr.execute(
+            """
+            INSERT INTO payment_redsys_notification
+                (redsys_order, data, transaction_id, state, fingerprint, attempts,
+                 create_uid, create_date, write_uid, write_date)
+            VALUES (%s, %s, %s, %s, %s, 0,
+                    %s, NOW() AT TIME ZONE 'UTC', %s, NOW() AT TIME ZONE 'UTC')
+            ON CONFLICT (fingerprint) DO NOTHING
+            RETURNING id
+            """,
+            [
+                tx[:1].redsys_order,
+                json.dumps(redsys_utils.raw_data(data)),
+                tx[:1].id or None,
+                state,
+                redsys_utils.notification_fingerprint(data),
+                self.env.uid,
+                self.env.uid,
+            ],
+        )
+        row = self.env.cr.fetchone()
+        return self.browse(row and row[0])
+
+    def _process(self):
+        """Apply the queued notifications to their transactions.
+
+        The state transitions of the whole batch are grouped, see
+        ``payment.transaction._redsys_process_feedback_batch``. A notification
+        whose transaction already reached a final state is only marked as done,
+        so processing the same notification twice is harmless.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        max_attempts = int(get_param("payment_redsys.async_max_attempts", 5))
+        Transaction = self.env["payment.transaction"]
+        processed = self.browse()
+        errors = {}
+        items = []
+        for notification in self.filtered(lambda n: n.state == "pending"):
+            if notification.transaction_id.state in ("done", "cancel"):
+                processed |= notification
+                continue
+            data = json.loads(notification.data)
+            try:
+                with self.env.cr.savepoint():
+                    tx = Transaction._get_tx_from_feedback_data("redsys", data)
+            except Exception as error:
+                errors[notification] = str(error)
+                continue
+            items.append((notification, tx, data))
+        failures = dict(
+            Transaction._redsys_process_feedback_batch(
+                [(tx, data) for _notification, tx, data in items], execute_callback=True
+            )
+        )
+        for notification, tx, _data in items:
+            if tx in failures:
+                errors[notification] = failures[tx]
+            else:
+                processed |= notification
+        processed.write({"state": "done", "processed_date": fields.Datetime.now()})
+        for notification, error in errors.items():
+            _logger.error(
+                "Redsys: unable to process queued notification %s: %s",
+                notification.id,
+                error,
+            )
+            attempts = notification.attempts + 1
+            notification.write(
+                {
+                    "attempts": attempts,
+                    "error_message": error,
+                    "state": "error" if attempts >= max_attempts else "pending",
+                }
+            )
+
+    @api.model
+    def _cron_process_notifications(self, batch_size=None, auto_commit=True):
+        """Drain the queue in batches. The rows are locked with SKIP LOCKED, so
+        several cron workers can drain it in parallel.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        batch_size = batch_size or int(get_param("payment_redsys.async_batch_size", 200))
+        while True:
+            self.env.cr.execute(
+                """
+                SELECT id FROM payment_redsys_notification
+                 WHERE state = 'pending'
+              ORDER BY id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+                """,
+                [batch_size],
+            )
+            ids = [row[0] for row in self.env.cr.fetchall()]
+            if not ids:
+                break
+            self.browse(ids)._process()
+            if not auto_commit:
+                break
+            self.env.cr.commit()
+
+    @api.autovacuum
+    def _gc_processed_notifications(self):
+        """Drop the processed notifications once Redsys stopped retrying them."""
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        days = int(get_param("payment_redsys.notification_retention_days", 30))
+        limit = fields.Datetime.now() - timedelta(days=days)
+        self.search([("state", "=", "done"), ("create_date", "<", limit)]).unlink()
+
+    @api.model
+    def _get_queue_metrics(self):
+        """Return the depth of the queue, the age in seconds of its oldest
+        pending notification, the number of notifications in error and the
+        number of duplicates suppressed by this worker.
+        """
+        self.flush()
+        self.env.cr.execute(
+            """
+            SELECT COUNT(*) FILTER (WHERE state = 'pending'),
+                   EXTRACT(EPOCH FROM (NOW() AT TIME ZONE 'UTC'
+                       - MIN(create_date) FILTER (WHERE state = 'pending'))),
+                   COUNT(*) FILTER (WHERE state = 'error')
+              FROM payment_redsys_notification
+             WHERE state IN ('pending', 'error')
+            """
+        )
+        depth, lag, errors = self.env.cr.fetchone()
+        return {
+            "depth": depth,
+            "lag": float(lag or 0.0),
+            "errors": errors,
+            "duplicates": redsys_utils.notification_deduplicator.suppressed,
+        }
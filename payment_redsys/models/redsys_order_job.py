@@ -0,0 +1,154 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models
+
+_logger = logging.getLogger(__name__)
+
+
+class RedsysOrderJob(models.Model):
+    _name = "payment.redsys.order.job"
+    _description = "Redsys Post-Payment Order Job"
+    _order = "id"
+
+    transaction_id = fields.Many2one(
+        "payment.transaction", readonly=True, index=True, ondelete="cascade"
+    )
+    sale_order_id = fields.Many2one(
+        "sale.order", required=True, readonly=True, index=True, ondelete="cascade"
+    )
+    action = fields.Selection(
+        [("confirm", "Confirm Order"), ("quotation", "Send Quotation")],
+        required=True,
+        readonly=True,
+    )
+    state = fields.Selection(
+        [("pending", "Pending"), ("done", "Done"), ("error", "Error")],
+        default="pending",
+        required=True,
+        readonly=True,
+        index=True,
+    )
+    attempts = fields.Integer(readonly=True)
+    error_message = fields.Text(readonly=True)
+    processed_date = fields.Datetime(readonly=True)
+
+    @api.model
+    def _is_deferred(self):
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        return bool(get_param("payment_redsys.deferred_order_jobs"))
+
+    @api.model
+    def _run_or_enqueue(self, tx, action):
+        """Confirm the sale orders of ``tx`` or send their quotation, right away
+        or through the job queue depending on the ``deferred_order_jobs``
+        setting.
+
+        :param recordset tx: The paid transaction, as a `payment.transaction` record
+        :param str action: ``confirm`` or ``quotation``
+        :return: The queued jobs, empty when run right away
+        """
+        if not self._is_deferred():
+            self._execute(tx.sale_order_ids, action)
+            return self
+        pending = self.search(
+            [
+                ("sale_order_id", "in", tx.sale_order_ids.ids),
+                ("action", "=", action),
+                ("state", "=", "pending"),
+            ]
+        ).mapped("sale_order_id")
+        return self.create(
+            [
+                {"transaction_id": tx.id, "sale_order_id": order.id, "action": action}
+                for order in tx.sale_order_ids - pending
+            ]
+        )
+
+    @api.model
+    def _execute(self, orders, action):
+        if action == "confirm":
+            orders.with_context(send_email=True).action_confirm()
+        else:
+            orders.action_quotation_send()
+
+    def _process(self):
+        """Run the jobs, one savepoint each. The mails they generate are only
+        queued, to be sent all at once by ``_flush_mails``.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        max_attempts = int(get_param("payment_redsys.async_max_attempts", 5))
+        done = self.browse()
+        for job in self.with_context(mail_notify_force_send=False):
+            # The order may have been confirmed meanwhile, e.g. by a duplicate job
+            if job.sale_order_id.state not in ("draft", "sent"):
+                done |= job
+                continue
+            try:
+                with self.env.cr.savepoint():
+                    job._execute(job.sale_order_id, job.action)
+                done |= job
+            except Exception as error:
+                _logger.exception("Redsys: order job %s failed", job.id)
+                attempts = job.attempts + 1
+                job.write(
+                    {
+                        "attempts": attempts,
+                        "error_message": str(error),
+                        "state": "error" if attempts >= max_attempts else "pending",
+                    }
+                )
+        done.write({"state": "done", "processed_date": fields.Datetime.now()})
+
+    @api.model
+    def _get_last_mail_id(self):
+        self.env.cr.execute("SELECT MAX(id) FROM mail_mail")
+        return self.env.cr.fetchone()[0] or 0
+
+    @api.model
+    def _flush_mails(self, after_id):
+        """Send at once the mails queued since the mail ``after_id``."""
+        mails = self.env["mail.mail"].sudo().search(
+            [("id", ">", after_id), ("state", "=", "outgoing")]
+        )
+        if mails:
+            mails.process_email_queue(ids=mails.ids)
+
+    @api.model
+    def _cron_process_jobs(self, batch_size=None, auto_commit=True):
+        """Run the pending jobs in batches, with one flush of the mail queue per
+        batch. The rows are locked with SKIP LOCKED, so several cron workers
+        can share the queue.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        batch_size = batch_size or int(get_param("payment_redsys.order_job_batch_size", 50))
+        while True:
+            self.env.cr.execute(
+                """
+                SELECT id FROM payment_redsys_order_job
+                 WHERE state = 'pending'
+              ORDER BY id
+                 LIMIT %s
+                   FOR UPDATE SKIP LOCKED
+                """,
+                [batch_size],
+            )
+            ids = [row[0] for row in self.env.cr.fetchall()]
+            if not ids:
+                break
+            last_mail_id = self._get_last_mail_id()
+            self.browse(ids)._process()
+            if auto_commit:
+                self.env.cr.commit()
+            self._flush_mails(last_mail_id)
+            if not auto_commit:
+                break
+
+    @api.autovacuum
+    def _gc_done_jobs(self):
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        days = int(get_param("payment_redsys.notification_retention_days", 30))
+        limit = fields.Datetime.now() - timedelta(days=days)
+        self.search([("state", "=", "done"), ("create_date", "<", limit)]).unlink()
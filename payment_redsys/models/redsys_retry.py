@@ -0,0 +1,155 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import logging
+from datetime import timedelta
+
+from odoo import api, fields, models, tools
+
+from odoo.addons.payment_redsys import utils as redsys_utils
+
+_logger = logging.getLogger(__name__)
+
+
+class RedsysRetry(models.Model):
+    _name = "payment.redsys.retry"
+    _description = "Redsys Charge Retry"
+    _order = "next_attempt, id"
+
+    transaction_id = fields.Many2one(
+        "payment.transaction",
+        "Failed Transaction",
+        required=True,
+        readonly=True,
+        index=True,
+        ondelete="cascade",
+    )
+    acquirer_id = fields.Many2one(
+        "payment.acquirer", required=True, readonly=True, index=True, ondelete="cascade"
+    )
+    retry_transaction_id = fields.Many2one(
+        "payment.transaction",
+        "Retry Transaction",
+        readonly=True,
+        index=True,
+        ondelete="set null",
+        help="The transaction created to attempt the charge again",
+    )
+    attempt = fields.Integer(readonly=True, default=1)
+    next_attempt = fields.Datetime(required=True, readonly=True)
+    state = fields.Selection(
+        [("queued", "Queued"), ("sent", "Sent"), ("failed", "Failed")],
+        default="queued",
+        required=True,
+        readonly=True,
+    )
+    reason = fields.Char(readonly=True)
+
+    def init(self):
+        # The cron picks the due retries with a single range scan on this index
+        tools.create_index(
+            self._cr,
+            "payment_redsys_retry_state_next_attempt_index",
+            self._table,
+            ["state", "next_attempt"],
+        )
+
+    @api.model
+    def _schedule(self, tx, reason):
+        """Queue a new attempt of the failed token charge ``tx``.
+
+        :param recordset tx: The failed transaction, as a `payment.transaction` record
+        :param str reason: Why the charge failed
+        :return: The queued retry, empty if the attempts are exhausted
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        if self.search_count([("transaction_id", "=", tx.id)]):
+            return self
+        previous = self.search([("retry_transaction_id", "=", tx.id)], limit=1)
+        attempt = previous.attempt + 1 if previous else 1
+        if attempt > int(get_param("payment_redsys.retry_max_attempts", 4)):
+            _logger.warning(
+                "Redsys: giving up charging %s after %s retries: %s",
+                tx.reference,
+                attempt - 1,
+                reason,
+            )
+            return self
+        delay = redsys_utils.retry_delay(
+            attempt - 1,
+            tx.id,
+            base=int(get_param("payment_redsys.retry_base_delay", 3600)),
+            cap=int(get_param("payment_redsys.retry_max_delay", 86400)),
+            window=int(get_param("payment_redsys.retry_window", 900)),
+        )
+        return self.create(
+            {
+                "transaction_id": tx.id,
+                "acquirer_id": tx.acquirer_id.id,
+                "attempt": attempt,
+                "next_attempt": fields.Datetime.now() + timedelta(seconds=delay),
+                "reason": reason,
+            }
+        )
+
+    @api.model
+    def _get_due_retries(self):
+        """Lock and return the due retries, at most ``retry_max_in_flight`` per
+        acquirer, so a backlog never turns into a burst against Redsys.
+        """
+        get_param = self.env["ir.config_parameter"].sudo().get_param
+        self.flush()
+        self.env.cr.execute(
+            """
+            SELECT id FROM payment_redsys_retry
+             WHERE id IN (
+                 SELECT id FROM (
+                     SELECT id, ROW_NUMBER() OVER (
+                                PARTITION BY acquirer_id ORDER BY next_attempt, id
+                            ) AS rank
+                       FROM payment_redsys_retry
+                      WHERE state = 'queued' AND next_attempt <= %s
+                 ) due
+                  WHERE rank <= %s
+             )
+               FOR UPDATE SKIP LOCKED
+            """,
+            [
+                fields.Datetime.now(),
+                int(get_param("payment_redsys.retry_max_in_flight", 50)),
+            ],
+        )
+        return self.browse([row[0] for row in self.env.cr.fetchall()])
+
+    def _run(self, auto_commit=False):
+        """Create a fresh transaction for every retry, Redsys refusing order
+        numbers already used, and charge them all concurrently.
+
+        With ``auto_commit``, the retry transactions and the retries marked
+        sent are committed before any request leaves. A worker dying while
+        charging them never queues the retries again with new order numbers:
+        the transactions left in draft are sent again with the same ones by
+        ``_cron_redsys_charge_tokens``, which Redsys cannot charge twice.
+        """
+        retry_txs = self.env["payment.transaction"]
+        for retry in self:
+            try:
+                with self.env.cr.savepoint():
+                    retry_tx = retry.transaction_id._redsys_create_retry_transaction()
+            except Exception as error:
+                _logger.exception(
+                    "Redsys: cannot retry %s", retry.transaction_id.reference
+                )
+                retry.write({"state": "failed", "reason": str(error)})
+                continue
+            retry.write({"retry_transaction_id": retry_tx.id, "state": "sent"})
+            retry_txs |= retry_tx
+        if auto_commit:
+            self.env.cr.commit()
+        return retry_txs._redsys_send_payment_requests_batch(auto_commit=auto_commit)
+
+    @api.model
+    def _cron_process_retries(self, auto_commit=True):
+        retries = self._get_due_retries()
+        if not retries:
+            return None
+        return retries._run(auto_commit=auto_commit)
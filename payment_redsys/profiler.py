@@ -0,0 +1,147 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Sampled profiling of the Redsys checkout and notification requests.
+
+A sampled request records a span per stage (duration and number of SQL
+queries, nested stages being named ``parent/child``). The slowest requests
+seen by each worker are kept, and every request entering that ranking is
+written as a JSON line to a rotating file. Outside a sampled request,
+``span`` does nothing.
+"""
+
+import contextlib
+import heapq
+import itertools
+import json
+import logging
+import logging.handlers
+import os
+import random
+import threading
+import time
+
+_logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class Profile(object):
+    """Stages of a single request."""
+
+    __slots__ = ("name", "cr", "start", "spans", "_stack")
+
+    def __init__(self, name, cr):
+        self.name = name
+        self.cr = cr
+        self.start = time.perf_counter()
+        self.spans = []
+        self._stack = []
+
+    def _queries(self):
+        return getattr(self.cr, "sql_log_count", 0)
+
+    def enter(self, stage):
+        path = "/".join([frame[0] for frame in self._stack] + [stage])
+        self._stack.append((path, time.perf_counter(), self._queries()))
+
+    def exit(self):
+        path, start, queries = self._stack.pop()
+        self.spans.append(
+            {
+                "stage": path,
+                "seconds": time.perf_counter() - start,
+                "queries": self._queries() - queries,
+            }
+        )
+
+    def to_dict(self, total):
+        return {
+            "name": self.name,
+            "date": time.strftime("%Y-%m-%d %H:%M:%S"),
+            "pid": os.getpid(),
+            "seconds": total,
+            "stages": self.spans,
+        }
+
+
+class SlowestRecorder(object):
+    """Keeps the ``size`` slowest requests profiled by this worker."""
+
+    def __init__(self):
+        self._heap = []
+        self._counter = itertools.count()
+        self._lock = threading.Lock()
+        self._handlers = {}
+
+    def _get_file_logger(self, path):
+        handler_logger = self._handlers.get(path)
+        if handler_logger is None:
+            handler_logger = logging.getLogger("%s.file.%s" % (__name__, len(self._handlers)))
+            handler_logger.propagate = False
+            handler_logger.setLevel(logging.INFO)
+            handler = logging.handlers.RotatingFileHandler(
+                path, maxBytes=10 * 1024 * 1024, backupCount=5
+            )
+            handler.setFormatter(logging.Formatter("%(message)s"))
+            handler_logger.addHandler(handler)
+            self._handlers[path] = handler_logger
+        return handler_logger
+
+    def record(self, record, size, path=None):
+        """Rank ``record``, writing it to ``path`` if among the slowest."""
+        entry = (record["seconds"], next(self._counter), record)
+        with self._lock:
+            if len(self._heap) < size:
+                heapq.heappush(self._heap, entry)
+            elif entry[0] > self._heap[0][0]:
+                heapq.heapreplace(self._heap, entry)
+            else:
+                return False
+            if path:
+                try:
+                    self._get_file_logger(path).info(json.dumps(record))
+                except OSError:
+                    _logger.exception("Redsys: cannot write the profile to %s", path)
+        return True
+
+    def slowest(self):
+        with self._lock:
+            return [entry[2] for entry in sorted(self._heap, reverse=True)]
+
+    def clear(self):
+        with self._lock:
+            self._heap = []
+
+
+recorder = SlowestRecorder()
+
+
+def current():
+    return getattr(_local, "profile", None)
+
+
+@contextlib.contextmanager
+def profiled(name, cr, sample_rate, size=20, path=None):
+    """Profile the request ``name`` with a probability of ``sample_rate``."""
+    if not sample_rate or random.random() >= sample_rate or current() is not None:
+        yield None
+        return
+    profile = _local.profile = Profile(name, cr)
+    try:
+        yield profile
+    finally:
+        _local.profile = None
+        recorder.record(profile.to_dict(time.perf_counter() - profile.start), size, path)
+
+
+@contextlib.contextmanager
+def span(stage):
+    """Time ``stage`` of the request being profiled, if any."""
+    profile = current()
+    if profile is None:
+        yield
+        return
+    profile.enter(stage)
+    try:
+        yield
+    finally:
+        profile.exit()
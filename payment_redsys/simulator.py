@@ -0,0 +1,318 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Offline stand-in for the Redsys SIS, for load and integration testing.
+
+It serves the redirect form (``/sis/realizarPago``), answering with a
+redirection to Ds_Merchant_UrlOk/UrlKo and a signed notification to
+Ds_Merchant_MerchantURL, the REST endpoint (``/sis/rest/trataPeticionREST``)
+and the consultation web service (``/apl02/services/SerClsWSConsulta``),
+which answers the status queries with the last operation of their order and
+type. Requests and answers are signed with HMAC_SHA256_V1 using the secret key of
+the simulated merchant. The latency, the rate of SIS errors and declined
+payments and the throughput are configurable. Point an acquirer in test mode
+to it with the ``payment_redsys.simulator_url`` system parameter, or run it
+standalone, with only ``requests`` and ``pycryptodome`` installed::
+
+    python payment_redsys/simulator.py --port 8079 --secret-key <key>
+"""
+
+import argparse
+import base64
+import hmac
+import json
+import logging
+import random
+import threading
+import time
+import urllib
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+try:
+    from . import sis
+except ImportError:
+    # Run as a script, outside of the addon package and of Odoo
+    import sis
+
+_logger = logging.getLogger(__name__)
+
+FORM_PATH = "/sis/realizarPago"
+REST_PATH = "/sis/rest/trataPeticionREST"
+CONSULTATION_PATH = sis.CONSULTATION_PATH
+STATS_PATH = "/stats"
+
+
+class RedsysSimulatorHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def log_message(self, format, *args):
+        _logger.debug("Redsys simulator: " + format, *args)
+
+    def _read_body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length", 0)))
+
+    def _read_form(self):
+        body = self._read_body()
+        return {
+            key: values[0]
+            for key, values in urllib.parse.parse_qs(body.decode()).items()
+        }
+
+    def _reply(self, status, body=b"", content_type="application/json", headers=None):
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if self.path.split("?")[0] != STATS_PATH:
+            return self._reply(404)
+        self._reply(200, json.dumps(self.server.simulator.get_stats()).encode())
+
+    def do_POST(self):
+        simulator = self.server.simulator
+        path = self.path.split("?")[0].rstrip("/")
+        if path not in (FORM_PATH, REST_PATH, CONSULTATION_PATH):
+            return self._reply(404)
+        simulator.throttle()
+        if path == CONSULTATION_PATH:
+            answer = simulator.consult(self._read_body().decode())
+            return self._reply(200, answer.encode(), "text/xml; charset=utf-8")
+        answer, params = simulator.process(self._read_form(), path)
+        if path == REST_PATH:
+            return self._reply(200, json.dumps(answer).encode())
+        if "errorCode" in answer:
+            # The real SIS shows an error page to the customer
+            return self._reply(
+                200, ("<html>%s</html>" % answer["errorCode"]).encode(), "text/html"
+            )
+        simulator.notify(params.get("ds_merchant_merchanturl"), answer)
+        target = params.get(
+            "ds_merchant_urlok" if simulator.is_authorised(answer) else "ds_merchant_urlko"
+        )
+        if not target:
+            return self._reply(200, b"<html>OK</html>", "text/html")
+        location = "%s%s%s" % (
+            target,
+            "&" if "?" in target else "?",
+            urllib.parse.urlencode(answer),
+        )
+        self._reply(303, headers={"Location": location})
+
+
+class RedsysSimulator(object):
+    """Simulated SIS of a single merchant.
+
+    :param str secret_key: The secret key (base64) of the simulated merchant
+    :param float latency: The seconds every request takes at least
+    :param float jitter: The maximum random seconds added to ``latency``
+    :param float error_rate: The fraction of requests answered ``error_code``
+    :param str error_code: The SIS error code injected
+    :param float decline_rate: The fraction of payments answered ``decline_response``
+    :param str decline_response: The Ds_Response of the declined payments
+    :param float max_rate: The maximum requests per second served, 0 for unlimited
+    :param bool notify: Whether the redirect form notifies the merchant URL
+    :param int seed: Seed of the random outcomes, for reproducible runs
+    """
+
+    def __init__(self, secret_key, host="127.0.0.1", port=0, latency=0.0, jitter=0.0,
+                 error_rate=0.0, error_code="SIS0034", decline_rate=0.0,
+                 decline_response="0190", max_rate=0, notify=True, seed=None):
+        self.secret_key = secret_key
+        self.latency = latency
+        self.jitter = jitter
+        self.error_rate = error_rate
+        self.error_code = error_code
+        self.decline_rate = decline_rate
+        self.decline_response = decline_response
+        self.notify_merchant = notify
+        self.bucket = sis.TokenBucket(max_rate)
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._stats = dict.fromkeys(
+            ("requests", "authorised", "declined", "errors", "notifications", "queries"), 0
+        )
+        self._answers = {}
+        self._session = requests.Session()
+        self.server = ThreadingHTTPServer((host, port), RedsysSimulatorHandler)
+        self.server.daemon_threads = True
+        self.server.simulator = self
+        self._thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return "http://%s:%s" % (host, port)
+
+    def start(self):
+        self._thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+        self._session.close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
+
+    def _count(self, key):
+        with self._lock:
+            self._stats[key] += 1
+
+    def get_stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+    def throttle(self):
+        self.bucket.acquire()
+        delay = self.latency + (self._random.uniform(0, self.jitter) if self.jitter else 0)
+        if delay:
+            time.sleep(delay)
+
+    def _sign(self, params):
+        params64 = base64.b64encode(json.dumps(params).encode()).decode()
+        return {
+            "Ds_SignatureVersion": "HMAC_SHA256_V1",
+            "Ds_MerchantParameters": params64,
+            "Ds_Signature": sis.sign_parameters(
+                self.secret_key, params64, sis.get_order(params)
+            ),
+        }
+
+    def process(self, data, path):
+        """Return the answer to the request ``data`` and its decoded merchant
+        parameters, with lowercase keys as the SIS ignores their case.
+        """
+        self._count("requests")
+        try:
+            raw = json.loads(base64.b64decode(data.get("Ds_MerchantParameters", "")))
+        except ValueError:
+            self._count("errors")
+            return {"errorCode": "SIS0007"}, {}
+        params = {key.lower(): value for key, value in raw.items()}
+        order = str(params.get("ds_merchant_order", ""))
+        expected = sis.sign_parameters(
+            self.secret_key, data["Ds_MerchantParameters"], order
+        )
+        if not hmac.compare_digest(expected, data.get("Ds_Signature", "")):
+            self._count("errors")
+            return {"errorCode": "SIS0042"}, params
+        if self._random.random() < self.error_rate:
+            self._count("errors")
+            return {"errorCode": self.error_code}, params
+        declined = self._random.random() < self.decline_rate
+        self._count("declined" if declined else "authorised")
+        transaction_type = str(params.get("ds_merchant_transactiontype", "0"))
+        # Refunds and captures are answered 0900 instead of 0000
+        authorised = "0900" if transaction_type in ("2", "3") else "0000"
+        now = time.localtime()
+        answer = {
+            "Ds_Date": time.strftime("%d/%m/%Y", now),
+            "Ds_Hour": time.strftime("%H:%M", now),
+            "Ds_Amount": str(params.get("ds_merchant_amount", "")),
+            "Ds_Currency": str(params.get("ds_merchant_currency", "978")),
+            "Ds_Order": order,
+            "Ds_MerchantCode": str(params.get("ds_merchant_merchantcode", "")),
+            "Ds_Terminal": str(params.get("ds_merchant_terminal", "1")).zfill(3),
+            "Ds_Response": self.decline_response if declined else authorised,
+            "Ds_AuthorisationCode": "" if declined else "%06d" % self._random.randint(
+                0, 999999
+            ),
+            "Ds_TransactionType": transaction_type,
+            "Ds_SecurePayment": "0" if path == REST_PATH else "1",
+            "Ds_Language": "1",
+            "Ds_MerchantData": params.get("ds_merchant_merchantdata", ""),
+            "Ds_Card_Country": "724",
+        }
+        if params.get("ds_merchant_identifier") and not declined:
+            answer["Ds_Merchant_Identifier"] = (
+                uuid.uuid4().hex
+                if params["ds_merchant_identifier"] == "REQUIRED"
+                else params["ds_merchant_identifier"]
+            )
+            answer["Ds_Merchant_Cof_Txnid"] = "%015d" % self._random.randint(0, 10 ** 15)
+        with self._lock:
+            self._answers[order, transaction_type] = answer
+        return self._sign(answer), params
+
+    def consult(self, body):
+        """Return the answer of the consultation web service to the SOAP
+        request ``body``: the last operation of its order and type.
+        """
+        self._count("requests")
+        self._count("queries")
+        try:
+            transaction, version, signature = sis.parse_consultation(body)
+        except ValueError:
+            self._count("errors")
+            return sis.build_consultation_response(error_code="XML0001")
+        order = transaction.get("Ds_Order", "")
+        expected = sis.sign_parameters(self.secret_key, version, order)
+        if not hmac.compare_digest(expected, signature):
+            self._count("errors")
+            return sis.build_consultation_response(error_code="SIS0042")
+        if self._random.random() < self.error_rate:
+            self._count("errors")
+            return sis.build_consultation_response(error_code=self.error_code)
+        with self._lock:
+            answer = self._answers.get((order, transaction.get("Ds_TransactionType", "0")))
+        if answer is None:
+            return sis.build_consultation_response(error_code="XML0024")
+        return sis.build_consultation_response(dict(answer, Ds_State="F"))
+
+    def is_authorised(self, answer):
+        params = json.loads(base64.b64decode(answer["Ds_MerchantParameters"]))
+        return 0 <= int(params["Ds_Response"]) <= 100
+
+    def notify(self, url, answer):
+        """Post the signed ``answer`` to the merchant URL in the background, as
+        the SIS does while redirecting the customer.
+        """
+        if not (url and self.notify_merchant):
+            return
+
+        def post():
+            try:
+                self._session.post(url, data=answer, timeout=30)
+                self._count("notifications")
+            except requests.exceptions.RequestException:
+                _logger.exception("Redsys simulator: cannot notify %s", url)
+
+        threading.Thread(target=post, daemon=True).start()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split("\n\n")[0])
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8079)
+    parser.add_argument("--secret-key", required=True)
+    parser.add_argument("--latency", type=float, default=0.0)
+    parser.add_argument("--jitter", type=float, default=0.0)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--error-code", default="SIS0034")
+    parser.add_argument("--decline-rate", type=float, default=0.0)
+    parser.add_argument("--decline-response", default="0190")
+    parser.add_argument("--max-rate", type=float, default=0)
+    parser.add_argument("--no-notify", dest="notify", action="store_false")
+    parser.add_argument("--seed", type=int)
+    args = vars(parser.parse_args())
+    logging.basicConfig(level=logging.INFO)
+    simulator = RedsysSimulator(**args)
+    _logger.info("Redsys simulator listening on %s", simulator.url)
+    try:
+        simulator.server.serve_forever()
+    except KeyboardInterrupt:
+        simulator.server.server_close()
+
+
+if __name__ == "__main__":
+    main()
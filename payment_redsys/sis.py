@@ -0,0 +1,206 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+"""Pieces of the Redsys client the SIS simulator shares with the addon: the
+HMAC_SHA256_V1 signatures, the messages of the consultation web service and
+the rate limiting.
+
+They only need the standard library and pycryptodome, so that
+``simulator.py`` can run standalone, without Odoo.
+"""
+
+import base64
+import functools
+import hashlib
+import hmac
+import logging
+import threading
+import time
+import urllib
+from xml.etree import ElementTree
+from xml.sax.saxutils import escape
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from Crypto.Cipher import DES3
+except ImportError:
+    _logger.info("Missing dependency (pycryptodome). See README.")
+
+# Consultation web service (SerClsWSConsulta), queried with SOAP
+CONSULTATION_PATH = "/apl02/services/SerClsWSConsulta"
+CONSULTATION_HEADERS = {"Content-Type": "text/xml; charset=utf-8", "SOAPAction": ""}
+_SOAP_ENVELOPE = (
+    '<soapenv:Envelope xmlns:soapenv="http://schemas.xmlsoap.org/soap/envelope/" '
+    'xmlns:web="http://webservices.apl02.redsys.es">'
+    "<soapenv:Header/><soapenv:Body><web:{method}><{argument}>{value}</{argument}>"
+    "</web:{method}></soapenv:Body></soapenv:Envelope>"
+)
+
+
+@functools.lru_cache(maxsize=32)
+def _get_des3_key(secret_key):
+    """Return the 3DES key of ``secret_key``, decoded and parity-checked once.
+    CBC ciphers keep their chaining state, so a new one is built per order.
+    """
+    return DES3.adjust_key_parity(base64.b64decode(secret_key))
+
+
+@functools.lru_cache(maxsize=4096)
+def derive_order_key(secret_key, order):
+    """Return the per-order key, ``order`` 3DES-CBC-encrypted (zero IV) with
+    the secret.
+
+    Both the 3DES key and the derived keys are cached, keyed on the secret
+    itself, so a changed secret never hits stale entries.
+    """
+    diff_block = len(order) % 8
+    zeros = diff_block and "\0" * (8 - diff_block) or ""
+    cipher = DES3.new(_get_des3_key(secret_key), DES3.MODE_CBC, iv=b"\0" * 8)
+    return cipher.encrypt(str.encode(order + zeros))
+
+
+def clear_signing_cache():
+    _get_des3_key.cache_clear()
+    derive_order_key.cache_clear()
+
+
+def get_order(params_dic):
+    """Return the order number the signature of ``params_dic`` is bound to."""
+    if "Ds_Merchant_Order" in params_dic:
+        return str(params_dic["Ds_Merchant_Order"])
+    return str(urllib.parse.unquote(params_dic.get("Ds_Order", "Not found")))
+
+
+def sign_parameters(secret_key, params64, order):
+    """Return the HMAC_SHA256_V1 signature of ``params64`` for ``order``."""
+    if isinstance(params64, str):
+        params64 = params64.encode()
+    key = derive_order_key(secret_key, str(order))
+    dig = hmac.new(key=key, msg=params64, digestmod=hashlib.sha256).digest()
+    return base64.b64encode(dig).decode()
+
+
+def signatures_match(expected, signature):
+    """Compare two signatures in constant time."""
+    if not signature:
+        return False
+    if isinstance(signature, str):
+        signature = signature.encode()
+    return hmac.compare_digest(expected.encode(), signature)
+
+
+class TokenBucket(object):
+    """Thread-safe token bucket allowing ``rate`` operations per second, with
+    bursts of up to ``burst`` operations. A rate of 0 means unlimited.
+    """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self._tokens = self.burst
+        self._last = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """Wait until an operation is allowed, return the seconds waited."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last) * self.rate)
+            self._last = now
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.0
+        if wait:
+            time.sleep(wait)
+        return wait
+
+
+def _soap(method, argument, document):
+    return _SOAP_ENVELOPE.format(method=method, argument=argument, value=escape(document))
+
+
+def _parse_xml(text):
+    try:
+        return ElementTree.fromstring(text)
+    except ElementTree.ParseError as error:
+        raise ValueError("Invalid XML: %s" % error)
+
+
+def _soap_argument(body, argument):
+    """Return the XML document passed as ``argument`` in the SOAP ``body``."""
+    for element in _parse_xml(body).iter():
+        if element.tag.rsplit("}", 1)[-1] == argument:
+            return element.text or ""
+    raise ValueError("No %s in the SOAP message" % argument)
+
+
+def _fields(element):
+    return {child.tag: (child.text or "").strip() for child in element}
+
+
+def build_consultation(secret_key, order, merchant_code, terminal, transaction_type):
+    """Return the SOAP request asking the consultation web service for the
+    operations of type ``transaction_type`` on ``order``.
+
+    The ``Version`` element is signed with the key derived from the order,
+    as the payment requests are.
+    """
+    version = (
+        '<Version Ds_Version="0.0"><Message><Transaction>'
+        "<Ds_MerchantCode>%s</Ds_MerchantCode><Ds_Terminal>%s</Ds_Terminal>"
+        "<Ds_Order>%s</Ds_Order><Ds_TransactionType>%s</Ds_TransactionType>"
+        "</Transaction></Message></Version>"
+    ) % tuple(
+        escape(str(value)) for value in (merchant_code, terminal, order, transaction_type)
+    )
+    messages = (
+        "<Messages>%s<Signature>%s</Signature>"
+        "<SignatureVersion>HMAC_SHA256_V1</SignatureVersion></Messages>"
+    ) % (version, sign_parameters(secret_key, version, order))
+    return _soap("consultaOperaciones", "cadenaXML", messages)
+
+
+def parse_consultation(body):
+    """Return the fields of the ``Transaction`` of a consultation request, its
+    signed ``Version`` element as sent and the signature.
+    """
+    messages = _soap_argument(body, "cadenaXML")
+    root = _parse_xml(messages)
+    transaction = root.find("Version/Message/Transaction")
+    start, end = messages.find("<Version"), messages.find("</Version>")
+    if start < 0 or end < 0 or transaction is None:
+        raise ValueError("No transaction in the consultation")
+    version = messages[start:end + len("</Version>")]
+    return _fields(transaction), version, root.findtext("Signature", "")
+
+
+def build_consultation_response(params=None, error_code=None):
+    """Return the answer of the consultation web service, the operation
+    ``params`` or the SIS error ``error_code``.
+    """
+    if error_code:
+        message = "<ErrorMsg><Ds_ErrorCode>%s</Ds_ErrorCode></ErrorMsg>" % escape(error_code)
+    else:
+        message = '<Response Ds_Version="0.0">%s</Response>' % "".join(
+            "<%s>%s</%s>" % (key, escape(str(value)), key) for key, value in params.items()
+        )
+    return _soap(
+        "consultaOperacionesResponse",
+        "consultaOperacionesReturn",
+        '<Messages><Version Ds_Version="0.0"><Message>%s</Message></Version></Messages>'
+        % message,
+    )
+
+
+def parse_consultation_response(body):
+    """Return the fields of the operation found by a consultation, or
+    ``{"errorCode": code}`` if the SIS answered an error, as the REST answers.
+    """
+    messages = _parse_xml(_soap_argument(body, "consultaOperacionesReturn"))
+    response = messages.find(".//Response")
+    if response is not None:
+        return _fields(response)
+    error_code = messages.findtext(".//Ds_ErrorCode")
+    if not error_code:
+        raise ValueError("Neither operation nor error in the consultation answer")
+    return {"errorCode": error_code.strip()}
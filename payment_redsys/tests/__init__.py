@@ -1 +1,2 @@
 from . import test_redsys
+from . import test_redsys_benchmark
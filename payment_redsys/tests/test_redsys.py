@@ -1,14 +1,26 @@
 # Copyright 2016-2017 Tecnativa - Sergio Teruel
 # License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
 
+import io
 import json
 import logging
+import os
+import tempfile
+import urllib
 
+import requests
 from lxml import objectify
 from mock import patch
+from psycopg2 import IntegrityError
 
 from odoo import http
 from odoo.tests.common import HttpCase
+from odoo.tools import mute_logger
+
+from odoo.addons.payment_redsys import metrics as redsys_metrics
+from odoo.addons.payment_redsys import profiler as redsys_profiler
+from odoo.addons.payment_redsys import simulator as redsys_simulator
+from odoo.addons.payment_redsys import utils as redsys_utils
 
 _logger = logging.getLogger(__name__)
 
@@ -93,6 +105,7 @@ class RedsysCase(HttpCase):
             "partner_id": self.buyer_id,
         }
         self.tx = self.env["payment.transaction"].create(self.vals_tx)
+        self.redsys_ds_parameters["Ds_Order"] = self.tx.redsys_order
         self.partner = self.env["res.partner"].create({"name": "Partner Test"})
         self.product = self.env["product.product"].create(
             {"name": "Test Product", "list_price": 100.50}
@@ -161,7 +174,9 @@ class RedsysCase(HttpCase):
                 continue
             if form_input.get("name") == "Ds_MerchantParameters":
                 DS_parameters = self.redsys._url_decode64(form_input.get("value"))
-                self.assertEqual(DS_parameters["Ds_Merchant_Order"], "TST0001")
+                self.assertEqual(
+                    DS_parameters["Ds_Merchant_Order"], self.tx.redsys_order
+                )
                 self.assertEqual(
                     DS_parameters["Ds_Merchant_MerchantUrl"],
                     "%s/payment/redsys/return" % base_url,
@@ -332,3 +347,775 @@ class RedsysCase(HttpCase):
         )
         res = self.data_post_redsys(url="/payment/redsys/return")
         self.assertGreater(res.url.find("/shop"), 0, "Redsys: Redirection to /shop")
+
+    def test_92_redsys_pooled_session(self):
+        session = self.redsys._get_redsys_session()
+        self.assertIs(session, self.redsys._get_redsys_session())
+        with patch.object(type(session), "post") as mock_post:
+            mock_post.return_value.content = b'{"errorCode": "SIS0051"}'
+            response = self.redsys._redsys_make_request({"Ds_Signature": "x"})
+        self.assertEqual(response, {"errorCode": "SIS0051"})
+        mock_post.assert_called_once_with(
+            self.redsys._get_redsys_url_s2s(),
+            data={"Ds_Signature": "x"},
+            timeout=(5.0, 30.0),
+        )
+
+    def test_93_redsys_batch_charge(self):
+        token = self.env["payment.token"].create(
+            {
+                "name": "XXXX-1234",
+                "partner_id": self.buyer_id,
+                "acquirer_id": self.redsys.id,
+                "acquirer_ref": "TOKEN",
+            }
+        )
+        self.tx.write({"token_id": token.id, "operation": "offline"})
+        DS_parameters = self.redsys._url_encode64(json.dumps(self.redsys_ds_parameters))
+        answer = {
+            "Ds_SignatureVersion": "HMAC_SHA256_V1",
+            "Ds_MerchantParameters": DS_parameters.decode(),
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+        }
+        with patch("requests.Session.post") as mock_post:
+            mock_post.return_value.content = json.dumps(answer).encode()
+            stats = self.tx._redsys_send_payment_requests_batch(concurrency=2)
+        self.assertEqual(stats["count"], 1)
+        self.assertEqual(stats["done"], 1)
+        self.assertEqual(self.tx.state, "done")
+        self.assertIn("p95", stats["latency"])
+
+    def test_94_redsys_get_tx_by_order(self):
+        self.tx.sale_order_ids = [(6, 0, self.so.ids)]
+        tx, acquirer, sale_orders = self.env[
+            "payment.transaction"
+        ]._redsys_get_tx_by_order(self.tx.redsys_order)
+        self.assertEqual(tx, self.tx)
+        self.assertEqual(acquirer, self.redsys)
+        self.assertEqual(sale_orders, self.so)
+
+    def test_95_redsys_async_notification(self):
+        self.env["ir.config_parameter"].set_param(
+            "payment_redsys.async_notifications", "1"
+        )
+        DS_parameters = self.redsys._url_encode64(json.dumps(self.redsys_ds_parameters))
+        redsys_post_data = {
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+            "Ds_MerchantParameters": DS_parameters.decode(),
+            "Ds_SignatureVersion": u"HMAC_SHA256_V1",
+        }
+        queue = self.env["payment.redsys.notification"]
+        self.assertTrue(queue._is_async_enabled())
+        notification = queue._enqueue(redsys_post_data)
+        self.assertEqual(notification.transaction_id, self.tx)
+        self.assertEqual(self.tx.state, "draft")
+        self.assertEqual(queue._get_queue_metrics()["depth"], 1)
+        queue._cron_process_notifications(auto_commit=False)
+        self.assertEqual(notification.state, "done")
+        self.assertEqual(self.tx.state, "done")
+        self.assertEqual(queue._get_queue_metrics()["depth"], 0)
+
+    def test_96_redsys_duplicate_notification(self):
+        DS_parameters = self.redsys._url_encode64(json.dumps(self.redsys_ds_parameters))
+        redsys_post_data = {
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+            "Ds_MerchantParameters": DS_parameters.decode(),
+            "Ds_SignatureVersion": u"HMAC_SHA256_V1",
+        }
+        queue = self.env["payment.redsys.notification"]
+        self.assertFalse(queue._is_duplicate(redsys_post_data))
+        self.assertTrue(queue._receive(redsys_post_data))
+        self.assertEqual(self.tx.state, "done")
+        self.env.cr.postcommit.run()
+        duplicates = queue._get_queue_metrics()["duplicates"]
+        with patch.object(
+            type(self.env["payment.transaction"]), "_handle_feedback_data"
+        ) as mock_handle:
+            self.assertFalse(queue._receive(redsys_post_data))
+            mock_handle.assert_not_called()
+        self.assertTrue(queue._is_duplicate(redsys_post_data))
+        self.assertEqual(queue._get_queue_metrics()["duplicates"], duplicates + 2)
+
+    def test_97_redsys_trace_is_lazy(self):
+        logger = logging.getLogger("odoo.addons.payment_redsys.models.redsys")
+        level = logger.level
+        logger.setLevel(logging.WARNING)
+        try:
+            with patch.object(redsys_utils, "redact") as mock_redact, patch.object(
+                redsys_utils.pprint, "pformat"
+            ) as mock_pformat:
+                for _i in range(1000):
+                    self.redsys._redsys_trace("notification", {"Ds_Signature": "x"})
+            mock_redact.assert_not_called()
+            mock_pformat.assert_not_called()
+        finally:
+            logger.setLevel(level)
+        self.assertEqual(
+            redsys_utils.redact({"Ds_Signature": "x", "Ds_Order": "TST0001"}),
+            {"Ds_Signature": "***", "Ds_Order": "TST0001"},
+        )
+
+    def test_98_redsys_endpoints_cache(self):
+        base_url = self.env["ir.config_parameter"].get_param("web.base.url")
+        endpoints = self.redsys._get_redsys_endpoints()
+        self.assertEqual(endpoints["form_url"], self.redsys.redsys_get_form_action_url())
+        self.assertEqual(endpoints["s2s_url"], self.redsys._get_redsys_url_s2s())
+        self.assertEqual(
+            endpoints["merchant_url"], "%s/payment/redsys/return" % base_url
+        )
+        with self.assertQueryCount(0):
+            self.redsys._get_redsys_endpoints()
+        self.env["ir.config_parameter"].set_param(
+            "payment_redsys.callback_url", "https://callback.example.com"
+        )
+        self.assertEqual(
+            self.redsys._get_redsys_endpoints()["url_ok"],
+            "https://callback.example.com/payment/redsys/result/redsys_result_ok",
+        )
+
+    def test_99_redsys_product_description(self):
+        self.so.write(
+            {
+                "order_line": [
+                    (0, 0, {"name": "Line %s" % i, "product_id": self.product.id})
+                    for i in range(200)
+                ]
+            }
+        )
+        self.tx.sale_order_ids = [(6, 0, self.so.ids)]
+        expected = "|".join(self.so.order_line.mapped("name"))[:125]
+        descriptions = self.redsys._get_redsys_product_descriptions(
+            ["TST0001", self.so.name, "UNKNOWN"]
+        )
+        self.assertEqual(descriptions["TST0001"], expected)
+        self.assertEqual(descriptions[self.so.name], expected)
+        self.assertNotIn("UNKNOWN", descriptions)
+        self.assertEqual(self.redsys._product_description("TST0001"), expected)
+
+    def test_100_redsys_notification_parsed_once(self):
+        DS_parameters = self.redsys._url_encode64(json.dumps(self.redsys_ds_parameters))
+        redsys_post_data = {
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+            "Ds_MerchantParameters": DS_parameters.decode(),
+            "Ds_SignatureVersion": u"HMAC_SHA256_V1",
+        }
+        notification = redsys_utils.parse_notification(redsys_post_data)
+        self.assertEqual(notification.order, self.tx.redsys_order)
+        self.assertEqual(notification.authorisation_code, "999999")
+        with patch.object(
+            redsys_utils.ParsedNotification, "__init__", side_effect=AssertionError
+        ):
+            self.env["payment.transaction"]._handle_feedback_data(
+                "redsys", redsys_post_data
+            )
+        self.assertEqual(self.tx.state, "done")
+
+    def test_101_redsys_feedback_batch(self):
+        tx2 = self.env["payment.transaction"].create(
+            dict(self.vals_tx, reference="TST0002")
+        )
+        items = []
+        for tx, response in ((self.tx, "0000"), (tx2, "9065")):
+            params = dict(self.redsys_ds_parameters, Ds_Order=tx.redsys_order)
+            params["Ds_Response"] = response
+            items.append(
+                (
+                    tx,
+                    {
+                        "Ds_MerchantParameters": self.redsys._url_encode64(
+                            json.dumps(params)
+                        ).decode()
+                    },
+                )
+            )
+        broken = self.redsys._url_encode64(json.dumps({"Ds_Response": "broken"}))
+        items.append((tx2, {"Ds_MerchantParameters": broken.decode()}))
+        with patch.object(type(self.env.cr), "commit") as mock_commit:
+            failures = self.env["payment.transaction"]._redsys_process_feedback_batch(
+                items
+            )
+            mock_commit.assert_not_called()
+        self.assertEqual(len(failures), 1)
+        self.assertEqual(self.tx.state, "done")
+        self.assertEqual(self.tx.state_message, "Ok: 0000")
+        self.assertEqual(tx2.state, "cancel")
+
+    def test_102_redsys_response_classification(self):
+        tx_model = self.env["payment.transaction"]
+        self.assertEqual(tx_model._get_redsys_state(0), "done")
+        self.assertEqual(tx_model._get_redsys_state(101), "pending")
+        self.assertEqual(tx_model._get_redsys_state(9065), "cancel")
+        self.assertEqual(tx_model._get_redsys_state(300), "error")
+        self.assertEqual(tx_model._get_redsys_state(900), "done")
+        self.assertTrue(redsys_utils.classify_response(116).retryable)
+        self.assertFalse(redsys_utils.classify_response(101).retryable)
+        result = redsys_utils.classify_response(9065, "SIS0051")
+        self.assertEqual(result.state, "cancel")
+        self.assertEqual(result.reason, "Duplicated order number")
+        error_tx = dict(self.redsys_ds_parameters, Ds_Response="0116")
+        self.tx._process_feedback_data(
+            {
+                "Ds_MerchantParameters": self.redsys._url_encode64(
+                    json.dumps(error_tx)
+                ).decode()
+            }
+        )
+        self.assertEqual(self.tx.redsys_response_code, 116)
+        self.assertTrue(self.tx.redsys_retryable)
+        self.assertEqual(self.tx.redsys_reason, "Insufficient funds")
+
+    def test_103_redsys_charge_retry(self):
+        token = self.env["payment.token"].create(
+            {
+                "name": "XXXX-1234",
+                "partner_id": self.buyer_id,
+                "acquirer_id": self.redsys.id,
+                "acquirer_ref": "TOKEN",
+            }
+        )
+        self.tx.write({"token_id": token.id, "operation": "offline"})
+        Retry = self.env["payment.redsys.retry"]
+        self.tx._redsys_handle_charge_failure("SIS0051")
+        self.assertFalse(self.tx.redsys_retryable)
+        self.assertEqual(self.tx.state, "error")
+        self.assertFalse(Retry.search([("transaction_id", "=", self.tx.id)]))
+        self.tx._redsys_handle_charge_failure("SIS0034")
+        retry = Retry.search([("transaction_id", "=", self.tx.id)])
+        self.assertEqual(retry.attempt, 1)
+        self.assertEqual(retry.reason, "Database access error")
+        # The first retry waits between half and the whole base delay, plus
+        # the spreading window
+        delay = (retry.next_attempt - retry.create_date).total_seconds()
+        self.assertTrue(1800 - 1 <= delay <= 3600 + 900 + 60)
+        self.assertFalse(Retry._get_due_retries())
+        retry.next_attempt = retry.create_date
+        with patch("requests.Session.post") as mock_post:
+            mock_post.return_value.content = b'{"errorCode": "SIS0034"}'
+            stats = Retry._cron_process_retries(auto_commit=False)
+        self.assertEqual(stats["failed"], 1)
+        self.assertEqual(retry.state, "sent")
+        child = retry.retry_transaction_id
+        self.assertNotEqual(child.redsys_order, self.tx.redsys_order)
+        self.assertEqual(child.token_id, token)
+        self.assertEqual(
+            Retry.search([("transaction_id", "=", child.id)]).attempt, 2
+        )
+        for attempt in range(1, 8):
+            delay = redsys_utils.retry_delay(attempt, 1, window=0)
+            self.assertTrue(min(86400, 3600 * 2 ** attempt) / 2 <= delay <= 86400)
+
+    def test_104_redsys_simulator(self):
+        simulator = redsys_simulator.RedsysSimulator(
+            self.redsys.redsys_secret_key, notify=False
+        ).start()
+        self.addCleanup(simulator.stop)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "payment_redsys.simulator_url", simulator.url
+        )
+        self.assertTrue(self.redsys._get_redsys_url_s2s().startswith(simulator.url))
+        values = self.redsys.redsys_form_generate_values(dict(self.vals_tx))
+        self.assertTrue(values["api_url"].startswith(simulator.url))
+        response = requests.post(
+            values["api_url"],
+            data={
+                key: values[key]
+                for key in (
+                    "Ds_SignatureVersion",
+                    "Ds_MerchantParameters",
+                    "Ds_Signature",
+                )
+            },
+            allow_redirects=False,
+        )
+        self.assertEqual(response.status_code, 303)
+        location = urllib.parse.urlsplit(response.headers["Location"])
+        self.assertEqual(location.path, "/payment/redsys/result/redsys_result_ok")
+        answer = dict(urllib.parse.parse_qsl(location.query))
+        self.env["payment.transaction"]._handle_feedback_data("redsys", answer)
+        self.assertEqual(self.tx.state, "done")
+        token = self.env["payment.token"].create(
+            {
+                "name": "XXXX-1234",
+                "partner_id": self.buyer_id,
+                "acquirer_id": self.redsys.id,
+                "acquirer_ref": "TOKEN",
+            }
+        )
+        tx2 = self.env["payment.transaction"].create(
+            dict(self.vals_tx, reference="TST0002", token_id=token.id)
+        )
+        simulator.error_rate = 1.0
+        tx2._send_payment_request()
+        self.assertEqual(tx2.redsys_error_code, "SIS0034")
+        simulator.error_rate = 0.0
+        tx2._send_payment_request()
+        self.assertEqual(tx2.state, "done")
+        self.assertEqual(simulator.get_stats()["requests"], 3)
+
+    def test_105_redsys_metrics(self):
+        response = self.url_open("/payment/redsys/metrics")
+        self.assertEqual(response.status_code, 404)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "payment_redsys.metrics_token", "s3cr3t"
+        )
+        response = self.url_open(
+            "/payment/redsys/metrics", headers={"Authorization": "Bearer wrong"}
+        )
+        self.assertEqual(response.status_code, 401)
+        signed = redsys_metrics.signatures.value()
+        self.redsys.redsys_form_generate_values(dict(self.vals_tx))
+        self.assertEqual(redsys_metrics.signatures.value(), signed + 1)
+        response = self.url_open(
+            "/payment/redsys/metrics", headers={"Authorization": "Bearer s3cr3t"}
+        )
+        self.assertEqual(response.status_code, 200)
+        self.assertIn("redsys_sign_seconds_count", response.text)
+        self.assertIn("redsys_form_render_seconds_bucket", response.text)
+        self.assertIn("redsys_queue_depth", response.text)
+
+    def test_106_redsys_profiling(self):
+        DS_parameters = self.redsys._url_encode64(json.dumps(self.redsys_ds_parameters))
+        redsys_post_data = {
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+            "Ds_MerchantParameters": DS_parameters.decode(),
+            "Ds_SignatureVersion": u"HMAC_SHA256_V1",
+        }
+        redsys_profiler.recorder.clear()
+        with self.redsys._redsys_profiled("disabled") as profile:
+            self.assertIsNone(profile)
+        path = os.path.join(tempfile.mkdtemp(), "profile.log")
+        config = self.env["ir.config_parameter"].sudo()
+        config.set_param("payment_redsys.profile_sample_rate", "1")
+        config.set_param("payment_redsys.profile_file", path)
+        with self.redsys._redsys_profiled("/payment/redsys/return"):
+            with redsys_profiler.span("receive"):
+                self.env["payment.redsys.notification"]._receive(redsys_post_data)
+        self.assertEqual(self.tx.state, "done")
+        record = redsys_profiler.recorder.slowest()[0]
+        self.assertEqual(record["name"], "/payment/redsys/return")
+        stages = {span["stage"]: span for span in record["stages"]}
+        self.assertIn("receive/enqueue/lookup", stages)
+        self.assertIn("receive/feedback", stages)
+        self.assertGreater(stages["receive"]["queries"], 0)
+        with open(path) as profile_file:
+            self.assertEqual(json.loads(profile_file.readline())["name"], record["name"])
+
+    @patch("odoo.addons.sale.models.sale.SaleOrder.action_confirm")
+    def test_107_redsys_deferred_order_jobs(self, mock_confirm):
+        self.env["ir.config_parameter"].sudo().set_param(
+            "payment_redsys.deferred_order_jobs", "1"
+        )
+        self.redsys.redsys_percent_partial = 50
+        params = dict(self.redsys_ds_parameters, Ds_Amount="5025")
+        DS_parameters = self.redsys._url_encode64(json.dumps(params))
+        redsys_post_data = {
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+            "Ds_MerchantParameters": DS_parameters,
+            "Ds_SignatureVersion": u"HMAC_SHA256_V1",
+        }
+        self.tx.sale_order_ids = [(6, 0, self.so.ids)]
+        self._form_feedback(redsys_post_data)
+        self.assertEqual(self.tx.state, "done")
+        mock_confirm.assert_not_called()
+        jobs = self.env["payment.redsys.order.job"].search(
+            [("transaction_id", "=", self.tx.id)]
+        )
+        self.assertEqual(jobs.sale_order_id, self.so)
+        self.assertEqual(jobs.action, "confirm")
+        # A second delivery of the notification does not queue the job again
+        self.env["payment.redsys.order.job"]._run_or_enqueue(self.tx, "confirm")
+        self.assertEqual(
+            self.env["payment.redsys.order.job"].search_count(
+                [("sale_order_id", "=", self.so.id)]
+            ),
+            1,
+        )
+        self.env["payment.redsys.order.job"]._cron_process_jobs(auto_commit=False)
+        mock_confirm.assert_called_once_with()
+        self.assertEqual(jobs.state, "done")
+
+    def test_108_redsys_config_snapshot_and_routing(self):
+        config = self.redsys._get_redsys_config()
+        self.assertIs(config, self.redsys._get_redsys_config())
+        self.assertEqual(config.merchant_code, "069611024")
+        self.assertEqual(config.currency, "978")
+        self.redsys.redsys_merchant_name = "A merchant name longer than 25 chars"
+        config = self.redsys._get_redsys_config()
+        self.assertEqual(config.merchant_name, "A merchant name longer th")
+        acquirer_usd = self.redsys.copy({"redsys_currency": "840", "state": "test"})
+        acquirers = self.redsys | acquirer_usd
+        self.assertEqual(
+            acquirers._redsys_route(currency_id=self.env.ref("base.USD").id),
+            acquirer_usd,
+        )
+        self.assertEqual(
+            acquirers._redsys_route(currency_id=self.currency_euro.id), self.redsys
+        )
+        # No terminal in that currency, none is discarded
+        self.assertEqual(
+            acquirers._redsys_route(currency_id=self.env.ref("base.CHF").id), acquirers
+        )
+        website = self.env["website"].create({"name": "Second shop"})
+        acquirer_web = self.redsys.copy({"website_id": website.id, "state": "test"})
+        acquirers |= acquirer_web
+        self.assertEqual(
+            acquirers._redsys_route(
+                website_id=website.id, currency_id=self.currency_euro.id
+            ),
+            acquirer_web,
+        )
+
+    def test_109_redsys_verify_signatures(self):
+        pairs = []
+        for index in range(5):
+            params = dict(self.redsys_ds_parameters, Ds_Order="TST%04d" % index)
+            params64 = self.redsys._url_encode64(json.dumps(params)).decode()
+            pairs.append(
+                (
+                    params64,
+                    self.redsys.sign_parameters(self.redsys.redsys_secret_key, params64),
+                )
+            )
+        pairs.append((pairs[0][0], pairs[1][1]))
+        pairs.append((pairs[0][0], "é"))
+        pairs.append(("not base64", "x"))
+        other_merchant = dict(self.redsys_ds_parameters, Ds_MerchantCode="999999999")
+        params64 = self.redsys._url_encode64(json.dumps(other_merchant)).decode()
+        pairs.append(
+            (params64, self.redsys.sign_parameters(self.redsys.redsys_secret_key, params64))
+        )
+        results = list(self.redsys.redsys_verify_signatures(iter(pairs), chunk_size=2))
+        self.assertEqual(results, [True] * 5 + [False] * 4)
+        self.assertTrue(redsys_utils.signatures_match("abc", b"abc"))
+        self.assertFalse(redsys_utils.signatures_match("abc", None))
+
+    def test_110_redsys_presigned_form(self):
+        tx = self.env["payment.transaction"].create(
+            dict(self.vals_tx, reference="TST0002", operation="online_redirect")
+        )
+        self.assertTrue(tx.redsys_signature)
+        values = tx._get_specific_rendering_values({"reference": tx.reference})
+        self.assertEqual(
+            set(values),
+            {
+                "api_url",
+                "return_url",
+                "Ds_SignatureVersion",
+                "Ds_MerchantParameters",
+                "Ds_Signature",
+            },
+        )
+        self.assertEqual(values["Ds_Signature"], tx.redsys_signature)
+        params = self.redsys._url_decode64(values["Ds_MerchantParameters"])
+        self.assertEqual(params["Ds_Merchant_Order"], tx.redsys_order)
+        self.assertEqual(params["Ds_Merchant_Amount"], "10050")
+        self.assertEqual(params["Ds_Merchant_Titular"], self.buyer.display_name)
+        tx.amount = 20
+        self.assertFalse(tx.redsys_signature)
+        values = tx._get_specific_rendering_values({"reference": tx.reference})
+        params = self.redsys._url_decode64(values["Ds_MerchantParameters"])
+        self.assertEqual(params["Ds_Merchant_Amount"], "2000")
+        # Changing the terminal drops the forms signed with the former one
+        self.assertTrue(tx.redsys_signature)
+        self.redsys.redsys_terminal = "2"
+        self.assertFalse(tx.redsys_signature)
+        values = tx._get_specific_rendering_values({"reference": tx.reference})
+        params = self.redsys._url_decode64(values["Ds_MerchantParameters"])
+        self.assertEqual(params["Ds_Merchant_Terminal"], "2")
+        rendered = redsys_metrics.form_html.value()
+        self.redsys._get_redirect_form_view()._render(values, engine="ir.qweb")
+        self.assertEqual(redsys_metrics.form_html.value(), rendered + 1)
+
+    def test_111_redsys_reconciliation_import(self):
+        tx2 = self.env["payment.transaction"].create(
+            dict(self.vals_tx, reference="TST0002", amount=20)
+        )
+        export = "\n".join(
+            [
+                "Consulta de operaciones",
+                "",
+                "Fecha;Tipo operación;Número de pedido;Importe;Moneda",
+                "17/10/2026;Autorización;%s;100,50;EUR" % self.tx.redsys_order,
+                "17/10/2026;Autorización;%s;19,00;EUR" % tx2.redsys_order,
+                "17/10/2026;Devolución;%s;20,00;EUR" % tx2.redsys_order,
+                "18/10/2026;Autorización;UNKNOWN0001;5,00;EUR",
+                "18/10/2026;Autorización;%s;n/a;EUR" % self.tx.redsys_order,
+            ]
+        )
+        stats = self.env["payment.transaction"]._redsys_import_reconciliation(
+            io.BytesIO(export.encode()), chunk_size=2
+        )
+        self.assertEqual(
+            {key: value for key, value in stats.items() if key != "elapsed"},
+            {"rows": 4, "matched": 1, "amount_mismatch": 1, "unknown": 1, "invalid": 1},
+        )
+        self.assertEqual(self.tx.redsys_reconciliation_state, "matched")
+        self.assertEqual(str(self.tx.redsys_settlement_date), "2026-10-17")
+        self.assertEqual(tx2.redsys_reconciliation_state, "amount_mismatch")
+        self.assertEqual(tx2.redsys_settled_amount, 19.0)
+        # The partial payment percentage is deducted, as for the notifications
+        self.redsys.redsys_percent_partial = 50
+        export = "Ds_Order,Ds_Amount\n%s,5025\n" % self.tx.redsys_order
+        with tempfile.NamedTemporaryFile(suffix=".csv") as export_file:
+            export_file.write(export.encode())
+            export_file.flush()
+            stats = self.env["payment.transaction"]._redsys_import_reconciliation(
+                export_file.name
+            )
+        self.assertEqual(stats["matched"], 1)
+        self.assertEqual(self.tx.redsys_settled_amount, 50.25)
+
+    def test_112_redsys_status_query(self):
+        simulator = redsys_simulator.RedsysSimulator(
+            self.redsys.redsys_secret_key, notify=False
+        ).start()
+        self.addCleanup(simulator.stop)
+        config = self.env["ir.config_parameter"].sudo()
+        config.set_param("payment_redsys.simulator_url", simulator.url)
+        config.set_param("payment_redsys.status_query_delay", "0")
+        # The customer pays, but the notification never arrives
+        values = self.redsys.redsys_form_generate_values(dict(self.vals_tx))
+        response = requests.post(
+            values["api_url"],
+            data={
+                key: values[key]
+                for key in ("Ds_SignatureVersion", "Ds_MerchantParameters", "Ds_Signature")
+            },
+            allow_redirects=False,
+        )
+        self.assertEqual(response.status_code, 303)
+        lost, abandoned = self.env["payment.transaction"].create(
+            [dict(self.vals_tx, reference=reference) for reference in ("TST0002", "TST0003")]
+        )
+        for tx in self.tx | lost:
+            tx._get_specific_rendering_values({"reference": tx.reference})
+        Tx = self.env["payment.transaction"]
+        # The customer of the abandoned one never reached the payment form
+        domain = Tx._redsys_get_stale_domain() + [
+            ("id", "in", (self.tx | lost | abandoned).ids)
+        ]
+        stale = Tx.search(domain)
+        self.assertEqual(stale, self.tx | lost)
+        stats = stale._redsys_query_status_batch(rate=0)
+        self.assertEqual(stats["done"], 1)
+        self.assertEqual(stats["failures"], [("TST0002", "XML0024")])
+        self.assertEqual(self.tx.state, "done")
+        self.assertEqual(lost.state, "draft")
+        self.assertTrue(lost.redsys_last_query)
+        self.assertEqual(simulator.get_stats()["queries"], 2)
+        # The queries did not start any payment
+        self.assertEqual(simulator.get_stats()["authorised"], 1)
+        # Queried recently, they are left alone until the next interval
+        domain = Tx._redsys_get_stale_domain() + [("id", "in", (self.tx | lost).ids)]
+        self.assertFalse(Tx.search(domain))
+
+    def test_113_redsys_order_number(self):
+        Tx = self.env["payment.transaction"]
+        # Same last 12 characters, which used to be the order number
+        txs = Tx.create(
+            [
+                dict(self.vals_tx, reference="%s-S0000012345-1" % prefix)
+                for prefix in ("A", "B", "C")
+            ]
+        )
+        orders = txs.mapped("redsys_order") + [self.tx.redsys_order]
+        self.assertEqual(len(set(orders)), 4)
+        for order in orders:
+            self.assertRegex(order, r"^[0-9]{12}$")
+        values = self.redsys.redsys_form_generate_values(
+            dict(self.vals_tx, reference=txs[0].reference)
+        )
+        params = self.redsys._url_decode64(values["Ds_MerchantParameters"])
+        self.assertEqual(params["Ds_Merchant_Order"], txs[0].redsys_order)
+        self.assertEqual(Tx._redsys_get_tx_by_order(txs[1].redsys_order)[0], txs[1])
+        with self.assertRaises(IntegrityError), mute_logger("odoo.sql_db"):
+            with self.cr.savepoint():
+                txs[2].write({"redsys_order": txs[1].redsys_order})
+                txs.flush()
+
+    def test_114_redsys_refund_and_capture(self):
+        simulator = redsys_simulator.RedsysSimulator(
+            self.redsys.redsys_secret_key, notify=False
+        ).start()
+        self.addCleanup(simulator.stop)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "payment_redsys.simulator_url", simulator.url
+        )
+        Tx = self.env["payment.transaction"]
+        self.tx._set_done()
+        refund_tx = self.tx._send_refund_request(amount_to_refund=40)
+        self.assertEqual(refund_tx.operation, "refund")
+        self.assertFalse(refund_tx.redsys_order)
+        self.assertEqual(refund_tx.state, "done")
+        # Notified on the order of the payment, a refund leaves the payment as it is
+        answer = dict(self.redsys_ds_parameters, Ds_Response="0900", Ds_TransactionType="3")
+        self.assertIsNone(self.tx._redsys_get_feedback_state(answer)[0])
+        self.assertEqual(refund_tx._redsys_get_feedback_state(answer)[0], "done")
+        self.tx._process_feedback_data(
+            {
+                "Ds_MerchantParameters": self.redsys._url_encode64(
+                    json.dumps(answer)
+                ).decode()
+            }
+        )
+        self.assertEqual(self.tx.state, "done")
+        self.assertEqual(self.tx.redsys_response_code, 0)
+        # A cancelled pre-authorisation releases the money
+        self.assertEqual(Tx._get_redsys_state(400), "cancel")
+        params = self.redsys._url_decode64(
+            refund_tx._redsys_prepare_operation_values()["Ds_MerchantParameters"]
+        )
+        self.assertEqual(params["DS_MERCHANT_ORDER"], self.tx.redsys_order)
+        self.assertEqual(params["DS_MERCHANT_TRANSACTIONTYPE"], "3")
+        self.assertEqual(params["DS_MERCHANT_AMOUNT"], "4000")
+        # Batch of refunds, one of them refused by the SIS
+        txs = Tx.create(
+            [dict(self.vals_tx, reference="TST%04d" % index) for index in range(2, 5)]
+        )
+        txs._set_done()
+        stats = txs[:2]._redsys_refund_batch({txs[0].id: 10}, concurrency=2)
+        self.assertEqual(stats["done"], 2)
+        self.assertEqual(set(stats["results"].values()), {"done"})
+        refunds = Tx.search([("source_transaction_id", "in", txs.ids)])
+        self.assertEqual(
+            refunds.filtered(lambda t: t.source_transaction_id == txs[0]).amount, -10
+        )
+        simulator.error_rate = 1.0
+        stats = txs[2:]._redsys_refund_batch()
+        self.assertEqual(stats["failed"], 1)
+        refund_tx = Tx.search([("source_transaction_id", "=", txs[2].id)])
+        self.assertEqual(refund_tx.state, "error")
+        self.assertEqual(refund_tx.redsys_error_code, "SIS0034")
+        simulator.error_rate = 0.0
+        # Pre-authorisation and capture
+        self.redsys.capture_manually = True
+        self.assertTrue(self.redsys.support_manual_capture)
+        self.assertEqual(self.redsys._get_redsys_config().transaction_type, "1")
+        answer = dict(self.redsys_ds_parameters, Ds_TransactionType="1")
+        self.assertEqual(self.tx._redsys_get_feedback_state(answer)[0], "authorized")
+        txs = Tx.create(
+            [dict(self.vals_tx, reference="TST%04d" % index) for index in range(5, 8)]
+        )
+        txs._set_authorized()
+        txs[0]._send_capture_request()
+        self.assertEqual(txs[0].state, "done")
+        stats = txs[1:]._redsys_send_operation_requests_batch()
+        self.assertEqual(stats["done"], 2)
+        self.assertEqual(txs[1:].mapped("state"), ["done", "done"])
+
+    def test_115_redsys_charge_transport_errors(self):
+        simulator = redsys_simulator.RedsysSimulator(
+            self.redsys.redsys_secret_key, notify=False
+        ).start()
+        self.addCleanup(simulator.stop)
+        config = self.env["ir.config_parameter"].sudo()
+        config.set_param("payment_redsys.simulator_url", simulator.url)
+        config.set_param("payment_redsys.status_query_delay", "0")
+        token = self.env["payment.token"].create(
+            {
+                "name": "XXXX-1234",
+                "partner_id": self.buyer_id,
+                "acquirer_id": self.redsys.id,
+                "acquirer_ref": "TOKEN",
+            }
+        )
+        Tx = self.env["payment.transaction"]
+        Retry = self.env["payment.redsys.retry"]
+        unreachable, lost = Tx.create(
+            [
+                dict(self.vals_tx, reference=reference, token_id=token.id, operation="offline")
+                for reference in ("TST0002", "TST0003")
+            ]
+        )
+        # Refused before sending anything, it is safe to send again
+        unreachable._redsys_handle_charge_failure(
+            error=requests.exceptions.ConnectTimeout("Connection timed out")
+        )
+        self.assertTrue(unreachable.redsys_retryable)
+        self.assertEqual(unreachable.state, "error")
+        self.assertTrue(Retry.search([("transaction_id", "=", unreachable.id)]))
+        # Redsys may have charged it, its order must be looked up first
+        lost._redsys_handle_charge_failure(
+            error=requests.exceptions.ReadTimeout("Read timed out")
+        )
+        self.assertFalse(lost.redsys_retryable)
+        self.assertEqual(lost.state, "pending")
+        self.assertFalse(Retry.search([("transaction_id", "=", lost.id)]))
+        # Neither of them is sent again by the token charges
+        self.assertFalse((unreachable | lost)._redsys_lock_drafts())
+        stale = Tx.search(Tx._redsys_get_stale_domain() + [("id", "=", lost.id)])
+        self.assertEqual(stale, lost)
+        stale._redsys_query_status_batch(rate=0)
+        self.assertEqual(lost.state, "error")
+        self.assertEqual(lost.redsys_error_code, "XML0024")
+        self.assertTrue(Retry.search([("transaction_id", "=", lost.id)]))
+
+    @patch("odoo.addons.sale.models.sale.SaleOrder.action_confirm")
+    @patch("odoo.addons.sale.models.sale.SaleOrder.action_quotation_send")
+    def test_116_redsys_partial_payment_notification_then_result(
+        self, mock_quo_send, mock_confirm
+    ):
+        self.redsys.redsys_percent_partial = 50
+        self.tx.amount = 50.25
+        self.tx.sale_order_ids = [(6, 0, self.so.ids)]
+        params = dict(self.redsys_ds_parameters, Ds_Amount="5025")
+        DS_parameters = self.redsys._url_encode64(json.dumps(params))
+        redsys_post_data = {
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, DS_parameters
+            ),
+            "Ds_MerchantParameters": DS_parameters,
+            "Ds_SignatureVersion": u"HMAC_SHA256_V1",
+        }
+        # The order is confirmed on the state set by the notification
+        self.env["payment.redsys.notification"]._receive(dict(redsys_post_data))
+        self.assertEqual(self.tx.state, "done")
+        mock_confirm.assert_called_once_with()
+        # Then the customer lands on the result page with the same answer
+        response = self.url_open(
+            "/payment/redsys/result/redsys_result_ok?"
+            + urllib.parse.urlencode(redsys_post_data),
+            allow_redirects=False,
+        )
+        self.assertEqual(response.status_code, 302)
+        self.assertEqual(self.tx.state, "done")
+        mock_confirm.assert_called_once_with()
+        mock_quo_send.assert_not_called()
+
+    def test_117_redsys_export_amounts_and_delimiter(self):
+        for value, amount in (
+            ("1.234,56", 1234.56),
+            ("1,234.56", 1234.56),
+            ("1234.56", 1234.56),
+            ("100,50 €", 100.5),
+            ("1.234.567", 1234567.0),
+            ("1,234,567.50", 1234567.5),
+        ):
+            self.assertEqual(redsys_utils.parse_amount(value), amount, value)
+        # A comma in the title line does not mislead the delimiter
+        export = "\n".join(
+            [
+                "Consulta de operaciones, octubre 2026",
+                "Fecha;Número de pedido;Importe",
+                "17/10/2026;%s;1.234,56" % self.tx.redsys_order,
+            ]
+        )
+        rows = [
+            row
+            for chunk in redsys_utils.read_export(io.BytesIO(export.encode()))
+            for row in chunk
+        ]
+        self.assertEqual(len(rows), 1)
+        self.assertEqual(rows[0][1:3], (self.tx.redsys_order, 1234.56))
@@ -0,0 +1,376 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import base64
+import hashlib
+import hmac
+import json
+import logging
+import os
+import platform
+import time
+import urllib
+
+from odoo import fields
+from odoo.tests import tagged
+from odoo.tests.common import HttpCase
+
+from odoo.addons.payment_redsys import simulator as redsys_simulator
+from odoo.addons.payment_redsys import utils as redsys_utils
+
+_logger = logging.getLogger(__name__)
+
+try:
+    from Crypto.Cipher import DES3
+except ImportError:
+    _logger.info("Missing dependency (pycryptodome). See README.")
+
+
+def legacy_sign_parameters(secret_key, params64):
+    """Signing as done before the key material was cached."""
+    params_dic = json.loads(base64.b64decode(params64).decode())
+    if "Ds_Merchant_Order" in params_dic:
+        order = str(params_dic["Ds_Merchant_Order"])
+    else:
+        order = str(urllib.parse.unquote(params_dic.get("Ds_Order", "Not found")))
+    cipher = DES3.new(
+        key=base64.b64decode(secret_key), mode=DES3.MODE_CBC, IV=b"\0\0\0\0\0\0\0\0"
+    )
+    diff_block = len(order) % 8
+    zeros = diff_block and (b"\0" * (8 - diff_block)) or b""
+    key = cipher.encrypt(str.encode(order + zeros.decode()))
+    if isinstance(params64, str):
+        params64 = params64.encode()
+    dig = hmac.new(key=key, msg=params64, digestmod=hashlib.sha256).digest()
+    return base64.b64encode(dig).decode()
+
+
+@tagged("-at_install", "post_install", "-standard", "redsys_benchmark")
+class RedsysBenchmark(HttpCase):
+    """Benchmarks of the signing, encoding and notification paths, excluded
+    from the standard run. Launch them with ``--test-tags redsys_benchmark``.
+
+    The transaction table sizes to measure are read from the
+    REDSYS_BENCHMARK_SIZES environment variable (comma separated), and the
+    results are written as JSON to the REDSYS_BENCHMARK_OUTPUT path, if set,
+    so they can be compared between releases.
+    """
+
+    results = []
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        output = os.environ.get("REDSYS_BENCHMARK_OUTPUT")
+        report = {
+            "date": fields.Datetime.to_string(fields.Datetime.now()),
+            "python": platform.python_version(),
+            "results": cls.results,
+        }
+        if output:
+            with open(output, "w") as report_file:
+                json.dump(report, report_file, indent=2, sort_keys=True)
+        _logger.info("Redsys benchmark results: %s", json.dumps(report))
+
+    def setUp(self):
+        super().setUp()
+        self.redsys = self.env.ref("payment_redsys.payment_acquirer_redsys")
+        self.redsys.redsys_merchant_code = "069611024"
+        self.redsys.redsys_secret_key = "sq7HjrUOBfKmC576ILgskD5srU870gJ8"
+        self.currency_euro = self.env["res.currency"].search(
+            [("name", "=", "EUR")], limit=1
+        )
+        self.partner = self.env["res.partner"].create({"name": "Benchmark Buyer"})
+        self.order = "BENCH0000001"
+        self.params64 = self.redsys._url_encode64(
+            json.dumps({"Ds_Merchant_Order": self.order, "Ds_Merchant_Amount": "10050"})
+        )
+        self.sizes = [
+            int(size)
+            for size in os.environ.get("REDSYS_BENCHMARK_SIZES", "100,1000,10000").split(",")
+        ]
+
+    def _measure(self, name, func, number=500, **extra):
+        """Call ``func`` ``number`` times and record its throughput and latency."""
+        latencies = []
+        start = time.perf_counter()
+        for _i in range(number):
+            call_start = time.perf_counter()
+            func()
+            latencies.append(time.perf_counter() - call_start)
+        elapsed = time.perf_counter() - start
+        latencies.sort()
+        result = dict(
+            extra,
+            name=name,
+            number=number,
+            ops_per_sec=number / elapsed if elapsed else 0.0,
+            p50=redsys_utils.percentile(latencies, 50),
+            p95=redsys_utils.percentile(latencies, 95),
+            p99=redsys_utils.percentile(latencies, 99),
+        )
+        self.results.append(result)
+        _logger.info(
+            "Redsys benchmark %s %s: %.0f ops/s, p50 %.6fs, p95 %.6fs, p99 %.6fs",
+            name,
+            extra or "",
+            result["ops_per_sec"],
+            result["p50"],
+            result["p95"],
+            result["p99"],
+        )
+        return result
+
+    def _tx_values(self, reference):
+        return {
+            "reference": reference,
+            "amount": 100.50,
+            "acquirer_id": self.redsys.id,
+            "currency_id": self.currency_euro.id,
+            "partner_id": self.partner.id,
+        }
+
+    def _fill_transactions(self, size):
+        """Grow the transaction table to ``size`` benchmark transactions."""
+        Transaction = self.env["payment.transaction"]
+        existing = Transaction.search_count([("reference", "=like", "BENCH%")])
+        for start in range(existing, size, 1000):
+            Transaction.create(
+                [
+                    self._tx_values("BENCH%07d" % index)
+                    for index in range(start + 1, min(start + 1000, size) + 1)
+                ]
+            )
+        Transaction.flush()
+
+    def _bench_order(self, index):
+        """Return the Redsys order number of the benchmark transaction ``index``."""
+        return self.env["payment.transaction"].search(
+            [("reference", "=", "BENCH%07d" % index)]
+        ).redsys_order
+
+    def _notification(self, order, authorisation_code="999999"):
+        params = self.redsys._url_encode64(
+            json.dumps(
+                {
+                    "Ds_Order": order,
+                    "Ds_Amount": "10050",
+                    "Ds_Currency": "978",
+                    "Ds_Response": "0000",
+                    "Ds_AuthorisationCode": authorisation_code,
+                    "Ds_MerchantCode": "069611024",
+                    "Ds_Terminal": "001",
+                }
+            )
+        ).decode()
+        return {
+            "Ds_SignatureVersion": "HMAC_SHA256_V1",
+            "Ds_MerchantParameters": params,
+            "Ds_Signature": self.redsys.sign_parameters(
+                self.redsys.redsys_secret_key, params
+            ),
+        }
+
+    def test_sign_parameters(self):
+        key = self.redsys.redsys_secret_key
+        expected = legacy_sign_parameters(key, self.params64)
+        self.assertEqual(self.redsys.sign_parameters(key, self.params64), expected)
+        self.assertEqual(
+            self.redsys.sign_parameters(key, self.params64, order=self.order), expected
+        )
+        self._measure(
+            "sign_parameters (legacy)",
+            lambda: legacy_sign_parameters(key, self.params64),
+            number=5000,
+        )
+        self._measure(
+            "sign_parameters",
+            lambda: self.redsys.sign_parameters(key, self.params64),
+            number=5000,
+        )
+        self._measure(
+            "sign_parameters (known order)",
+            lambda: self.redsys.sign_parameters(key, self.params64, order=self.order),
+            number=5000,
+        )
+        items = [(self.params64, self.order)] * 100
+        self._measure("sign_many (x100)", lambda: self.redsys.sign_many(items), number=50)
+
+    def test_bulk_verification(self):
+        key = self.redsys.redsys_secret_key
+        pairs = []
+        for index in range(20000):
+            params64 = self.redsys._url_encode64(
+                json.dumps(
+                    {
+                        "Ds_Order": "%012d" % index,
+                        "Ds_MerchantCode": "069611024",
+                        "Ds_Terminal": "001",
+                    }
+                )
+            ).decode()
+            pairs.append((params64, self.redsys.sign_parameters(key, params64)))
+
+        def legacy_verification():
+            for params64, signature in pairs:
+                if legacy_sign_parameters(key, params64) != signature:
+                    raise AssertionError(params64)
+
+        self._measure("verification x20000 (legacy)", legacy_verification, number=1)
+        for processes in (0, os.cpu_count() or 1):
+            self._measure(
+                "redsys_verify_signatures x20000",
+                lambda: all(self.redsys.redsys_verify_signatures(pairs, processes)),
+                number=1,
+                processes=processes,
+            )
+
+    def test_encoding(self):
+        data = json.dumps(self.redsys._url_decode64(self.params64))
+        self._measure("_url_encode64", lambda: self.redsys._url_encode64(data), 5000)
+        self._measure(
+            "_url_decode64", lambda: self.redsys._url_decode64(self.params64), 5000
+        )
+
+    def test_notification_decoding(self):
+        data = self._notification(self.order)
+
+        def legacy_decoding():
+            # Ds_MerchantParameters used to be decoded by the transaction
+            # lookup, the signature check, the parameter check and the
+            # feedback processing
+            for _i in range(4):
+                json.loads(base64.b64decode(data["Ds_MerchantParameters"]).decode())
+
+        def parsed_decoding():
+            values = dict(data)
+            for _i in range(4):
+                redsys_utils.parse_notification(values).params
+
+        self._measure("notification decoding (legacy)", legacy_decoding, 5000)
+        self._measure("notification decoding (parsed once)", parsed_decoding, 5000)
+
+    def test_form_rendering(self):
+        self.env["payment.transaction"].create(self._tx_values(self.order))
+        self._measure(
+            "_prepare_merchant_parameters",
+            lambda: self.redsys._prepare_merchant_parameters(self._tx_values(self.order)),
+        )
+        self._measure(
+            "redsys_form_generate_values",
+            lambda: self.redsys.redsys_form_generate_values(self._tx_values(self.order)),
+        )
+        tx = self.env["payment.transaction"].create(
+            dict(self._tx_values("BENCHFORM001"), operation="online_redirect")
+        )
+        self._measure(
+            "_get_specific_rendering_values (presigned)",
+            lambda: tx._get_specific_rendering_values({"reference": tx.reference}),
+        )
+        view = self.redsys._get_redirect_form_view()
+        values = tx._get_specific_rendering_values({"reference": tx.reference})
+        self._measure(
+            "redirect form QWeb rendering", lambda: view._render(values, engine="ir.qweb")
+        )
+
+    def test_notification_lookup(self):
+        Transaction = self.env["payment.transaction"]
+        for size in self.sizes:
+            self._fill_transactions(size)
+            data = self._notification(self._bench_order(size // 2 or 1))
+            self._measure(
+                "_redsys_form_get_tx_from_data",
+                lambda: Transaction._redsys_form_get_tx_from_data(data),
+                table_size=size,
+            )
+
+    def test_return_round_trip(self):
+        # Every call gets its own authorisation code, not to be dropped as a
+        # duplicate notification
+        codes = iter(range(10 ** 6))
+        for size in self.sizes:
+            self._fill_transactions(size)
+            order = self._bench_order(size // 2 or 1)
+            self._measure(
+                "/payment/redsys/return",
+                lambda: self.url_open(
+                    "/payment/redsys/return",
+                    data=self._notification(order, "%06d" % next(codes)),
+                    allow_redirects=False,
+                ),
+                number=100,
+                table_size=size,
+            )
+
+    def _start_simulator(self, **options):
+        simulator = redsys_simulator.RedsysSimulator(
+            self.redsys.redsys_secret_key, notify=False, **options
+        ).start()
+        self.addCleanup(simulator.stop)
+        self.env["ir.config_parameter"].sudo().set_param(
+            "payment_redsys.simulator_url", simulator.url
+        )
+        return simulator
+
+    def test_rest_round_trip(self):
+        tx = self.env["payment.transaction"].create(self._tx_values(self.order))
+        self._start_simulator()
+        self._measure(
+            "_redsys_make_request",
+            lambda: self.redsys._redsys_make_request(tx._redsys_prepare_s2s_values()),
+        )
+
+    def test_simulated_batch_charge(self):
+        """MIT charges against the simulator, with the latency of the real SIS
+        (REDSYS_BENCHMARK_LATENCY seconds) and 1% of transient errors.
+        """
+        self._start_simulator(
+            latency=float(os.environ.get("REDSYS_BENCHMARK_LATENCY", "0.2")),
+            error_rate=0.01,
+            seed=1,
+        )
+        token = self.env["payment.token"].create(
+            {
+                "name": "XXXX-1234",
+                "partner_id": self.partner.id,
+                "acquirer_id": self.redsys.id,
+                "acquirer_ref": "TOKEN",
+            }
+        )
+        for size in self.sizes:
+            txs = self.env["payment.transaction"].create(
+                [
+                    dict(
+                        self._tx_values("MIT%05d%06d" % (size % 10 ** 5, index)),
+                        token_id=token.id,
+                        operation="offline",
+                    )
+                    for index in range(size)
+                ]
+            )
+            stats = txs._redsys_send_payment_requests_batch()
+            result = dict(stats, name="simulated batch charge", table_size=size)
+            result.pop("failures")
+            self.results.append(result)
+            _logger.info("Redsys benchmark simulated batch charge: %s", result)
+
+    def test_simulated_batch_refund(self):
+        """Refunds against the simulator, with the latency of the real SIS
+        (REDSYS_BENCHMARK_LATENCY seconds).
+        """
+        self._start_simulator(
+            latency=float(os.environ.get("REDSYS_BENCHMARK_LATENCY", "0.2")), seed=1
+        )
+        for size in self.sizes:
+            txs = self.env["payment.transaction"].create(
+                [
+                    self._tx_values("REF%05d%06d" % (size % 10 ** 5, index))
+                    for index in range(size)
+                ]
+            )
+            txs._set_done()
+            stats = txs._redsys_refund_batch()
+            result = dict(stats, name="simulated batch refund", table_size=size)
+            result.pop("failures")
+            result.pop("results")
+            self.results.append(result)
+            _logger.info("Redsys benchmark simulated batch refund: %s", result)
@@ -0,0 +1,661 @@
+# License AGPL-3.0 or later (https://www.gnu.org/licenses/agpl).
+
+import base64
+import collections
+import concurrent.futures
+import csv
+import datetime
+import functools
+import hashlib
+import io
+import itertools
+import json
+import logging
+import math
+import pprint
+import random
+import threading
+import time
+import unicodedata
+import urllib
+
+import requests
+import urllib3
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from . import const, metrics
+from .sis import (  # noqa: F401
+    TokenBucket,
+    clear_signing_cache,
+    derive_order_key,
+    get_order,
+    sign_parameters,
+    signatures_match,
+)
+
+_logger = logging.getLogger(__name__)
+
+# Pooled HTTP sessions, one per (database, acquirer) and worker process
+_sessions = {}
+_sessions_lock = threading.Lock()
+
+
+def get_session(key, pool_size=10, max_retries=2, backoff_factor=0.3):
+    """Return the keep-alive session bound to ``key``, creating it if needed.
+
+    Connections to Redsys are pooled and reused between calls, so only the
+    first request of a worker pays the TCP+TLS handshake. Only connection
+    errors are retried: a POST that may have reached Redsys is never
+    replayed, as that could charge the customer twice.
+    """
+    options = (pool_size, max_retries, backoff_factor)
+    with _sessions_lock:
+        entry = _sessions.get(key)
+        if entry and entry[0] == options:
+            return entry[1]
+        if entry:
+            entry[1].close()
+        retry = Retry(
+            total=max_retries,
+            connect=max_retries,
+            read=False,
+            redirect=False,
+            status=0,
+            backoff_factor=backoff_factor,
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(
+            pool_connections=2, pool_maxsize=pool_size, max_retries=retry
+        )
+        session = requests.Session()
+        session.mount("https://", adapter)
+        session.mount("http://", adapter)
+        _sessions[key] = (options, session)
+        return session
+
+
+def get_session_stats():
+    """Return the connection counters of every pooled session.
+
+    ``new`` counts the connections opened (one handshake each) and
+    ``reused`` the requests served over an already open connection.
+    """
+    stats = {}
+    with _sessions_lock:
+        sessions = list(_sessions.items())
+    for key, (_options, session) in sessions:
+        new = sent = 0
+        for adapter in {id(a): a for a in session.adapters.values()}.values():
+            pools = adapter.poolmanager.pools
+            for pool_key in pools.keys():
+                pool = pools.get(pool_key)
+                if pool is None:
+                    continue
+                new += pool.num_connections
+                sent += pool.num_requests
+        stats[key] = {"requests": sent, "new": new, "reused": max(sent - new, 0)}
+    return stats
+
+
+def _parse_json(content):
+    return json.loads(content.decode("utf8"))
+
+
+def timed_post(session, url, data, timeout, headers=None, parse=None):
+    """POST ``data`` with ``session`` and return ``(response, error, seconds)``.
+
+    The body of the response is decoded by ``parse``, JSON by default. Meant
+    to run inside worker threads: it never touches the ORM, and transport
+    errors are returned instead of raised so one failing call does not abort
+    a whole batch.
+    """
+    start = time.perf_counter()
+    try:
+        response = session.post(url, data=data, timeout=timeout, headers=headers)
+        result = (parse or _parse_json)(response.content), None, _elapsed(start)
+    except (requests.exceptions.RequestException, ValueError) as error:
+        result = None, error, _elapsed(start)
+    metrics.observe_rest(result[2], result[0], result[1])
+    return result
+
+
+def is_connect_error(error):
+    """Whether the transport ``error`` happened before the request was sent,
+    while connecting to Redsys, so that sending it again cannot charge twice.
+    A read timeout or a connection dropped while waiting for the answer may
+    come after Redsys processed the request.
+    """
+    if isinstance(error, requests.exceptions.ConnectTimeout):
+        return True
+    if not isinstance(error, requests.exceptions.ConnectionError):
+        return False
+    reason = error.args[0] if error.args else None
+    reason = getattr(reason, "reason", reason)
+    return isinstance(reason, urllib3.exceptions.NewConnectionError)
+
+
+def post_many(calls, concurrency=8, rate=0):
+    """Send ``(session, url, data, timeout[, headers, parse])`` calls with
+    ``timed_post`` over ``concurrency`` threads, starting at most ``rate`` of
+    them per second (0 for unlimited). Returns their results in the order of
+    ``calls``.
+    """
+    bucket = TokenBucket(rate)
+
+    def post(call):
+        bucket.acquire()
+        return timed_post(*call)
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(concurrency, 1)) as executor:
+        return list(executor.map(post, calls))
+
+
+def _elapsed(start):
+    return time.perf_counter() - start
+
+
+def percentile(sorted_values, pct):
+    """Return the nearest-rank ``pct`` percentile of ``sorted_values``."""
+    if not sorted_values:
+        return 0.0
+    rank = max(int(math.ceil(pct / 100.0 * len(sorted_values))) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarize_run(latencies, elapsed, done, failures):
+    """Build the statistics reported by the batch runs.
+
+    :param list latencies: The duration in seconds of every remote call
+    :param float elapsed: The wall-clock duration of the whole run
+    :param int done: The number of items that succeeded
+    :param list failures: ``(reference, reason)`` of the items that failed
+    """
+    latencies = sorted(latencies)
+    count = done + len(failures)
+    return {
+        "count": count,
+        "done": done,
+        "failed": len(failures),
+        "failures": failures,
+        "elapsed": elapsed,
+        "throughput": count / elapsed if elapsed else 0.0,
+        "latency": {
+            "p50": percentile(latencies, 50),
+            "p95": percentile(latencies, 95),
+            "p99": percentile(latencies, 99),
+            "max": latencies[-1] if latencies else 0.0,
+        },
+    }
+
+
+def merchant_key(params):
+    """Return the (merchant code, terminal) a Redsys payload belongs to."""
+    code = params.get("Ds_MerchantCode") or params.get("Ds_Merchant_MerchantCode")
+    terminal = params.get("Ds_Terminal") or params.get("Ds_Merchant_Terminal") or 1
+    try:
+        return str(code or ""), int(terminal)
+    except (TypeError, ValueError):
+        return str(code or ""), 0
+
+
+def _verify_pair(keys, params64, signature):
+    try:
+        params = json.loads(base64.b64decode(params64))
+        secret_key = keys.get(merchant_key(params))
+        order = get_order(params)
+    except (TypeError, ValueError, AttributeError):
+        return False
+    if not secret_key:
+        return False
+    return signatures_match(sign_parameters(secret_key, params64, order), signature)
+
+
+def verify_chunk(keys, pairs):
+    """Verify ``(Ds_MerchantParameters, Ds_Signature)`` pairs, see ``verify_many``."""
+    return [_verify_pair(keys, params64, signature) for params64, signature in pairs]
+
+
+def verify_many(keys, pairs, processes=0, chunk_size=10000):
+    """Verify a stream of ``(Ds_MerchantParameters, Ds_Signature)`` pairs.
+
+    :param dict keys: The secret keys indexed by ``merchant_key``
+    :param iterable pairs: The pairs to verify, consumed lazily
+    :param int processes: The size of the process pool, none if below 2
+    :param int chunk_size: The number of pairs sent at once to a process
+    :return: Whether each pair is correctly signed, in the order of ``pairs``
+    :rtype: generator
+    """
+    chunks = iter(lambda it=iter(pairs): list(itertools.islice(it, chunk_size)), [])
+    if processes < 2:
+        for chunk in chunks:
+            yield from verify_chunk(keys, chunk)
+        return
+    verify = functools.partial(verify_chunk, keys)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=processes) as executor:
+        # At most two chunks in flight per process, so a stream of any size is
+        # never fully loaded in memory
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append(executor.submit(verify, chunk))
+            if len(pending) >= 2 * processes:
+                yield from pending.popleft().result()
+        while pending:
+            yield from pending.popleft().result()
+
+
+# Key under which the parsed notification travels along its raw values
+NOTIFICATION_KEY = "_redsys_notification"
+
+
+class ParsedNotification(object):
+    """Values of a Redsys notification, decoded once and shared by every step
+    of the feedback pipeline. ``verified`` is set once its signature checked.
+    """
+
+    __slots__ = (
+        "raw",
+        "params",
+        "signature",
+        "signature_version",
+        "order",
+        "response",
+        "authorisation_code",
+        "amount",
+        "error_code",
+        "verified",
+        "_fingerprint",
+    )
+
+    def __init__(self, data):
+        raw = data.get("Ds_MerchantParameters", "")
+        self.raw = raw.encode() if isinstance(raw, str) else raw
+        try:
+            params = json.loads(base64.b64decode(self.raw))
+        except (ValueError, TypeError):
+            params = {}
+        self.params = params if isinstance(params, dict) else {}
+        self.signature = data.get("Ds_Signature", "").replace("_", "/").replace("-", "+")
+        self.signature_version = data.get("Ds_SignatureVersion")
+        self.order = urllib.parse.unquote(str(self.params.get("Ds_Order", "")))
+        self.response = self.params.get("Ds_Response")
+        self.authorisation_code = self.params.get("Ds_AuthorisationCode")
+        self.amount = self.params.get("Ds_Amount")
+        self.error_code = self.params.get("Ds_ErrorCode")
+        self.verified = False
+        self._fingerprint = None
+
+    @property
+    def fingerprint(self):
+        """Identify the notification, or None if its parameters are unreadable.
+
+        It is keyed on Ds_Order, Ds_Response, Ds_AuthorisationCode and the
+        signature, so the merchant URL retries of Redsys and the browser
+        redirection carrying the same parameters share one fingerprint.
+        """
+        if self._fingerprint is None and self.params:
+            key = "|".join(
+                str(self.params.get(name, ""))
+                for name in ("Ds_Order", "Ds_Response", "Ds_AuthorisationCode")
+            )
+            self._fingerprint = hashlib.sha256(
+                ("%s|%s" % (key, self.signature)).encode()
+            ).hexdigest()
+        return self._fingerprint
+
+
+def parse_notification(data):
+    """Return the parsed notification of ``data``, decoding and attaching it
+    to ``data`` on the first call only.
+    """
+    notification = data.get(NOTIFICATION_KEY)
+    # Posted values are strings, they can never pass for a parsed notification
+    if not isinstance(notification, ParsedNotification):
+        notification = data[NOTIFICATION_KEY] = ParsedNotification(data)
+    return notification
+
+
+def raw_data(data):
+    """Return the values of ``data`` as posted, without the parsed notification."""
+    return {key: value for key, value in data.items() if key != NOTIFICATION_KEY}
+
+
+def notification_fingerprint(data):
+    return parse_notification(data).fingerprint
+
+
+class NotificationDeduplicator(object):
+    """Bounded LRU of the notifications already handled by this worker."""
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.suppressed = 0
+        self._seen = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def is_duplicate(self, key):
+        with self._lock:
+            if key not in self._seen:
+                return False
+            self._seen.move_to_end(key)
+            self.suppressed += 1
+            return True
+
+    def remember(self, key):
+        with self._lock:
+            self._seen[key] = True
+            self._seen.move_to_end(key)
+            while len(self._seen) > self.maxsize:
+                self._seen.popitem(last=False)
+
+    def count_suppressed(self):
+        with self._lock:
+            self.suppressed += 1
+
+
+notification_deduplicator = NotificationDeduplicator()
+
+
+# Parameters never written to the logs: signatures, card and token data and
+# the customer identity
+SENSITIVE_KEYS = frozenset(
+    key.lower()
+    for key in (
+        "Ds_Signature",
+        "Ds_MerchantParameters",
+        "Ds_Merchant_Titular",
+        "Ds_Merchant_Identifier",
+        "Ds_Merchant_Cof_Txnid",
+        "Ds_Merchant_Pan",
+        "Ds_Merchant_ExpiryDate",
+        "Ds_Merchant_Cvv2",
+        "Ds_Card_Number",
+        "Ds_ExpiryDate",
+        "Ds_Merchant_Customer_Mobile",
+        "Ds_Merchant_Customer_Mail",
+        "token_ref",
+        "txnid",
+    )
+)
+
+
+def redact(values):
+    """Return a copy of ``values`` with the sensitive parameters masked."""
+    return {
+        key: "***" if str(key).lower() in SENSITIVE_KEYS else value
+        for key, value in values.items()
+    }
+
+
+class LazyRedacted(object):
+    """Log argument formatting ``values``, redacted, only when a record is
+    actually emitted.
+    """
+
+    __slots__ = ("values",)
+
+    def __init__(self, values):
+        self.values = values
+
+    def __str__(self):
+        return pprint.pformat(redact(self.values))
+
+
+def trace(logger, event, values, sample_rate=0.0):
+    """Log ``event`` with its redacted ``values``.
+
+    The record is emitted at DEBUG, and at INFO for a random ``sample_rate``
+    share of the calls, so production traffic can be sampled without enabling
+    DEBUG. Nothing is formatted when neither applies.
+    """
+    if sample_rate and random.random() < sample_rate:
+        logger.info("Redsys %s: %s", event, LazyRedacted(values))
+    elif logger.isEnabledFor(logging.DEBUG):
+        logger.debug("Redsys %s: %s", event, LazyRedacted(values))
+
+
+ResponseClass = collections.namedtuple("ResponseClass", ["state", "retryable", "reason"])
+
+
+# Immutable settings of an acquirer, with every field already defaulted and
+# truncated to the length accepted by the SIS
+RedsysConfig = collections.namedtuple(
+    "RedsysConfig",
+    [
+        "acquirer_id",
+        "state",
+        "website_id",
+        "merchant_code",
+        "merchant_name",
+        "merchant_description",
+        "merchant_data",
+        "terminal",
+        "currency",
+        "transaction_type",
+        "lang",
+        "pay_method",
+        "signature_version",
+        "secret_key",
+        "percent_partial",
+        "form_url",
+        "s2s_url",
+    ],
+)
+
+
+def _build_response_table():
+    table = [None] * 10000
+    for first, last, state, retryable, reason in const.RESPONSE_RANGES:
+        entry = ResponseClass(state, retryable, reason)
+        for code in range(first, last + 1):
+            table[code] = entry
+    for code, values in const.RESPONSE_CODES.items():
+        table[code] = ResponseClass(*values)
+    return table
+
+
+# Dense lookup table of every Ds_Response code from 0 to 9999
+RESPONSE_TABLE = _build_response_table()
+
+
+def classify_response(status_code, error_code=None):
+    """Return the state, retryability and reason of a Redsys answer.
+
+    :param int status_code: The Ds_Response code
+    :param str error_code: The Ds_ErrorCode / errorCode (SISxxxx), if any
+    :rtype: ResponseClass
+    """
+    if 0 <= status_code < len(RESPONSE_TABLE):
+        result = RESPONSE_TABLE[status_code]
+    else:
+        # Negative codes were historically taken as pending
+        result = ResponseClass(
+            "pending" if status_code < 0 else "error", False, "Unknown response code"
+        )
+    if error_code and result.state != "done":
+        retryable, reason = const.SIS_ERROR_CODES.get(
+            error_code, (False, "SIS error %s" % error_code)
+        )
+        result = result._replace(retryable=retryable, reason=reason)
+    return result
+
+
+def retry_delay(attempt, key, base=3600, cap=86400, window=900):
+    """Return the delay in seconds before the retry number ``attempt``.
+
+    The delay grows exponentially from ``base`` up to ``cap``, half of it
+    being random jitter. A fixed offset within ``window``, derived from
+    ``key``, spreads the retries of failures that happened at the same time
+    (e.g. a whole nightly run) instead of replaying them as one burst.
+    """
+    delay = min(cap, base * 2 ** attempt)
+    delay = delay / 2.0 + random.uniform(0, delay / 2.0)
+    # Knuth multiplicative hash, so consecutive keys land far apart
+    offset = (key * 2654435761) % (2 ** 32) % window if window else 0
+    return delay + offset
+
+
+def consultation_feedback(params):
+    """Return the operation ``params`` found by a consultation as feedback
+    data, shaped as the REST answers.
+    """
+    return {"Ds_MerchantParameters": base64.b64encode(json.dumps(params).encode()).decode()}
+
+
+def expected_amount(amount, percent_partial=0.0):
+    """Return the amount charged by Redsys for a transaction of ``amount``,
+    once the partial payment percentage of the acquirer is deducted.
+    """
+    if percent_partial > 0.0:
+        return amount - (amount * percent_partial / 100)
+    return amount
+
+
+def parse_amount(value):
+    """Parse an amount of a Redsys export, e.g. ``1.234,56``, ``1,234.56`` or
+    ``1234.56``.
+
+    When both separators are used the last one is the decimal one, a separator
+    repeated alone groups thousands.
+    """
+    value = value.strip().replace(" ", "").replace("\xa0", "")
+    for symbol in ("EUR", "€"):
+        value = value.replace(symbol, "")
+    if "," in value and "." in value:
+        thousands = "," if value.rindex(",") < value.rindex(".") else "."
+    elif value.count(",") > 1 or value.count(".") > 1:
+        thousands = "," if "," in value else "."
+    else:
+        thousands = ""
+    if thousands:
+        value = value.replace(thousands, "")
+    return float(value.replace(",", "."))
+
+
+def parse_export_date(value):
+    value = value.strip()[:10]
+    for fmt in ("%d/%m/%Y", "%Y-%m-%d", "%d-%m-%Y"):
+        try:
+            return datetime.datetime.strptime(value, fmt).date()
+        except ValueError:
+            continue
+    return None
+
+
+def _normalize_column(name):
+    name = unicodedata.normalize("NFKD", name).encode("ascii", "ignore").decode()
+    return "".join(char for char in name.lower() if char.isalpha())
+
+
+def _find_columns(header):
+    names = [_normalize_column(name) for name in header]
+    columns = {}
+    for key, aliases in const.EXPORT_COLUMNS.items():
+        exact = [names.index(alias) for alias in aliases if alias in names]
+        partial = [
+            index for alias in aliases for index, name in enumerate(names) if alias in name
+        ]
+        if exact or partial:
+            columns[key] = (exact or partial)[0]
+    return columns
+
+
+def read_export(
+    fileobj, chunk_size=5000, encoding="utf-8-sig", max_preamble=20, sample_size=16384
+):
+    """Read an operations or settlement export of Redsys, in CSV, line by line.
+
+    The delimiter is sniffed on a sample of the first ``sample_size``
+    characters and the title lines before the header skipped.
+    Yields lists of up to ``chunk_size`` ``(line, order, amount, date)``
+    tuples, ``amount`` being None when the row cannot be parsed, so only one
+    chunk is held in memory whatever the size of the file. The rows of
+    refunds and cancellations are left out.
+
+    :param fileobj: A binary or text file object
+    """
+    if not isinstance(fileobj, io.TextIOBase):
+        fileobj = io.TextIOWrapper(fileobj, encoding=encoding, errors="replace", newline="")
+    # The sample ends on a whole line, so no row is split when chaining it back
+    sample = fileobj.read(sample_size)
+    sample += fileobj.readline()
+    try:
+        delimiter = csv.Sniffer().sniff(sample, delimiters=";,\t").delimiter
+    except csv.Error:
+        delimiter = max(";,\t", key=sample.count)
+    reader = csv.reader(itertools.chain(io.StringIO(sample), fileobj), delimiter=delimiter)
+    columns = {}
+    for header in itertools.islice(reader, max_preamble):
+        columns = _find_columns(header)
+        if "order" in columns and "amount" in columns:
+            break
+    else:
+        raise ValueError("No order and amount columns found in the Redsys export")
+    order_col, amount_col = columns["order"], columns["amount"]
+    # Ds_Amount is in cents, as in the notifications
+    divisor = 100.0 if _normalize_column(header[amount_col]) == "dsamount" else 1.0
+    date_col, type_col = columns.get("date"), columns.get("type")
+    width = max(columns.values()) + 1
+    chunk = []
+    for row in reader:
+        if len(row) < width or not row[order_col].strip():
+            continue
+        if type_col is not None:
+            operation = _normalize_column(row[type_col])
+            if any(word in operation for word in const.EXPORT_SKIPPED_TYPES):
+                continue
+        try:
+            amount = parse_amount(row[amount_col]) / divisor
+        except ValueError:
+            amount = None
+        chunk.append(
+            (
+                reader.line_num,
+                row[order_col].strip(),
+                amount,
+                parse_export_date(row[date_col]) if date_col is not None else None,
+            )
+        )
+        if len(chunk) >= chunk_size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+class OrderNumberAllocator(object):
+    """Hands out Redsys order numbers from blocks reserved in a database
+    sequence, so that a worker only hits the sequence once per block.
+    Numbers are unique across workers, but not consecutive.
+    """
+
+    def __init__(self):
+        self._blocks = {}
+        self._lock = threading.Lock()
+
+    def next(self, key, reserve_block):
+        """Return the next number of the block of ``key`` (e.g. the database
+        name), calling ``reserve_block`` for a new ``(first, size)`` block
+        when it is used up.
+        """
+        with self._lock:
+            number, end = self._blocks.get(key, (0, 0))
+            if number >= end:
+                number, size = reserve_block()
+                end = number + size
+            self._blocks[key] = (number + 1, end)
+            return number
+
+    def clear(self):
+        with self._lock:
+            self._blocks.clear()
+
+
+order_numbers = OrderNumberAllocator()
+
+
+def format_order(number):
+    """Return the Ds_Order of ``number``: 12 digits, as Redsys requires the
+    first 4 characters to be numeric and accepts 12 at most.
+    """
+    return "%012d" % number